@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""Benchmark dfman phases on synthetic dotfile trees
+
+Every case runs in its own process against a generated tree in a temp dir.
+Phases are timed over REPEATS passes, keeping the best time, and their peak
+Python heap is measured with tracemalloc in a last pass, so tracing doesn't
+skew the timings.
+"""
+
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from context import dfman
+from dfman import core
+
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(BASE, 'baseline.json')
+
+SIZES = (10, 1000, 10000, 100000)
+# Fraction of entries with a global override and with a distro override
+PROFILES = {
+    'plain': (0.0, 0.0),
+    'overrides': (0.1, 0.01),
+    'distro': (0.3, 0.2),
+}
+DISTRO = 'benchdistro'
+# Every DIR_EVERY-th entry is a directory, every EXISTING_EVERY-th
+# destination already exists and has to be backed up
+DIR_EVERY = 10
+EXISTING_EVERY = 20
+
+PHASES = (
+    'config_cold', 'config_warm', 'get_filemap', 'install', 'install_noop', 'uninstall'
+)
+
+# Timed passes per case, the fastest counts
+REPEATS = 3
+# A phase regresses if it is slower than baseline * (1 + tolerance) + slack.
+# The slack is above the scheduling noise of phases taking milliseconds,
+# which only regress when they grow by a measurable amount.
+TOLERANCE = 0.5
+TIME_SLACK = 0.025
+MEMORY_SLACK = 64 * 1024
+
+SCRIPT = os.path.join(BASE, '..', 'bin', 'dfman')
+# Allowed growth of the cold start overhead of a no-op install over a bare
+# interpreter, in seconds, above the overhead recorded in the baseline
+STARTUP_SLACK = 0.02
+STARTUP_RUNS = 5
+
+
+def make_tree(root, size, profile):
+    """Generate dotfiles, destinations and a config file, return its path"""
+    override_density, distro_density = PROFILES[profile]
+    paths = {
+        i: os.path.join(root, i)
+        for i in ('dotfile_path', 'config_path', 'backup_path', 'home')
+    }
+    for path in paths.values():
+        os.makedirs(path)
+    paths['manifest'] = os.path.join(root, 'manifest.json')
+    paths['journal'] = os.path.join(root, 'journal')
+    paths['log'] = os.path.join(root, 'dfman.log')
+    overrides, distro = [], []
+    for i in range(size):
+        name = 'entry%06d' % i
+        src = os.path.join(paths['dotfile_path'], name)
+        if i % DIR_EVERY == 0:
+            os.makedirs(src)
+            open(os.path.join(src, 'file'), 'a').close()
+        else:
+            open(src, 'a').close()
+        # Spread overrides evenly instead of clustering them at the start
+        if int((i + 1) * override_density) != int(i * override_density):
+            overrides.append('%s = %s\n' % (name, os.path.join(paths['home'], name)))
+        if int((i + 1) * distro_density) != int(i * distro_density):
+            distro.append('%s = %s\n' % (name, os.path.join(paths['home'], 'distro', name)))
+        elif i % EXISTING_EVERY == EXISTING_EVERY - 1:
+            open(os.path.join(paths['config_path'], name), 'a').close()
+    os.makedirs(os.path.join(paths['home'], 'distro'))
+    cfg_file = os.path.join(root, 'dfman.conf')
+    with open(cfg_file, 'w') as f:
+        f.write('[Globals]\n')
+        for key in ('dotfile_path', 'config_path', 'backup_path', 'manifest', 'journal', 'log'):
+            f.write('%s = %s\n' % (key, paths[key]))
+        f.write('\n[Overrides]\n')
+        f.writelines(overrides)
+        f.write('\n[%s]\n' % DISTRO)
+        f.writelines(distro)
+    return cfg_file
+
+
+def new_runtime(cfg_file):
+    """Return a runtime using cfg_file, without touching the user config"""
+    runtime = core.MainRuntime(False, False)
+    runtime.config.cfg_file = cfg_file
+    runtime.distro = DISTRO
+    return runtime
+
+
+def run_phases(cfg_file):
+    """Run every phase once and yield (phase, seconds, peak traced bytes)"""
+    cache_file = new_runtime(cfg_file).config.cache_file()
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    steps = (
+        ('config_cold', lambda runtime: runtime.config.load_cfg()),
+        ('config_warm', lambda runtime: runtime.config.load_cfg()),
+        ('get_filemap', lambda runtime: runtime.get_filemap()),
+        ('install', lambda runtime: runtime.install_dotfiles()),
+        ('install_noop', lambda runtime: runtime.install_dotfiles()),
+        ('uninstall', lambda runtime: runtime.uninstall_dotfiles()),
+    )
+    runtime = None
+    for phase, step in steps:
+        if phase in ('config_cold', 'config_warm'):
+            runtime = new_runtime(cfg_file)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        step(runtime)
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+        yield phase, elapsed, peak
+
+
+def reset_state(root):
+    """Forget the state of the last pass, so the next one starts cold"""
+    os.remove(os.path.join(root, 'manifest.json'))
+    shutil.rmtree(os.path.join(root, 'backup_path'))
+    os.makedirs(os.path.join(root, 'backup_path'))
+
+
+def run_case(size, profile):
+    """Return the result of a single case"""
+    root = tempfile.mkdtemp(prefix='dfman-bench-')
+    try:
+        cfg_file = make_tree(root, size, profile)
+        result = {}
+        for _repeat in range(REPEATS):
+            for phase, elapsed, _ in run_phases(cfg_file):
+                if phase in result and result[phase]['seconds'] <= elapsed:
+                    continue
+                result[phase] = {
+                    'seconds': elapsed, 'per_second': size / elapsed if elapsed else None
+                }
+            reset_state(root)
+        tracemalloc.start()
+        for phase, _, peak in run_phases(cfg_file):
+            result[phase]['peak_bytes'] = peak
+        tracemalloc.stop()
+        result['max_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return result
+    finally:
+        shutil.rmtree(root)
+
+
+def case_key(size, profile):
+    """Return the name of a case"""
+    return '%s/%d' % (profile, size)
+
+
+def run_all(sizes, profiles):
+    """Run every case in a fresh process and return the results by case"""
+    results = {}
+    for profile in profiles:
+        for size in sizes:
+            output = subprocess.run(
+                [sys.executable, __file__, '--case', str(size), profile],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True
+            ).stdout
+            results[case_key(size, profile)] = json.loads(output)
+            report(case_key(size, profile), results[case_key(size, profile)])
+    return results
+
+
+def report(key, result):
+    """Print a case result"""
+    print('%s (max rss %d KiB)' % (key, result['max_rss_kib']))
+    for phase in PHASES:
+        values = result[phase]
+        print('  %-13s %10.4fs %14s entries/s %10d KiB peak' % (
+            phase, values['seconds'],
+            '%.0f' % values['per_second'] if values['per_second'] else '-',
+            values['peak_bytes'] // 1024
+        ))
+    sys.stdout.flush()
+
+
+def startup_overhead():
+    """Return the best time of a no-op install from a fresh process minus
+    that of a bare interpreter"""
+    home = tempfile.mkdtemp(prefix='dfman-bench-')
+    env = dict(os.environ, HOME=home, PYTHONPATH=os.path.join(BASE, '..'))
+
+    def best_of(*args):
+        timings = []
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable] + list(args), env=env, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            timings.append(time.perf_counter() - start)
+        return min(timings)
+
+    try:
+        os.makedirs(os.path.join(home, '.dotfiles', 'files', 'app'))
+        os.makedirs(os.path.join(home, '.config'))
+        # First run creates the config, its compiled cache and the manifest
+        best_of(SCRIPT, 'install')
+        return best_of(SCRIPT, 'install') - best_of('-c', 'pass')
+    finally:
+        shutil.rmtree(home)
+
+
+def compare(results, baseline, tolerance):
+    """Return descriptions of phases which regressed against baseline"""
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        for phase in PHASES:
+            old, new = baseline[key][phase], result[phase]
+            limit = old['seconds'] * (1 + tolerance) + TIME_SLACK
+            if new['seconds'] > limit:
+                regressions.append('%s %s: %.4fs, baseline %.4fs' % (
+                    key, phase, new['seconds'], old['seconds']
+                ))
+            limit = old['peak_bytes'] * (1 + tolerance) + MEMORY_SLACK
+            if new['peak_bytes'] > limit:
+                regressions.append('%s %s: %d KiB peak, baseline %d KiB' % (
+                    key, phase, new['peak_bytes'] // 1024, old['peak_bytes'] // 1024
+                ))
+    return regressions
+
+
+def main():
+    """Run benchmarks and compare or save them"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--profiles', nargs='+', choices=sorted(PROFILES), default=sorted(PROFILES))
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    parser.add_argument('--save', action='store_true', help='store results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--case', nargs=2, metavar=('SIZE', 'PROFILE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        json.dump(run_case(int(args.case[0]), args.case[1]), sys.stdout)
+        return
+
+    results = run_all(args.sizes, args.profiles)
+    overhead = startup_overhead()
+    print('startup overhead %.4fs' % overhead)
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        baseline['startup'] = {'seconds': overhead}
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return
+    if not os.path.exists(args.baseline):
+        sys.exit('%s: No baseline, run with --save first' % args.baseline)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if 'startup' not in baseline:
+        sys.exit('%s: No startup baseline, run with --save first' % args.baseline)
+    budget = baseline['startup']['seconds'] + STARTUP_SLACK
+    if overhead > budget:
+        regressions.append('startup: %.4fs over a bare interpreter, budget %.4fs' % (
+            overhead, budget
+        ))
+    for regression in regressions:
+        print('REGRESSION %s' % regression)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,3 +4,12 @@ import logging
 from dfman.config import Config
 
 logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+
+def __getattr__(name):
+    # dfman.api imports dfman.core, which imports this package, so the
+    # API is only imported once it is used
+    if name in ('Dfman', 'Result'):
+        from dfman import api
+        return getattr(api, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
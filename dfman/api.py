@@ -0,0 +1,155 @@
+"""Library interface for provisioning from Python
+
+Nothing here touches logging configuration: records go to the dfman logger,
+which only has a NullHandler unless the embedding application adds its own.
+"""
+
+
+import os
+from dfman import core, osrelease
+from dfman.config import Config
+
+
+class Result(object):
+    """Outcome of an operation on one target
+
+    records holds a description per planned operation and skip, in order,
+    as written by dfman plan. error is the message of an error which stopped
+    the operation, None if it completed.
+    """
+    __slots__ = ('target', 'operation', 'records', 'applied', 'error')
+
+    def __init__(self, target, operation, records=(), applied=False, error=None):
+        self.target = target
+        self.operation = operation
+        self.records = list(records)
+        self.applied = applied
+        self.error = error
+
+    def __repr__(self):
+        return 'Result(%r, %r, %d records, error=%r)' % (
+            self.target, self.operation, len(self.records), self.error
+        )
+
+    @property
+    def ok(self):
+        """True if the operation completed"""
+        return self.error is None
+
+    def counts(self):
+        """Return the number of records per action"""
+        counts = {}
+        for record in self.records:
+            counts[record['action']] = counts.get(record['action'], 0) + 1
+        return counts
+
+    def to_dict(self):
+        """Return a JSON serializable form"""
+        return {
+            'target': self.target, 'operation': self.operation, 'records': self.records,
+            'applied': self.applied, 'error': self.error,
+        }
+
+
+class Dfman(object):
+    """Plan, install and uninstall dotfiles for any number of targets with a
+    config loaded once
+
+    A target is a home directory, into which ~ in configured paths expands,
+    except for dotfile_path, which is shared. None targets the current home.
+    dotfile_path is scanned once and the filemap of each target built once,
+    call reload() to pick up changes to either or to the config file.
+    """
+    def __init__(self, cfg_file=None, jobs=1, engine='threads'):
+        self.config = Config()
+        if cfg_file is not None:
+            self.config.cfg_file = cfg_file
+        self.jobs = jobs
+        self.engine = engine
+        self._runtimes = {}
+        self._filemaps = {}
+        self._source_tree = None
+        self._release = None
+        self.reload()
+
+    def reload(self):
+        """Read the config file and forget scanned sources and filemaps"""
+        self.config.load_cfg()
+        self._runtimes.clear()
+        self._filemaps.clear()
+        self._source_tree = None
+        self._release = osrelease.load()
+
+    def runtime(self, target=None, dry_run=False):
+        """Return the runtime for target, created once and reused"""
+        key = (target, dry_run)
+        runtime = self._runtimes.get(key)
+        if runtime is not None:
+            return runtime
+        runtime = core.MainRuntime(False, dry_run, jobs=self.jobs, engine=self.engine)
+        if target is not None:
+            runtime.config = self.config.rehome(
+                os.path.abspath(target), keep=[('Globals', 'dotfile_path')]
+            )
+        else:
+            runtime.config = self.config
+        runtime.release = self._release
+        if self._source_tree is None:
+            self._source_tree = runtime.scan_source_tree()
+        runtime.source_tree = self._source_tree
+        self._runtimes[key] = runtime
+        return runtime
+
+    def filemap(self, target=None):
+        """Return the filemap of target, mapping sources to destinations"""
+        if target not in self._filemaps:
+            # The runtime which built it knows which sources exist
+            self._filemaps[target] = self.runtime(target).get_filemap()
+        return self._filemaps[target]
+
+    def _runtime_with_filemap(self, target, dry_run):
+        filemap = self.filemap(target)
+        runtime = self.runtime(target, dry_run)
+        if runtime.filemap is not filemap:
+            runtime.filemap = filemap
+            runtime.scanned = self.runtime(target).scanned
+        return runtime, filemap
+
+    def _run(self, target, operation, func, applied):
+        try:
+            runtime, filemap = self._runtime_with_filemap(target, not applied)
+            if applied:
+                runtime.create_runtime_directories()
+            plan = func(runtime, filemap)
+        except (OSError, ValueError) as err:
+            return Result(target, operation, error=str(err))
+        return Result(
+            target, operation, [runtime.describe(op) for op in plan.records], applied=applied
+        )
+
+    def plan(self, target=None, uninstall=False):
+        """Return the result of planning an install, or uninstall, of target
+        without changing anything"""
+        if uninstall:
+            return self._run(
+                target, 'plan_uninstall',
+                lambda runtime, filemap: runtime.plan_uninstall(filemap=filemap), False
+            )
+        return self._run(
+            target, 'plan_install',
+            lambda runtime, filemap: runtime.plan_install(filemap=filemap), False
+        )
+
+    def install(self, target=None, dry_run=False):
+        """Install into target and return the result"""
+        return self._run(
+            target, 'install',
+            lambda runtime, filemap: runtime.install_dotfiles(filemap=filemap), not dry_run
+        )
+
+    def uninstall(self, target=None, dry_run=False):
+        """Uninstall from target and return the result"""
+        return self._run(
+            target, 'uninstall',
+            lambda runtime, filemap: runtime.uninstall_dotfiles(filemap=filemap), not dry_run
+        )
@@ -0,0 +1,223 @@
+"""Content-addressed backup store"""
+
+
+import json
+import os
+import stat
+from dfman import fastcopy
+
+
+CHUNK_SIZE = 1 << 20
+TREE_SUFFIX = '.tree'
+# Separates a file blob from the mode of the destination it backs up
+MODE_SEP = '#'
+# Holds the index and blobs, apart from backups moved to backup_path/<name>
+STORE_DIR = '.dfman'
+
+
+def hash_file(path):
+    """Return the sha256 hex digest of a file's content"""
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def clone_file(src, dest):
+    """Copy src to dest with its mode, as a reflink where supported"""
+    st = os.stat(src)
+    with open(src, 'rb') as src_f, open(dest, 'wb') as dest_f:
+        fastcopy.copy_data(src_f.fileno(), dest_f.fileno(), st.st_size)
+    os.chmod(dest, stat.S_IMODE(st.st_mode))
+
+
+def _publish(path, create):
+    """Create path atomically with create(tmp) unless it already exists"""
+    if os.path.lexists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    create(tmp)
+    os.replace(tmp, path)
+
+
+def store_blob(src, blob):
+    """Store a copy of the content of src as blob, as a reflink where
+    supported. A hard link would share its inode, and so its mode, with a
+    live file."""
+    _publish(blob, lambda tmp: clone_file(src, tmp))
+
+
+def file_ref(blob, mode):
+    """Return the reference of a file backed up as blob with mode"""
+    return '%s%s%o' % (blob, MODE_SEP, mode)
+
+
+def split_ref(ref):
+    """Return the blob and mode of a file reference, the mode is None if
+    the reference doesn't record one"""
+    blob, sep, mode = ref.rpartition(MODE_SEP)
+    if not sep or os.sep in mode:
+        return ref, None
+    return blob, int(mode, 8)
+
+
+def write_blob(content, blob):
+    """Store a text blob"""
+    def create(tmp):
+        with open(tmp, 'w') as f:
+            f.write(content)
+    _publish(blob, create)
+
+
+def discard(path):
+    """Remove a file, symlink or directory tree after it has been stored"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        import shutil
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+
+def restore(ref, path):
+    """Recreate path from a file blob or tree blob"""
+    if not ref.endswith(TREE_SUFFIX):
+        blob, mode = split_ref(ref)
+        clone_file(blob, path)
+        if mode is not None:
+            os.chmod(path, mode)
+        return
+    objects = os.path.dirname(os.path.dirname(ref))
+    with open(ref) as f:
+        tree = json.load(f)
+    os.makedirs(path)
+    for rel in tree['dirs']:
+        os.makedirs(os.path.join(path, rel), exist_ok=True)
+    for rel, target in tree['links'].items():
+        os.symlink(target, os.path.join(path, rel))
+    for rel, (digest, mode) in tree['files'].items():
+        dest = os.path.join(path, rel)
+        clone_file(os.path.join(objects, digest[:2], digest), dest)
+        os.chmod(dest, mode)
+    os.chmod(path, tree['mode'])
+
+
+class BackupStore(object):
+    """Backups under backup_path and their index
+
+    The index and blobs live in STORE_DIR, so they can't collide with
+    destinations moved to backup_path by basename. index.json maps each
+    backed up destination to its backup, either a path the destination was
+    moved to or, with dedup, a blob. Deduplicated file contents are stored
+    once under objects/ by sha256 digest, and a file's reference records its
+    own mode after MODE_SEP. A backed up directory is stored as a tree blob
+    listing its files with their modes, symlinks and subdirectories.
+    """
+    def __init__(self, root, dedup=False, jobs=None):
+        self.root = root
+        self.dedup = dedup
+        self.objects = os.path.join(root, STORE_DIR, 'objects')
+        self.index_file = os.path.join(root, STORE_DIR, 'index.json')
+        self.jobs = jobs or os.cpu_count() or 1
+        self.index = {}
+        self._dirty = False
+
+    def load(self):
+        """Load the index"""
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+        self._dirty = False
+
+    def save(self):
+        """Atomically write the index if it changed"""
+        if not self._dirty:
+            return
+        tmp = self.index_file + '.tmp'
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.index_file)
+        self._dirty = False
+
+    def is_blob(self, ref):
+        """Return True if ref is a blob rather than a moved backup"""
+        return ref.startswith(os.path.join(self.objects, ''))
+
+    def blob_path(self, digest, tree=False):
+        """Return the path of the blob with digest"""
+        return os.path.join(
+            self.objects, digest[:2], digest + (TREE_SUFFIX if tree else '')
+        )
+
+    def hash_files(self, paths):
+        """Return digests of paths, hashed in parallel"""
+        if self.jobs <= 1 or len(paths) <= 1:
+            return [hash_file(path) for path in paths]
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            return list(pool.map(hash_file, paths))
+
+    def plan_backup(self, path, fileop):
+        """Add the operations backing up path to fileop and return its blob
+        reference, or None if path isn't a regular file or directory"""
+        result = os.lstat(path)
+        if stat.S_ISREG(result.st_mode):
+            blob = self.blob_path(hash_file(path))
+            fileop.store(path, blob)
+            ref = file_ref(blob, stat.S_IMODE(result.st_mode))
+        elif stat.S_ISDIR(result.st_mode):
+            tree, files = self._walk(path)
+            for (rel, mode), digest in zip(files, self.hash_files(
+                    [os.path.join(path, rel) for rel, _ in files])):
+                tree['files'][rel] = [digest, mode]
+                fileop.store(os.path.join(path, rel), self.blob_path(digest))
+            import hashlib
+            content = json.dumps(tree, sort_keys=True)
+            ref = self.blob_path(hashlib.sha256(content.encode()).hexdigest(), tree=True)
+            fileop.write(content, ref)
+        else:
+            return None
+        fileop.discard(ref, path)
+        return ref
+
+    @staticmethod
+    def _walk(path):
+        tree = {
+            'mode': stat.S_IMODE(os.stat(path).st_mode),
+            'dirs': [], 'links': {}, 'files': {},
+        }
+        files = []
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            with os.scandir(os.path.join(path, rel_dir)) as entries:
+                for entry in entries:
+                    rel = os.path.join(rel_dir, entry.name)
+                    if entry.is_symlink():
+                        tree['links'][rel] = os.readlink(entry.path)
+                    elif entry.is_dir():
+                        tree['dirs'].append(rel)
+                        stack.append(rel)
+                    elif entry.is_file():
+                        files.append((rel, stat.S_IMODE(entry.stat().st_mode)))
+        tree['dirs'].sort()
+        return tree, files
+
+    def update_index(self, plan):
+        """Record applied backups and drop restored ones"""
+        prefix = os.path.join(self.root, '')
+        for op in plan:
+            if op.kind == 'discard':
+                self.index[op.dest] = op.src
+            elif op.kind == 'move' and op.dest.startswith(prefix):
+                self.index[op.src] = op.dest
+            elif op.kind in ('restore', 'move') and op.dest in self.index:
+                del self.index[op.dest]
+            else:
+                continue
+            self._dirty = True
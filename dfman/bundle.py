@@ -0,0 +1,179 @@
+"""Single file archives of resolved dotfiles for fast deploys"""
+
+
+import json
+import os
+import stat
+import struct
+
+
+MAGIC = b'DFMBNDL1'
+VERSION = 1
+# Offset of the index and MAGIC, at the very end of a bundle
+TRAILER = struct.Struct('<Q8s')
+CHUNK_SIZE = 1 << 20
+
+
+def collapse_home(path, home):
+    """Return path with a leading home replaced by ~"""
+    if path == home or path.startswith(os.path.join(home, '')):
+        return '~' + path[len(home):]
+    return path
+
+
+def _add(out, records, entry, src, dest):
+    st = os.lstat(src)
+    mode = stat.S_IMODE(st.st_mode)
+    if stat.S_ISLNK(st.st_mode):
+        records.append([entry, 'l', dest, mode, 0, os.readlink(src)])
+    elif stat.S_ISDIR(st.st_mode):
+        records.append([entry, 'd', dest, mode, 0, 0])
+        with os.scandir(src) as entries:
+            names = sorted(i.name for i in entries)
+        for name in names:
+            _add(out, records, entry, os.path.join(src, name), os.path.join(dest, name))
+    else:
+        import shutil
+        offset = out.tell()
+        with open(src, 'rb') as f:
+            shutil.copyfileobj(f, out)
+        records.append([entry, 'f', dest, mode, offset, out.tell() - offset])
+
+
+def write(path, filemap, rendered=None, home=None):
+    """Write the sources of filemap, with the content of rendered templates
+    taken from rendered, into a bundle at path and return the sources which
+    don't exist
+
+    File contents come first, in the order they are extracted, followed by a
+    JSON index of entries (destinations) and records (directories, files and
+    symlinks below them) and the trailer. Destinations below home are stored
+    relative to ~ so a bundle can be installed into another home.
+    """
+    rendered = rendered or {}
+    home = home or os.path.expanduser('~')
+    entries, records, missing = [], [], []
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as out:
+        for src, dest in filemap.items():
+            dest = collapse_home(dest, home)
+            if src in rendered:
+                offset = out.tell()
+                out.write(rendered[src].encode())
+                mode = stat.S_IMODE(os.stat(src).st_mode)
+                records.append([len(entries), 'f', dest, mode, offset, out.tell() - offset])
+            elif os.path.lexists(src):
+                _add(out, records, len(entries), src, dest)
+            else:
+                missing.append(src)
+                continue
+            entries.append(dest)
+        index = json.dumps({'version': VERSION, 'entries': entries, 'records': records})
+        offset = out.tell()
+        out.write(index.encode())
+        out.write(TRAILER.pack(offset, MAGIC))
+    os.replace(tmp, path)
+    return missing
+
+
+class Bundle(object):
+    """A bundle mapped into memory for reading, raises ValueError if path
+    isn't one"""
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(self._map) < TRAILER.size:
+                raise ValueError('%s: Not a bundle' % path)
+            offset, magic = TRAILER.unpack_from(self._map, len(self._map) - TRAILER.size)
+            if magic != MAGIC:
+                raise ValueError('%s: Not a bundle' % path)
+            index = json.loads(self._map[offset:len(self._map) - TRAILER.size].decode())
+            if index.get('version') != VERSION:
+                raise ValueError('%s: Unsupported bundle version' % path)
+        except ValueError:
+            self.close()
+            raise
+        self.entries = [os.path.expanduser(dest) for dest in index['entries']]
+        self.records = index['records']
+        self._index = {dest: entry for entry, dest in enumerate(self.entries)}
+        self._by_entry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Unmap the bundle"""
+        self._map.close()
+
+    def extract(self, skip=()):
+        """Create every destination not in skip in a single sequential pass
+        over the bundle, return the number of destinations created"""
+        import mmap
+        if hasattr(self._map, 'madvise'):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+        skip = {self._index[dest] for dest in skip}
+        modes = []
+        view = memoryview(self._map)
+        try:
+            for entry, kind, dest, mode, offset, value in self.records:
+                if entry in skip:
+                    continue
+                dest = os.path.expanduser(dest)
+                if kind == 'd':
+                    os.makedirs(dest, exist_ok=True)
+                    # Set last, a read-only directory can't be filled
+                    modes.append((dest, mode))
+                elif kind == 'l':
+                    os.symlink(value, dest)
+                else:
+                    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+                    with open(fd, 'wb') as f:
+                        f.write(view[offset:offset + value])
+                    os.chmod(dest, mode)
+        finally:
+            view.release()
+        for dest, mode in reversed(modes):
+            os.chmod(dest, mode)
+        return len(self.entries) - len(skip)
+
+    def entry_records(self, dest):
+        """Return the records of the destination dest with their paths
+        expanded, a directory before what is in it"""
+        if self._by_entry is None:
+            self._by_entry = {}
+            for record in self.records:
+                self._by_entry.setdefault(record[0], []).append(record)
+        return [
+            [entry, kind, os.path.expanduser(path), mode, offset, value]
+            for entry, kind, path, mode, offset, value
+            in self._by_entry.get(self._index.get(dest), ())
+        ]
+
+    def is_extracted(self, record):
+        """Return True if the path of an entry_records record still holds
+        what extract created from it"""
+        _, kind, path, _, offset, value = record
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        if kind == 'd':
+            return stat.S_ISDIR(st.st_mode)
+        if kind == 'l':
+            return stat.S_ISLNK(st.st_mode) and os.readlink(path) == value
+        if not stat.S_ISREG(st.st_mode) or st.st_size != value:
+            return False
+        with open(path, 'rb') as f:
+            while value:
+                chunk = f.read(min(value, CHUNK_SIZE))
+                if not chunk or chunk != self._map[offset:offset + len(chunk)]:
+                    return False
+                offset += len(chunk)
+                value -= len(chunk)
+        return True
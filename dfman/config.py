@@ -1,11 +1,26 @@
 """Configuration module"""
 
 
-import configparser
+import json
 import os
 from dfman import const
 
 
+# Same values as configparser.ConfigParser.BOOLEAN_STATES, which isn't
+# imported unless the config file actually has to be parsed
+BOOLEAN_STATES = {
+    '1': True, 'yes': True, 'true': True, 'on': True,
+    '0': False, 'no': False, 'false': False, 'off': False,
+}
+
+
+def expand_home(value, home):
+    """Expand a leading ~ in value to home"""
+    if value == '~' or value.startswith('~' + os.sep):
+        return home + value[1:]
+    return os.path.expanduser(value)
+
+
 class Config(object):
     """Create, load, and return configuration"""
     def __init__(self):
@@ -18,13 +33,44 @@ class Config(object):
         defaults = {
             'verbose': 'false',
             'backup_path': '~/.dfman/backups',
+            'backup_store': 'false',
+            'digest_cache': '~/.dfman/digests.json',
             'dotfile_path': '~/.dotfiles/files',
             'config_path': '~/.config',
+            'install_mode': 'link',
+            'link_mode': 'entry',
             'log': '~/.dfman/dfman.log',
+            'log_format': 'text',
+            'manifest': '~/.dfman/manifest.json',
+            'render_path': '~/.dfman/rendered',
+            'journal': '~/.dfman/journal',
             'loglevel': 'DEBUG',
         }
-        self._config = configparser.ConfigParser(defaults)
-        self._config.optionxform=str
+        self._defaults = defaults
+        self._config = None
+        self._compiled = {}
+        self._merged = {}
+
+    def __getstate__(self):
+        # Copies sent to other processes only need the compiled snapshot
+        state = dict(self.__dict__)
+        state['_config'] = None
+        return state
+
+    def rehome(self, home, keep=()):
+        """Return a copy with ~ in paths expanded to home instead of $HOME,
+        except for the (section, option) pairs in keep"""
+        # pylint: disable=protected-access
+        config = Config()
+        config.cfg_file = self.cfg_file
+        config._defaults = self._defaults
+        for name, section in self._compiled.items():
+            paths = {
+                key: section['paths'][key] if (name, key) in keep else expand_home(value, home)
+                for key, value in section['values'].items()
+            }
+            config._compiled[name] = dict(section, paths=paths)
+        return config
 
     def setup_config(self, init_cfg=None):
         """Initialize configuration files and directories"""
@@ -44,38 +90,176 @@ class Config(object):
                 f.write(cfg_f.read())
 
     def load_cfg(self):
-        """Load the configuration file"""
-        self._config.read(self.cfg_file)
+        """Load the configuration file, from the compiled cache if it is current"""
+        key = self.cache_key()
+        compiled = self.read_cache(key)
+        if compiled is None:
+            self.parser().read(self.cfg_file)
+            compiled = self.compile()
+            self.write_cache(key, compiled)
+        self._compiled = compiled
+        self._merged = {}
+
+    def cache_file(self):
+        """Return the path of the compiled config cache for cfg_file"""
+        path, basename = os.path.split(self.cfg_file)
+        return os.path.join(path, '.%s%s' % (basename, const.CACHE_SUFFIX))
+
+    def cache_key(self):
+        """Return the values a compiled config depends on, or None if the
+        config file can't be read"""
+        try:
+            stat = os.stat(self.cfg_file)
+        except OSError:
+            return None
+        return {
+            'version': const.CACHE_VERSION,
+            'cfg_file': self.cfg_file,
+            'stamp': [stat.st_mtime_ns, stat.st_size],
+            'home': os.path.expanduser('~'),
+            'defaults': self._defaults,
+        }
+
+    def read_cache(self, key):
+        """Return the cached compiled config if it matches key"""
+        if key is None:
+            return None
+        try:
+            with open(self.cache_file()) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cache, dict) or cache.get('key') != key:
+            return None
+        return cache.get('compiled')
+
+    def write_cache(self, key, compiled):
+        """Persist the compiled config, ignoring unwritable locations"""
+        if key is None:
+            return
+        cache_file = self.cache_file()
+        tmp = cache_file + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'key': key, 'compiled': compiled}, f)
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass
+
+    def parser(self):
+        """Return the underlying ConfigParser, creating it on first use"""
+        if self._config is None:
+            import configparser
+            # Not passed as DEFAULT, which every section would inherit
+            self._config = configparser.ConfigParser()
+            self._config.optionxform = str
+        return self._config
 
-    @property
-    def get(self):
+    def compile(self):
+        """Return a snapshot of all sections with paths expanded
+
+        The defaults only fill in Globals, so an override named like a
+        global option is kept. own lists the keys set in the section itself
+        rather than taken from the defaults or a DEFAULT section.
+        """
+        parser = self.parser()
+        inherited = parser.defaults()
+        sections = {}
+        for section in parser.sections():
+            defaults = self._section_defaults(section)
+            values = dict(defaults)
+            values.update(parser.items(section))
+            sections[section] = {
+                'values': values,
+                'paths': {key: os.path.expanduser(value) for key, value in values.items()},
+                'own': [key for key in values if key not in inherited and key not in defaults],
+            }
+        return sections
+
+    def _section_defaults(self, section):
+        return self._defaults if section == 'Globals' else {}
+
+    def _section(self, section):
+        try:
+            return self._compiled[section]
+        except KeyError:
+            import configparser
+            raise configparser.NoSectionError(section)
+
+    def _lookup(self, section, option, kind='values'):
+        try:
+            return self._section(section)[kind][option]
+        except KeyError:
+            import configparser
+            raise configparser.NoOptionError(option, section)
+
+    def update_section(self, section, values):
+        """Set values in section, creating it if needed, without re-reading
+        the config file, and store the result as the current cache"""
+        compiled = self._compiled.setdefault(
+            section, {'values': dict(self._section_defaults(section)), 'paths': {}, 'own': []}
+        )
+        if not compiled['paths']:
+            compiled['paths'] = {
+                key: os.path.expanduser(value) for key, value in compiled['values'].items()
+            }
+        for key, value in values.items():
+            compiled['values'][key] = value
+            compiled['paths'][key] = os.path.expanduser(value)
+            if key not in compiled['own']:
+                compiled['own'].append(key)
+        self._merged = {}
+        self.write_cache(self.cache_key(), self._compiled)
+
+    def has_section(self, section):
+        """Return True if section exists"""
+        return section in self._compiled
+
+    def get(self, section, option):
         """Return the configuration string"""
-        return self._config.get
+        return self._lookup(section, option)
 
-    def getpath(self, *args):
+    def getpath(self, section, option):
         """Return the configuration path with expansion"""
-        return os.path.expanduser(self._config.get(*args))
+        return self._lookup(section, option, kind='paths')
 
-    @property
-    def getboolean(self):
+    def getboolean(self, section, option):
         """Return the configuration boolean"""
-        return self._config.getboolean
+        value = self.get(section, option)
+        try:
+            return BOOLEAN_STATES[value.lower()]
+        except KeyError:
+            raise ValueError('Not a boolean: %s' % value)
 
-    @property
-    def getint(self):
+    def getint(self, section, option):
         """Return the configuration int"""
-        return self._config.getint
+        return int(self.get(section, option))
 
     def items(self, section):
         """Return all items in a configuration section, excluding defaults"""
-        return [
-            i for i in self._config.items(section)
-            if i[0] not in self._config.defaults()
-        ]
+        compiled = self._section(section)
+        return [(key, compiled['values'][key]) for key in compiled['own']]
 
     def pathitems(self, section):
         """Return all items with path expansion"""
-        return {
-            key: os.path.expanduser(value)
-            for key, value in dict(self.items(section)).items()
-        }
+        compiled = self._section(section)
+        return {key: compiled['paths'][key] for key in compiled['own']}
+
+    def merged_pathitems(self, sections):
+        """Return the items of those sections which exist with path
+        expansion, merged in one pass with later sections taking precedence
+
+        The result is kept until the config is loaded or updated again.
+        """
+        key = tuple(sections)
+        merged = self._merged.get(key)
+        if merged is None:
+            merged = {}
+            for section in key:
+                compiled = self._compiled.get(section)
+                if compiled is not None:
+                    paths = compiled['paths']
+                    for option in compiled['own']:
+                        merged[option] = paths[option]
+            self._merged[key] = merged
+        return merged
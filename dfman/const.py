@@ -6,6 +6,8 @@ import os
 
 NAME = 'dfman'
 CFG = NAME + '.conf'
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 2
 DEFAULT_PATH = 'resources'
 USER_PATH = os.path.join(os.environ.get('HOME'), '.config', NAME)
 
@@ -1,58 +1,117 @@
 """Core module for dfman"""
 
 
-import argparse
+import json
 import logging
 import os
-import shutil
-from configparser import NoSectionError
-from datetime import datetime
-from dfman import Config, const
+import stat
+import sys
+import threading
+from contextlib import contextmanager
+from dfman import Config, const, logs
+from dfman.manifest import Manifest
+from dfman.profiling import NullProfiler, Profiler
 
 
 LOG = logging.getLogger(__name__)
 
+_UNSET = object()
+
+# Ways of running entries concurrently, see run_entries
+ENGINES = ('threads', 'async')
+
 
 class MainRuntime(object):
     """Main runtime class"""
-    def __init__(self, verbose, dry_run):
+    def __init__(self, verbose, dry_run, jobs=1, engine='threads'):
         self.verbose = verbose
         self.dry_run = dry_run
+        self.jobs = jobs
+        self.engine = engine
+        self.profiler = NullProfiler()
         self.config = Config()
-        self.distro = self.get_distro()
+        self._release = _UNSET
+        self.hostname = os.uname().nodename
+        self._overrides = None
         self.fileop = FileOperator(self.dry_run)
+        self.manifest = Manifest()
+        self.backups = None
+        self.renders = None
+        self.scanned = {}
+        self.source_tree = None
+        self.link_mode = 'entry'
+        self.install_mode = 'link'
+        self.filemap = None
+        self._lstat_cache = None
+        self.resolver = None
+        self._claimed_backups = set()
+        self._claim_lock = threading.Lock()
+        self._bundles = {}
+
+    @property
+    def release(self):
+        """OsRelease of the distro, only read from os-release when first needed"""
+        if self._release is _UNSET:
+            from dfman import osrelease
+            self._release = osrelease.load()
+        return self._release
+
+    @release.setter
+    def release(self, value):
+        self._release = value
+
+    @property
+    def distro(self):
+        """Distro ID"""
+        return self.release.id if self.release is not None else None
+
+    @distro.setter
+    def distro(self, value):
+        from dfman import osrelease
+        self._release = osrelease.OsRelease(value) if value else None
+
+    def enable_profiling(self):
+        """Time phases and file operations from now on, return the profiler"""
+        self.profiler = self.fileop.profiler = Profiler()
+        return self.profiler
 
     def run_initial_setup(self, init_cfg=None):
         """Runtime control method"""
-        self.config.setup_config(init_cfg=init_cfg)
+        with self.profiler.span('load_config'):
+            self.config.setup_config(init_cfg=init_cfg)
         # Set verbose if verbose specified in config or args
         self.verbose = any([
             self.config.getboolean('Globals', 'verbose'),
             self.verbose,
             self.dry_run
         ])
-        self.create_runtime_directories()
-        self.set_output_streams()
+        with self.profiler.span('setup'):
+            self.create_runtime_directories()
+            self.set_output_streams()
 
     def create_runtime_directories(self):
         """Create directory tree for backups and logs"""
         for path in (
                 os.path.dirname(self.config.getpath('Globals', 'log')),
+                os.path.dirname(self.config.getpath('Globals', 'manifest')),
+                os.path.dirname(self.config.getpath('Globals', 'journal')),
                 self.config.getpath('Globals', 'backup_path')
         ):
             if not os.path.isdir(path):
                 os.makedirs(path)
 
     def set_output_streams(self):
-        """Set the output streams with logging"""
-        if len(LOG.handlers) >= 2: # console and logfile
+        """Set the output streams with logging, written by a background thread"""
+        if logs.PIPELINE is not None:
             return
         LOG.setLevel(logging.DEBUG) # This only sets the minimum logging level
-        log_format = logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s')
-        file_out = logging.FileHandler(self.config.getpath('Globals', 'log'))
+        if self.config.get('Globals', 'log_format') == 'json':
+            log_format = logs.JsonFormatter()
+        else:
+            log_format = logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s')
+        file_out = logs.BufferedFileHandler(self.config.getpath('Globals', 'log'))
         file_out.setFormatter(log_format)
         file_out.setLevel(self.config.get('Globals', 'loglevel'))
-        LOG.addHandler(file_out)
 
         console_out = logging.StreamHandler()
         console_out.setFormatter(logging.Formatter('%(message)s'))
@@ -60,54 +119,1045 @@ class MainRuntime(object):
             console_out.setLevel(logging.DEBUG)
         else:
             console_out.setLevel(logging.INFO)
-        LOG.addHandler(console_out)
+        logs.start(LOG, [file_out, console_out])
 
-    def install_dotfiles(self):
+    def install_dotfiles(self, filemap=None):
+        """Install dotfiles based on defaults and overrides, return the plan"""
+        with self.profiler.span('plan_install'):
+            plan = self.plan_install(filemap=filemap)
+        self.apply_install(plan)
+        return plan
+
+    def apply_install(self, plan):
+        """Apply an install plan and record its results"""
+        if self.dry_run:
+            return
+        self.apply(plan)
+        with self.profiler.span('save_state'):
+            for op in plan:
+                if op.kind == 'symlink':
+                    # Record the inode of the link which now exists
+                    self.manifest.record(op.src, op.dest, 'linked')
+            self.manifest.save()
+            self.save_backups(plan)
+            if self.renders is not None:
+                self.renders.save()
+
+    def install_changes(self, names):
+        """Link new and unlink removed sources among names, which are entries
+        of dotfile_path, and return the plan
+
+        Only the filemap of the last install or get_filemap is updated, the
+        rest of dotfile_path isn't scanned or checked again.
+        """
+        from dfman import template
+        if self.filemap is None:
+            self.get_filemap()
+        self.check_journal()
+        dotfile_path = self.config.getpath('Globals', 'dotfile_path')
+        config_path = self.config.getpath('Globals', 'config_path')
+        added, removed = [], []
+        for name in sorted(names):
+            src = os.path.join(dotfile_path, name)
+            if os.path.lexists(src):
+                if os.path.exists(src):
+                    self.scanned[src] = os.path.isdir(src)
+                else:
+                    self.scanned.pop(src, None)
+                dest = os.path.join(config_path, template.strip_suffix(name))
+                if src in self.filemap or self.filemap.add(src, dest):
+                    added.append((src, self.filemap[src]))
+            else:
+                self.scanned.pop(src, None)
+                if src in self.filemap:
+                    removed.append((src, self.filemap[src]))
+                    if not self.filemap.is_override(src):
+                        self.filemap.remove(src)
+        plan = self.run_entries(self.install_entry, added)
+        self.run_entries(self.unlink_entry, removed, plan=plan)
+        self.manifest.set_filemap(self.get_stamps(), dict(self.filemap.items()))
+        self.apply_install(plan)
+        return plan
+
+    def create_bundle(self, path):
+        """Write the resolved filemap and the content of its sources to a
+        bundle at path"""
+        from dfman import bundle, template
+        with self.profiler.span('scan'):
+            filemap = self.get_filemap()
+        filemap, rendered = dict(filemap.items()), {}
+        templates = [src for src in filemap if template.is_template(src) and os.path.exists(src)]
+        variables = self.template_variables() if templates else None
+        for src in templates:
+            try:
+                with open(src) as f:
+                    rendered[src] = template.render(f.read(), variables)
+            except (KeyError, ValueError) as err:
+                LOG.error(
+                    'Skipped: %s does not render: %s', src, err,
+                    extra=logs.fields('skip', src, filemap.pop(src), 'render failed')
+                )
+        with self.profiler.span('bundle'):
+            missing = bundle.write(path, filemap, rendered=rendered)
+        for src in missing:
+            LOG.warning(
+                'Skipped: %s does not exist', src,
+                extra=logs.fields('skip', src, filemap[src], 'missing')
+            )
+        LOG.info('Bundled %d entries into %s', len(filemap) - len(missing), path)
+
+    def install_bundle(self, path):
+        """Create the destinations of a bundle from its content instead of
+        linking them, backing up what is in the way, and return the plan
+        of backups
+
+        Created destinations are recorded as bundled, so uninstall can
+        remove them.
+        """
+        from dfman import bundle
+        self.check_journal()
+        self._claimed_backups.clear()
+        path = os.path.abspath(path)
+        with self.profiler.span('load_state'):
+            self.manifest.load(self.config.getpath('Globals', 'manifest'))
+            self.load_backups()
+        with bundle.Bundle(path) as archive:
+            plan = self.run_entries(
+                self.backup_entry, [(path, dest) for dest in archive.entries]
+            )
+            if self.dry_run:
+                return plan
+            self.apply(plan)
+            with self.profiler.span('save_state'):
+                self.save_backups(plan)
+            skip = {op.dest for op in plan.records if op.kind == 'skip'}
+            with self.profiler.span('extract'):
+                count = archive.extract(skip=skip)
+            with self.profiler.span('save_state'):
+                for dest in archive.entries:
+                    if dest not in skip:
+                        self.manifest.record(path, dest, 'bundled')
+                self.manifest.save()
+        LOG.info('Installed %d entries from %s', count, path)
+        return plan
+
+    def backup_entry(self, src, dest, log=LOG, plan=None):
+        """Back up dest before it is created from src"""
+        fileop = self.fileop if plan is None else plan
+        if not self.backup_file(dest, log=log, plan=plan):
+            fileop.skip(src, dest, 'backup exists')
+
+    def unlink_entry(self, src, dest, log=LOG, plan=None):
+        """Remove the link to a source which no longer exists"""
+        fileop = self.fileop if plan is None else plan
+        if self.does_symlink_already_exist(src, dest):
+            fileop.unlink(dest)
+            self.manifest.discard(dest)
+            log.debug('Unlinked: %s', dest, extra=logs.fields('unlink', src, dest))
+        else:
+            fileop.skip(src, dest, 'not linked')
+
+    def plan_install(self, plan=None, filemap=None):
         # pylint: disable=no-value-for-parameter
-        """Install dotfiles based on defaults and overrides"""
+        """Return the plan for installing dotfiles, extending plan if given
+
+        filemap, a result of get_filemap on this runtime, is used instead of
+        scanning dotfile_path if given.
+        """
         if not os.path.isdir(self.config.getpath('Globals', 'dotfile_path')):
             raise FileNotFoundError(
                 '%s: No such directory' % self.config.getpath('Globals', 'dotfile_path')
             )
 
-        for src, dest in self.get_filemap().items():
-            if not os.path.exists(src):
-                LOG.warning('Skipped: %s does not exist', src)
-                continue
-            if not self.does_symlink_already_exist(src, dest):
-                if not self.backup_file(dest):
-                    # No backup made, skip this file
-                    continue
-                self.fileop.symlink(src, dest)
-                LOG.debug('Linked: %s to %s', src, dest)
+        self.check_journal()
+        self._claimed_backups.clear()
+        if filemap is None:
+            self.scanned = {}
+        with self.profiler.span('load_state'):
+            self.manifest.load(self.config.getpath('Globals', 'manifest'))
+            self.load_backups()
+            # Loaded when the first template is found
+            self.renders = None
+            stamps = self.get_stamps()
+        if filemap is not None:
+            plan = self.run_entries(self.install_entry, filemap.items(), plan=plan)
+            if not self.manifest.is_current(stamps):
+                self.manifest.set_filemap(stamps, dict(filemap.items()))
+            return plan
+        if self.manifest.is_current(stamps):
+            return self.run_entries(
+                self.install_entry, self.manifest.filemap().items(), plan=plan
+            )
+        filemap = {}
+
+        def collect():
+            for src, dest in self.iter_filemap():
+                filemap[src] = dest
+                yield src, dest
+
+        plan = self.run_entries(self.install_entry, collect(), plan=plan)
+        self.manifest.set_filemap(stamps, filemap)
+        return plan
+
+    def install_entry(self, src, dest, log=LOG, plan=None):
+        """Install a single dotfile, adding its operations to plan if given"""
+        from dfman import template
+        fileop = self.fileop if plan is None else plan
+        if template.is_template(src) and self.source_exists(src):
+            src = self.render_template(src, dest, log, fileop)
+            if src is None:
+                return
+        copy = self.install_mode == 'copy'
+        tree = self.link_mode in ('tree', 'fold') and self.is_source_dir(src)
+        # A directory linked as a whole has to be unfolded in tree mode
+        if not copy and (not tree or self.link_mode == 'fold') \
+                and self.manifest.is_linked(src, dest, lstat=self.lstat):
+            log.debug(
+                'Skipped: %s already linked', dest, extra=logs.fields('skip', src, dest, 'linked')
+            )
+            fileop.skip(src, dest, 'linked')
+            return
+        if not self.source_exists(src):
+            log.warning(
+                'Skipped: %s does not exist', src, extra=logs.fields('skip', src, dest, 'missing')
+            )
+            fileop.skip(src, dest, 'missing')
+            self.manifest.record(src, dest, 'missing', lstat=self.lstat)
+            return
+        if copy:
+            with self.profiler.span('copy_tree', 'check'):
+                copied = self.copy_entry(src, dest, log, fileop)
+            self.manifest.record(src, dest, 'copied' if copied else 'skipped', lstat=self.lstat)
+            return
+        if tree:
+            with self.profiler.span('link_tree', 'check'):
+                folded = self.link_tree(src, dest, log, fileop)
+            if folded is None:
+                self.manifest.record(src, dest, 'skipped', lstat=self.lstat)
+            else:
+                self.manifest.record(src, dest, 'linked' if folded else 'tree', lstat=self.lstat)
+            return
+        with self.profiler.span('check_link', 'check'):
+            linked = self.does_symlink_already_exist(src, dest)
+        if not linked:
+            with self.profiler.span('backup', 'check'):
+                backed_up = self.backup_file(dest, log=log, plan=plan)
+            if not backed_up:
+                # No backup made, skip this file
+                fileop.skip(src, dest, 'backup exists')
+                self.manifest.record(src, dest, 'skipped', lstat=self.lstat)
+                return
+            fileop.symlink(src, dest)
+            log.debug('Linked: %s to %s', src, dest, extra=logs.fields('link', src, dest))
+        else:
+            log.debug(
+                'Skipped: %s already linked', dest, extra=logs.fields('skip', src, dest, 'linked')
+            )
+            fileop.skip(src, dest, 'linked')
+        self.manifest.record(src, dest, 'linked', lstat=self.lstat)
+
+    def copy_entry(self, src, dest, log, fileop):
+        """Copy src to dest, return False if it was skipped
+
+        What is at dest is backed up first, unless it is a link to src or
+        copied from src by an earlier install, which is updated in place.
+        """
+        entry = self.manifest.entry(dest)
+        ours = entry is not None and entry['state'] == 'copied' and entry['src'] == src
+        dest_st = self.lstat(dest)
+        if dest_st is not None and stat.S_ISLNK(dest_st.st_mode) and self.links_to(dest, src):
+            fileop.unlink(dest)
+            dest_st = None
+        elif dest_st is not None and not ours:
+            if not self.backup_file(dest, log=log, plan=fileop):
+                fileop.skip(src, dest, 'backup exists')
+                return False
+            dest_st = None
+        if self.renders is not None and src in self.renders.planned:
+            # Only rendered when the plan is applied, there is nothing to
+            # compare or walk yet
+            if dest_st is not None and not stat.S_ISREG(dest_st.st_mode):
+                if not self.backup_file(dest, log=log, plan=fileop):
+                    fileop.skip(src, dest, 'backup exists')
+                    return False
+            fileop.copy(src, dest)
+            log.debug('Copied: %s to %s', src, dest, extra=logs.fields('copy', src, dest))
+            return True
+        self.copy_tree(src, dest, log, fileop, os.lstat(src), dest_st)
+        return True
+
+    def copy_tree(self, src, dest, log, fileop, src_st, dest_st):
+        """Copy src to dest in place, skipping files whose size and mtime
+        are unchanged
+
+        Directories are listed with os.scandir and nothing below a directory
+        which is created is checked. Files only found in dest are kept, what
+        has the wrong type is backed up. src_st and dest_st are the lstat
+        results of src and dest, None for a dest which doesn't exist.
+        """
+        from dfman import fastcopy
+        if dest_st is not None and stat.S_IFMT(dest_st.st_mode) != stat.S_IFMT(src_st.st_mode):
+            if not self.backup_file(dest, log=log, plan=fileop):
+                fileop.skip(src, dest, 'backup exists')
+                return
+            dest_st = None
+        if stat.S_ISDIR(src_st.st_mode):
+            if dest_st is None:
+                fileop.mkdir(dest)
+                existing = ()
             else:
-                LOG.debug('Skipped: %s already linked', dest)
+                with os.scandir(dest) as entries:
+                    existing = {entry.name for entry in entries}
+            with os.scandir(src) as entries:
+                children = [(entry.name, entry.stat(follow_symlinks=False)) for entry in entries]
+            for name, child_st in children:
+                child_dest = os.path.join(dest, name)
+                self.copy_tree(
+                    os.path.join(src, name), child_dest, log, fileop, child_st,
+                    self.lstat(child_dest) if name in existing else None
+                )
+        elif stat.S_ISLNK(src_st.st_mode):
+            target = os.readlink(src)
+            if dest_st is not None:
+                if os.readlink(dest) == target:
+                    fileop.skip(src, dest, 'unchanged')
+                    return
+                fileop.unlink(dest)
+            fileop.symlink(target, dest)
+        elif fastcopy.is_copy(src_st, dest_st):
+            fileop.skip(src, dest, 'unchanged')
+        else:
+            fileop.copy(src, dest)
+            log.debug('Copied: %s to %s', src, dest, extra=logs.fields('copy', src, dest))
+
+    def render_template(self, src, dest, log, fileop):
+        """Render src unless its cached render is current and return the
+        render to link instead, None if it doesn't render"""
+        with self._claim_lock:
+            if self.renders is None:
+                self.load_renders()
+        try:
+            with self.profiler.span('render', 'check'):
+                output = self.renders.plan_render(src, fileop)
+        except (KeyError, ValueError, OSError) as err:
+            log.error(
+                'Skipped: %s does not render: %s', src, err,
+                extra=logs.fields('skip', src, dest, 'render failed')
+            )
+            fileop.skip(src, dest, 'render failed')
+            return None
+        # Exists once the plan is applied
+        self.scanned[output] = False
+        return output
+
+    def template_variables(self):
+        """Return the variables templates are rendered with"""
+        variables = {'distro': self.distro or '', 'hostname': self.hostname}
+        if self.config.has_section('Variables'):
+            variables.update(self.config.items('Variables'))
+        return variables
+
+    def load_renders(self):
+        """Load the render cache"""
+        from dfman.template import RenderCache
+        self.renders = RenderCache(
+            self.config.getpath('Globals', 'render_path'),
+            self.config.getpath('Globals', 'dotfile_path'), self.template_variables()
+        )
+        self.renders.load()
+
+    def link_tree(self, src, dest, log=LOG, fileop=None, dest_st=_UNSET):
+        """Link the files inside directory src into dest, return True if dest
+        ends up a link to src, False if it ends up a real directory and None
+        if it was skipped
+
+        Real directories are created where dest has none. In 'fold' mode a
+        missing dest is linked as a whole instead, already linked directories
+        aren't descended into and a directory tree holding nothing but links
+        to the entries of src is folded back into a single link. Directories
+        are listed with os.scandir and nothing below a directory which is
+        created or already linked is checked, dest_st is the lstat of dest if
+        known.
+        """
+        fileop = self.fileop if fileop is None else fileop
+        fold = self.link_mode == 'fold'
+        if dest_st is _UNSET:
+            dest_st = self.lstat(dest)
+        if dest_st is not None and stat.S_ISLNK(dest_st.st_mode) and self.links_to(dest, src):
+            if fold:
+                log.debug(
+                    'Skipped: %s already linked', dest,
+                    extra=logs.fields('skip', src, dest, 'linked')
+                )
+                fileop.skip(src, dest, 'linked')
+                return True
+            fileop.unlink(dest)
+            log.debug('Unfolded: %s', dest, extra=logs.fields('unlink', src, dest))
+            dest_st = None
+        elif dest_st is not None and not stat.S_ISDIR(dest_st.st_mode):
+            if not self.backup_file(dest, log=log, plan=fileop):
+                fileop.skip(src, dest, 'backup exists')
+                return None
+            dest_st = None
+
+        if dest_st is None and fold:
+            fileop.symlink(src, dest)
+            log.debug('Linked: %s to %s', src, dest, extra=logs.fields('link', src, dest))
+            return True
+        if dest_st is None:
+            fileop.mkdir(dest)
+            log.debug('Created: %s', dest, extra=logs.fields('mkdir', None, dest))
+            existing = {}
+        else:
+            with os.scandir(dest) as entries:
+                existing = {entry.name: entry for entry in entries}
+            removals = self.fold_links(src, existing) if fold else None
+            if removals is not None:
+                for kind, path in removals:
+                    getattr(fileop, kind)(path)
+                fileop.rmdir(dest)
+                fileop.symlink(src, dest)
+                log.debug('Folded: %s to %s', src, dest, extra=logs.fields('link', src, dest))
+                return True
+
+        with os.scandir(src) as entries:
+            children = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries]
+        for name, is_dir in children:
+            child_src, child_dest = os.path.join(src, name), os.path.join(dest, name)
+            # Nothing below a directory which doesn't exist yet needs checking
+            child_st = self.lstat(child_dest) if name in existing else None
+            if is_dir:
+                self.link_tree(child_src, child_dest, log, fileop, child_st)
+            else:
+                self.link_file(child_src, child_dest, log, fileop, child_st)
+        return False
+
+    def fold_links(self, src, entries):
+        """Return what to remove, deepest first, for a directory holding
+        entries to become a single link to src, or None if it can't"""
+        if not entries:
+            return None
+        removals = []
+        for name, entry in entries.items():
+            child_src = os.path.join(src, name)
+            if entry.is_symlink():
+                if not self.links_to(entry.path, child_src):
+                    return None
+                removals.append(('unlink', entry.path))
+            elif entry.is_dir(follow_symlinks=False) and self.is_source_dir(child_src):
+                with os.scandir(entry.path) as children:
+                    nested = self.fold_links(child_src, {i.name: i for i in children})
+                if nested is None:
+                    return None
+                removals.extend(nested)
+                removals.append(('rmdir', entry.path))
+            else:
+                return None
+        return removals
+
+    def link_file(self, src, dest, log, fileop, dest_st):
+        """Link a file found by link_tree, backing up what is in its way"""
+        if dest_st is not None:
+            if stat.S_ISLNK(dest_st.st_mode) and self.links_to(dest, src):
+                log.debug(
+                    'Skipped: %s already linked', dest,
+                    extra=logs.fields('skip', src, dest, 'linked')
+                )
+                fileop.skip(src, dest, 'linked')
+                return
+            if not self.backup_file(dest, log=log, plan=fileop):
+                fileop.skip(src, dest, 'backup exists')
+                return
+        fileop.symlink(src, dest)
+        log.debug('Linked: %s to %s', src, dest, extra=logs.fields('link', src, dest))
 
-    def uninstall_dotfiles(self):
-        """Reverse install process based on configuration file"""
+    @staticmethod
+    def links_to(link, src):
+        """Return True if the symlink link points at src"""
+        return os.path.join(os.path.dirname(link), os.readlink(link)) == src
+
+    def is_source_dir(self, src):
+        """Return True if src is a directory, using the last scan where possible"""
+        if src in self.scanned:
+            return self.scanned[src]
+        return os.path.isdir(src)
+
+    def uninstall_dotfiles(self, filemap=None):
+        """Reverse install process based on configuration file, return the plan"""
+        with self.profiler.span('plan_uninstall'):
+            plan = self.plan_uninstall(filemap=filemap)
+        if not self.dry_run:
+            self.apply(plan)
+            with self.profiler.span('save_state'):
+                self.manifest.save()
+                self.save_backups(plan)
+        return plan
+
+    def plan_uninstall(self, plan=None, filemap=None):
+        """Return the plan for uninstalling dotfiles, extending plan if given,
+        using filemap as plan_install does"""
         if not os.path.isdir(self.config.getpath('Globals', 'backup_path')):
             raise FileNotFoundError(
                 '%s: No such directory' % self.config.getpath('Globals', 'backup_path')
             )
 
-        for src, dest in self.get_filemap().items():
-            if self.does_symlink_already_exist(src, dest):
-                self.fileop.unlink(dest)
-                LOG.debug('Unlinked: %s', dest)
+        self.check_journal()
+        self._claimed_backups.clear()
+        with self.profiler.span('load_state'):
+            self.manifest.load(self.config.getpath('Globals', 'manifest'))
+            self.load_backups()
+        # Indexed backups belong to their destination, never guess them by basename
+        self._claimed_backups.update(self.backups.index.values())
+        if filemap is None:
+            with self.profiler.span('scan'):
+                filemap = self.get_filemap()
+        dests = set(filemap.values())
+        bundled = [
+            (entry['src'], dest)
+            for dest, entry in sorted(self.manifest.by_state('bundled').items())
+            if dest not in dests
+        ]
+        try:
+            return self.run_entries(
+                self.uninstall_entry, list(filemap.items()) + bundled, plan=plan
+            )
+        finally:
+            for archive in self._bundles.values():
+                if archive is not None:
+                    archive.close()
+            self._bundles = {}
+
+    def uninstall_entry(self, src, dest, log=LOG, plan=None):
+        """Uninstall a single dotfile and restore its backup, adding its
+        operations to plan if given"""
+        from dfman import template
+        fileop = self.fileop if plan is None else plan
+        if template.is_template(src):
+            src = template.output_path(
+                self.config.getpath('Globals', 'render_path'),
+                self.config.getpath('Globals', 'dotfile_path'), src
+            )
+        entry = self.manifest.entry(dest)
+        if entry is not None and entry['state'] == 'bundled':
+            with self.profiler.span('remove_bundled', 'check'):
+                removed = self.remove_bundled(entry['src'], dest, log, fileop)
+            if removed:
+                self.manifest.discard(dest)
+                self.restore_backup(src, dest, log, fileop, guess=False)
             else:
-                LOG.debug('Skipped: %s is not linked', dest)
+                fileop.skip(src, dest, 'modified')
+            return
+        if entry is not None and entry['state'] == 'copied':
+            with self.profiler.span('remove_copies', 'check'):
+                removed = self.remove_copies(src, dest, log, fileop)
+            if removed:
+                self.manifest.discard(dest)
+                self.restore_backup(src, dest, log, fileop)
+            else:
+                fileop.skip(src, dest, 'modified')
+            return
+        if self.link_mode in ('tree', 'fold') and self.is_source_dir(src):
+            with self.profiler.span('unlink_tree', 'check'):
+                removed = self.unlink_tree(src, dest, log, fileop)
+            if removed:
+                self.manifest.discard(dest)
+                self.restore_backup(src, dest, log, fileop)
+            else:
+                fileop.skip(src, dest, 'not linked')
+            return
+        with self.profiler.span('check_link', 'check'):
+            linked = self.does_symlink_already_exist(src, dest)
+        if linked:
+            fileop.unlink(dest)
+            self.manifest.discard(dest)
+            log.debug('Unlinked: %s', dest, extra=logs.fields('unlink', src, dest))
+        else:
+            log.debug(
+                'Skipped: %s is not linked', dest,
+                extra=logs.fields('skip', src, dest, 'not linked')
+            )
+            fileop.skip(src, dest, 'not linked')
+            return
+        self.restore_backup(src, dest, log, fileop)
+
+    def unlink_tree(self, src, dest, log, fileop, dest_st=_UNSET):
+        """Remove the links link_tree made from src into dest, return True if
+        dest was removed
+
+        Real directories are removed once nothing but links to src was in
+        them, backups of the files inside are restored.
+        """
+        if dest_st is _UNSET:
+            dest_st = self.lstat(dest)
+        if dest_st is None:
+            return False
+        if stat.S_ISLNK(dest_st.st_mode):
+            if not self.links_to(dest, src):
+                return False
+            fileop.unlink(dest)
+            log.debug('Unlinked: %s', dest, extra=logs.fields('unlink', src, dest))
+            return True
+        if not stat.S_ISDIR(dest_st.st_mode):
+            return False
+        with os.scandir(dest) as entries:
+            existing = list(entries)
+        removed_all = bool(existing)
+        for entry in existing:
+            child_src = os.path.join(src, entry.name)
+            if entry.is_symlink() or (
+                    entry.is_dir(follow_symlinks=False) and self.is_source_dir(child_src)
+            ):
+                removed = self.unlink_tree(
+                    child_src, entry.path, log, fileop, self.lstat(entry.path)
+                )
+            else:
+                removed = False
+            if removed:
+                self.restore_backup(child_src, entry.path, log, fileop, guess=False)
+            removed_all = removed_all and removed
+        if not removed_all:
+            # Keep directories holding anything else, like application state
+            return False
+        fileop.rmdir(dest)
+        log.debug('Removed: %s', dest, extra=logs.fields('rmdir', None, dest))
+        return True
+
+    def remove_copies(self, src, dest, log, fileop, dest_st=_UNSET):
+        """Remove what copy_tree copied from src to dest, return True if
+        dest was removed
+
+        Files which changed since they were copied are kept, along with the
+        directories holding them.
+        """
+        from dfman import fastcopy
+        if dest_st is _UNSET:
+            dest_st = self.lstat(dest)
+        try:
+            src_st = os.lstat(src)
+        except OSError:
+            return False
+        if dest_st is None:
+            return False
+        if stat.S_ISDIR(src_st.st_mode) and stat.S_ISDIR(dest_st.st_mode):
+            with os.scandir(dest) as entries:
+                existing = list(entries)
+            removed_all = bool(existing)
+            for entry in existing:
+                removed = self.remove_copies(
+                    os.path.join(src, entry.name), entry.path, log, fileop,
+                    self.lstat(entry.path)
+                )
+                removed_all = removed_all and removed
+            if not removed_all:
+                return False
+            fileop.rmdir(dest)
+        elif stat.S_ISLNK(src_st.st_mode) and stat.S_ISLNK(dest_st.st_mode):
+            if os.readlink(src) != os.readlink(dest):
+                return False
+            fileop.unlink(dest)
+        elif fastcopy.is_copy(src_st, dest_st):
+            fileop.remove(src, dest)
+        else:
+            return False
+        log.debug('Removed: %s', dest, extra=logs.fields('remove', src, dest))
+        return True
+
+    def remove_bundled(self, path, dest, log, fileop):
+        """Remove what install_bundle extracted to dest from the bundle at
+        path, return True if dest was removed
+
+        What changed since, or can't be compared because the bundle is gone,
+        is kept along with the directories holding it.
+        """
+        archive = self.open_bundle(path)
+        if archive is None:
+            return False
+        removed = set()
+        for record in reversed(archive.entry_records(dest)):
+            kind, target = record[1], record[2]
+            if not archive.is_extracted(record):
                 continue
-            backup = os.path.join(
+            if kind == 'd':
+                with os.scandir(target) as entries:
+                    if any(entry.path not in removed for entry in entries):
+                        continue
+                fileop.rmdir(target)
+            else:
+                fileop.unlink(target)
+            removed.add(target)
+            log.debug('Removed: %s', target, extra=logs.fields('remove', path, target))
+        return dest in removed
+
+    def open_bundle(self, path):
+        """Return the Bundle at path, opened once per uninstall, None if it
+        can't be read"""
+        from dfman import bundle
+        with self._claim_lock:
+            if path not in self._bundles:
+                try:
+                    self._bundles[path] = bundle.Bundle(path)
+                except (OSError, ValueError):
+                    self._bundles[path] = None
+            return self._bundles[path]
+
+    def restore_backup(self, src, dest, log, fileop, guess=True):
+        """Restore the backup of dest, with guess falling back to backups
+        made before the index existed"""
+        backup_ref = self.backups.index.get(dest)
+        if backup_ref is None:
+            if not guess:
+                return
+            # Backups made before the index existed are found by basename
+            backup_ref = os.path.join(
                 self.config.getpath('Globals', 'backup_path'), os.path.basename(src)
             )
-            if os.path.exists(backup):
-                self.fileop.move(backup, dest)
-                LOG.debug('Restored: %s to %s', backup, src)
-            else:
-                LOG.error('Not restored: %s not found in backups', backup)
+            if not self.lexists(backup_ref) or not self.claim_backup(backup_ref):
+                log.error(
+                    'Not restored: %s not found in backups', backup_ref,
+                    extra=logs.fields('skip', backup_ref, dest, 'no backup')
+                )
+                fileop.skip(backup_ref, dest, 'no backup')
+                return
+        if self.backups.is_blob(backup_ref):
+            fileop.restore(backup_ref, dest)
+        else:
+            fileop.move(backup_ref, dest)
+        log.debug(
+            'Restored: %s to %s', backup_ref, dest,
+            extra=logs.fields('restore', backup_ref, dest)
+        )
+
+    def load_backups(self):
+        """Load the backup index"""
+        from dfman.backup import BackupStore
+        self.backups = BackupStore(
+            self.config.getpath('Globals', 'backup_path'),
+            dedup=self.config.getboolean('Globals', 'backup_store')
+        )
+        self.backups.load()
+
+    def save_backups(self, plan):
+        """Update the backup index with an applied plan"""
+        self.backups.update_index(plan)
+        self.backups.save()
+
+    def get_stamps(self):
+        """Return the inputs a cached filemap depends on"""
+        dotfile_path = self.config.getpath('Globals', 'dotfile_path')
+        return {
+            'config': Manifest.stamp(self.config.cfg_file),
+            'dotfile_path': [dotfile_path, Manifest.stamp(dotfile_path)],
+            'distro': Manifest.stamp(const.SYSTEMD_DISTINFO),
+            'hostname': self.hostname,
+            'override_sections': self.override_sections(),
+        }
+
+    def run_entries(self, func, entries, plan=None):
+        """Call func(src, dest, log, plan) for every (src, dest) pair in
+        entries and return the resulting plan
+
+        Serially, entries are handled as they are produced. With more than one
+        job, entries are collected first and run on a thread pool in waves so
+        that operations on a destination nested inside another destination
+        come after those on its parent. The async engine instead runs each
+        entry as soon as the entry of the nearest destination containing it
+        is done, on an executor of jobs threads, which keeps more lookups in
+        flight where the filesystem has a high latency. Log records and
+        operations are buffered per entry and kept in wave order. Paths
+        are lstat'ed and directories resolved at most once while the plan is
+        built.
+        """
+        from dfman.plan import Plan
+        if plan is None:
+            plan = Plan()
+        self.link_mode = self.config.get('Globals', 'link_mode')
+        self.install_mode = self.config.get('Globals', 'install_mode')
+        with self.path_cache(), self.profiler.span('entries'):
+            self._run_entries(func, entries, plan)
+        return plan
+
+    @contextmanager
+    def path_cache(self):
+        """Cache lstat results and resolved directories within the block
+
+        The counts of the resolver are added to the profile at the end.
+        """
+        self._lstat_cache = {}
+        self.resolver = self._resolver()
+        try:
+            yield
+        finally:
+            for name, value in self.resolver.counts().items():
+                self.profiler.count('resolve_' + name, value)
+            self._lstat_cache = None
+            self.resolver = None
+
+    def _run_entries(self, func, entries, plan):
+        if self.engine == 'async':
+            import asyncio
+            coroutine = self._run_entries_async(func, entries, plan)
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
+                asyncio.run(coroutine)
+                return
+            # asyncio.run can't be nested, called from a coroutine the entries
+            # run on a loop of their own in a worker thread
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                pool.submit(asyncio.run, coroutine).result()
+            return
+        if self.jobs <= 1:
+            for src, dest in entries:
+                func(src, dest, plan=plan)
+            return
+
+        from concurrent.futures import ThreadPoolExecutor
+        from dfman.plan import Plan
+        filemap = dict(entries)
+
+        def run(entry):
+            log, entry_plan = BufferedLog(), Plan()
+            func(entry[0], entry[1], log, entry_plan)
+            return log, entry_plan
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for wave in self.schedule_waves(filemap):
+                for log, entry_plan in pool.map(run, wave):
+                    log.flush(LOG)
+                    plan.extend(entry_plan)
+
+    async def _run_entries_async(self, func, entries, plan):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from dfman.plan import Plan
+        loop = asyncio.get_running_loop()
+        filemap = dict(entries)
+
+        def run(src, dest):
+            log, entry_plan = BufferedLog(), Plan()
+            func(src, dest, log, entry_plan)
+            return log, entry_plan
+
+        async def run_after(parent, src, dest):
+            if parent is not None:
+                await parent
+            return await loop.run_in_executor(executor, run, src, dest)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            tasks = {}
+            waves = self.schedule_waves(filemap)
+            # Waves order parents first, so their tasks exist when needed
+            for wave in waves:
+                for src, dest in wave:
+                    parent = self.nearest_parent(dest, tasks)
+                    tasks[dest] = loop.create_task(run_after(parent, src, dest))
+            try:
+                # Collected in wave order like the threads engine, so both
+                # produce the same plan
+                for wave in waves:
+                    for _, dest in wave:
+                        log, entry_plan = await tasks[dest]
+                        log.flush(LOG)
+                        plan.extend(entry_plan)
+            finally:
+                for task in tasks.values():
+                    task.cancel()
+
+    @staticmethod
+    def nearest_parent(path, parents):
+        """Return the value in parents of the closest ancestor of path, None
+        if no ancestor is in parents"""
+        parent = os.path.dirname(path)
+        while parent != path:
+            if parent in parents:
+                return parents[parent]
+            path, parent = parent, os.path.dirname(parent)
+        return None
+
+    def lstat(self, path):
+        """Return os.lstat(path) or None if path doesn't exist
+
+        Results are cached while a plan is being built.
+        """
+        cache = self._lstat_cache
+        if cache is not None and path in cache:
+            self.profiler.count('lstat_cached')
+            return cache[path]
+        self.profiler.count('lstat')
+        try:
+            result = os.lstat(path)
+        except OSError:
+            result = None
+        if cache is not None:
+            cache[path] = result
+        return result
+
+    def exists(self, path):
+        """Return True if path exists, following a final symlink"""
+        if self._lstat_cache is None:
+            return os.path.exists(path)
+        result = self.lstat(path)
+        if result is None:
+            return False
+        if stat.S_ISLNK(result.st_mode):
+            return os.path.exists(path)
+        return True
+
+    def lexists(self, path):
+        """Return True if path exists, without following a final symlink"""
+        return self.lstat(path) is not None
+
+    def write_plan(self, out, uninstall=False, stream=True):
+        """Write every operation and skip of an install, or uninstall, to out
+
+        With stream, one JSON object is written per line as entries are
+        planned, otherwise a single JSON array is written at the end.
+        """
+        from dfman.plan import Plan
+        if stream:
+            def emit(op):
+                out.write(json.dumps(self.describe(op), sort_keys=True) + '\n')
+                out.flush()
+            plan = Plan(listener=emit)
+        else:
+            plan = Plan()
+        if uninstall:
+            self.plan_uninstall(plan)
+        else:
+            self.plan_install(plan)
+        if not stream:
+            json.dump([self.describe(op) for op in plan.records], out, indent=2, sort_keys=True)
+            out.write('\n')
+
+    def describe(self, op):
+        """Return a JSON serializable description of a plan record"""
+        action = {
+            'symlink': 'link', 'unlink': 'unlink', 'skip': 'skip', 'store': 'store',
+            'write': 'store', 'discard': 'backup', 'restore': 'restore', 'mkdir': 'mkdir',
+            'rmdir': 'rmdir', 'render': 'render', 'copy': 'copy', 'remove': 'remove',
+        }.get(op.kind)
+        if op.kind == 'move':
+            backup_path = os.path.join(self.config.getpath('Globals', 'backup_path'), '')
+            action = 'restore' if op.src.startswith(backup_path) else 'backup'
+        src = None if op.kind in ('write', 'render') else op.src
+        description = {'action': action, 'src': src, 'dest': op.dest}
+        if op.kind == 'skip':
+            description['reason'] = op.reason
+        return description
+
+    def check_journal(self):
+        """Refuse to run while operations of an interrupted run are pending"""
+        from dfman.plan import Journal
+        journal = self.config.getpath('Globals', 'journal')
+        if Journal(journal).exists():
+            raise FileExistsError(
+                '%s: Unfinished operations from an interrupted run, use recover' % journal
+            )
+
+    def apply(self, plan):
+        """Apply a plan, journaling it so an interrupted run can be recovered"""
+        from dfman.plan import apply_plan
+        with self.profiler.span('apply'):
+            apply_plan(
+                plan, self.config.getpath('Globals', 'journal'), profiler=self.profiler,
+                # Copies wait on I/O, not the CPU
+                jobs=self.jobs if self.jobs > 1 else os.cpu_count() or 1
+            )
+
+    def recover(self, rollback=False):
+        """Roll forward, or back, operations of an interrupted run"""
+        from dfman import plan
+        journal = self.config.getpath('Globals', 'journal')
+        if not plan.Journal(journal).exists():
+            LOG.info('Nothing to recover')
+            return
+        for op in plan.recover(journal, rollback=rollback):
+            LOG.debug(
+                'Recovered: %s %s to %s', op.kind, op.src, op.dest,
+                extra=logs.fields(op.kind, op.src, op.dest)
+            )
+
+    @staticmethod
+    def schedule_waves(filemap):
+        """Split filemap entries into waves of independent entries
+
+        An entry is placed one wave after each ancestor of its destination
+        which is itself a destination. Filemap order is kept within a wave.
+        """
+        dests = set(filemap.values())
+        waves = []
+        for src, dest in filemap.items():
+            depth = 0
+            path, parent = dest, os.path.dirname(dest)
+            while parent != path:
+                if parent in dests:
+                    depth += 1
+                path, parent = parent, os.path.dirname(parent)
+            while len(waves) <= depth:
+                waves.append([])
+            waves[depth].append((src, dest))
+        return waves
+
+    def claim_backup(self, path):
+        """Reserve a backup path for this run, return False if already taken"""
+        with self._claim_lock:
+            if path in self._claimed_backups:
+                return False
+            self._claimed_backups.add(path)
+            return True
 
     def add_file(self, existing_file):
         """Add a file to tracking"""
+        self.add_files([existing_file])
+
+    def add_files(self, patterns):
+        """Add files, or glob patterns of files, to tracking
+
+        Every file is checked before any is moved. Files are moved on the
+        thread pool, then all new overrides are written to the config file at
+        once and applied to the loaded config. If a move fails, the overrides
+        of the files which were moved are still written.
+        """
+        import glob
+        paths = []
+        for pattern in patterns:
+            if glob.has_magic(pattern):
+                matches = sorted(glob.glob(os.path.expanduser(pattern)))
+                if not matches:
+                    raise FileNotFoundError('%s: No match' % pattern)
+                paths.extend(matches)
+            else:
+                paths.append(pattern)
+        adds = [self._check_add(path) for path in paths]
+        dests = [dest for _, dest, _ in adds]
+        if len(set(dests)) != len(dests):
+            duplicate = [dest for dest in dests if dests.count(dest) > 1][0]
+            raise FileExistsError('%s: Added more than once' % duplicate)
+
+        moved = set()
+
+        def move(add):
+            self.fileop.move(add[0], add[1])
+            moved.add(add)
+            LOG.debug('Added: %s', add[0])
+
+        try:
+            if self.jobs <= 1 or len(adds) <= 1:
+                for add in adds:
+                    move(add)
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                    list(pool.map(move, adds))
+        finally:
+            # A moved file is only found again through its override
+            overrides = [add[2] for add in adds if add in moved and add[2] is not None]
+            if overrides:
+                self.add_files_to_overrides(overrides)
+
+    def _check_add(self, existing_file):
+        """Return (src, dest, override path or None) for a file to add"""
         if existing_file.endswith(os.sep):
             existing_file = existing_file.rstrip(os.sep)
         path, basename = os.path.split(existing_file)
@@ -118,83 +1168,220 @@ class MainRuntime(object):
             raise FileNotFoundError('%s: No such file or directory' % existing_file)
         if os.path.exists(dest):
             raise FileExistsError('%s: Already exists' % dest)
-        if not path == self.config.getpath('Globals', 'config_path'):
-            self.add_file_to_overrides(os.path.join(path, basename))
-
-        self.fileop.move(existing_file, dest)
-        LOG.debug('Added: %s', existing_file)
+        if os.path.expanduser(path) == self.config.getpath('Globals', 'config_path'):
+            return existing_file, dest, None
+        return existing_file, dest, os.path.join(path, basename)
 
     def add_file_to_overrides(self, filepath):
         """Add a file to overrides section of config file"""
-        filename = os.path.basename(filepath)
-        with open(os.path.join(const.USER_PATH, const.CFG)) as f:
+        self.add_files_to_overrides([filepath])
+
+    def add_files_to_overrides(self, filepaths):
+        """Add files to the overrides section of the config file with a single
+        atomic write, and to the loaded config"""
+        cfg_file = os.path.join(const.USER_PATH, const.CFG)
+        with open(cfg_file) as f:
             content = f.readlines()
-        line = content.index('[Overrides]' + os.linesep) + 1
-        content.insert(line, '%s = %s%s' % (filename, filepath, os.linesep))
-        self.fileop.writelines(os.path.join(const.USER_PATH, const.CFG), 'w', content)
+        lines = [
+            '%s = %s%s' % (os.path.basename(filepath), filepath, os.linesep)
+            for filepath in filepaths
+        ]
+        try:
+            line = content.index('[Overrides]' + os.linesep) + 1
+        except ValueError:
+            content.append('%s[Overrides]%s' % (os.linesep, os.linesep))
+            line = len(content)
+        content[line:line] = lines
+        self.fileop.write_atomic(cfg_file, content)
+        if not self.dry_run:
+            self.config.update_section(
+                'Overrides', {os.path.basename(filepath): filepath for filepath in filepaths}
+            )
 
     def get_filemap(self):
         """Return a map of all file sources and destinations with overrides"""
-        filemap = {
-            os.path.join(self.config.getpath('Globals', 'dotfile_path'), i):
-                os.path.join(self.config.getpath('Globals', 'config_path'), i)
-            for i in os.listdir(self.config.getpath('Globals', 'dotfile_path'))
-        }
-        overrides = self.get_overrides()
-        override_destinations = [
-            key for key, value in filemap.items()
-            if value in overrides.values()
-        ]
-        for key in override_destinations:
-            del filemap[key]
-        filemap.update(overrides)
-        return filemap
+        for _ in self.iter_filemap():
+            pass
+        return self.filemap
+
+    def iter_filemap(self):
+        """Yield (src, dest) pairs while scanning dotfile_path
+
+        The complete map is kept in self.filemap. Every scanned source is
+        recorded in self.scanned along with whether it is a directory, so its
+        existence doesn't need to be checked again, except for symlinks to
+        nothing, which don't exist as os.path.exists sees it. Overrides for sources not
+        found by the scan are yielded last. A source_tree from
+        scan_source_tree is used instead of scanning if set.
+        """
+        dotfile_path = self.config.getpath('Globals', 'dotfile_path')
+        config_path = self.config.getpath('Globals', 'config_path')
+        from dfman import template
+        from dfman.filemap import FileMap
+        self.filemap = FileMap(dotfile_path)
+        for src, dest in self.get_overrides().items():
+            self.filemap.add(src, dest, override=True)
+        self.scanned = {}
+        if self.source_tree is not None:
+            entries = iter(self.source_tree)
+        else:
+            entries = self._scan_source_tree(dotfile_path)
+        found = set()
+        for name, is_dir in entries:
+            src = os.path.join(dotfile_path, name)
+            found.add(src)
+            if is_dir is not None:
+                self.scanned[src] = is_dir
+            if src in self.filemap:
+                yield src, self.filemap[src]
+                continue
+            dest = os.path.join(config_path, template.strip_suffix(name))
+            if self.filemap.add(src, dest):
+                yield src, dest
+        for src, dest in self.filemap.items():
+            if src not in found:
+                yield src, dest
+        for kind, dest, kept, dropped in self.filemap.conflicts:
+            if kind == 'duplicate':
+                LOG.warning('Skipped: %s and %s both map to %s', kept, dropped, dest)
+
+    def scan_source_tree(self):
+        """Return (name, is_dir) pairs for the entries of dotfile_path, with
+        is_dir None for symlinks to nothing"""
+        return list(self._scan_source_tree(self.config.getpath('Globals', 'dotfile_path')))
+
+    @staticmethod
+    def _scan_source_tree(dotfile_path):
+        with os.scandir(dotfile_path) as entries:
+            for entry in entries:
+                if entry.is_symlink() and not os.path.exists(entry.path):
+                    yield entry.name, None
+                else:
+                    yield entry.name, entry.is_dir()
+
+    def source_exists(self, src):
+        """Return True if src exists, using the last scan where possible"""
+        if src in self.scanned:
+            return True
+        return os.path.exists(src)
+
+    def override_sections(self):
+        """Return the names of the sections overriding destinations, in
+        increasing order of precedence"""
+        sections = ['Overrides']
+        if self.release is not None:
+            sections.extend(self.release.sections())
+        if self.hostname:
+            sections.append('host:' + self.hostname)
+        return sections
 
     def get_overrides(self):
-        """Get a dict of global and distro overrides"""
-        overrides = dict(self.config.pathitems('Overrides'))
-        if self.distro:
-            try:
-                overrides.update(self.config.pathitems(self.distro))
-            except NoSectionError:
-                pass
-        return {
-            os.path.join(self.config.getpath('Globals', 'dotfile_path'), key): value
-            for key, value in overrides.items()
-        }
+        """Get a dict of global, distro and host overrides
 
-    def backup_file(self, dest):
+        The table is built once and reused until the config changes.
+        """
+        merged = self.config.merged_pathitems(self.override_sections())
+        if self._overrides is None or self._overrides[0] is not merged:
+            dotfile_path = self.config.getpath('Globals', 'dotfile_path')
+            self._overrides = (merged, {
+                os.path.join(dotfile_path, key): value for key, value in merged.items()
+            })
+        return self._overrides[1]
+
+    def backup_file(self, dest, log=LOG, plan=None):
         """Back up dest to backup dir if it isn't already
-        a symlink to src"""
-        if not os.path.exists(dest):
-            LOG.debug("Not backed up: %s doesn't exist", dest)
+        a symlink to src, adding the move to plan if given
+
+        A symlink to nothing is in the way of a new link too, so it is
+        backed up like anything else at dest.
+        """
+        if not self.lexists(dest):
+            log.debug("Not backed up: %s doesn't exist", dest)
             return True
+        fileop = self.fileop if plan is None else plan
+        if self.backups is not None and self.backups.dedup:
+            ref = self.backups.plan_backup(dest, fileop)
+            if ref is not None:
+                self.manifest.record_backup(dest, ref)
+                log.debug('Backed up: %s to %s', dest, ref, extra=logs.fields('backup', dest, ref))
+                return True
         backup_dest = os.path.join(
             self.config.getpath('Globals', 'backup_path'),
             os.path.basename(dest)
         )
-        if os.path.exists(backup_dest):
-            LOG.error('Skipped: %s already exists in backups', backup_dest)
+        if self.lexists(backup_dest) or not self.claim_backup(backup_dest):
+            log.error(
+                'Skipped: %s already exists in backups', backup_dest,
+                extra=logs.fields('skip', dest, backup_dest, 'backup exists')
+            )
             return False
-        self.fileop.move(dest, backup_dest)
-        LOG.debug('Backed up: %s to %s', dest, self.config.getpath('Globals', 'backup_path'))
+        fileop.move(dest, backup_dest)
+        self.manifest.record_backup(dest, backup_dest)
+        log.debug(
+            'Backed up: %s to %s', dest, self.config.getpath('Globals', 'backup_path'),
+            extra=logs.fields('backup', dest, backup_dest)
+        )
         return True
 
-    @staticmethod
-    def does_symlink_already_exist(src, dest):
+    def does_symlink_already_exist(self, src, dest):
         """Return True if a symlink already exists for dest->src or False"""
-        return os.path.realpath(dest) == src
+        result = self.lstat(dest)
+        if result is None:
+            return False
+        resolver = self.resolver or self._resolver()
+        if stat.S_ISLNK(result.st_mode):
+            target = os.readlink(dest)
+            if os.path.join(os.path.dirname(dest), target) == src:
+                return True
+            return resolver.follow(dest, target) == src
+        if not self.has_symlink_parent(dest, resolver):
+            return dest == src
+        return resolver.realpath(dest) == src
+
+    def has_symlink_parent(self, path, resolver=None):
+        """Return True if any parent directory of path is a symlink"""
+        parent = os.path.dirname(path)
+        resolver = resolver or self.resolver or self._resolver()
+        return resolver.resolve_dir(parent) != parent
+
+    def _resolver(self):
+        from dfman.resolver import PathResolver
+        return PathResolver(self.lstat)
 
     @staticmethod
     def get_distro():
         """Return the distro ID"""
-        if not os.path.isfile(const.SYSTEMD_DISTINFO):
-            return None
-        with open(const.SYSTEMD_DISTINFO) as f:
-            for line in f:
-                if line.startswith('ID='):
-                    return line.rstrip().split('ID=')[-1]
-        return None
+        from dfman import osrelease
+        release = osrelease.load()
+        return release.id if release is not None else None
+
+
+class BufferedLog(object):
+    """Collect log records from a worker thread for ordered replay"""
+    def __init__(self):
+        self.records = []
+
+    def log(self, level, msg, *args, **kwargs):
+        """Buffer a log record"""
+        self.records.append((level, msg, args, kwargs))
+
+    def debug(self, msg, *args, **kwargs):
+        """Buffer a debug record"""
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        """Buffer a warning record"""
+        self.log(logging.WARNING, msg, *args, **kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        """Buffer an error record"""
+        self.log(logging.ERROR, msg, *args, **kwargs)
+
+    def flush(self, logger):
+        """Emit all buffered records to logger in order"""
+        for level, msg, args, kwargs in self.records:
+            logger.log(level, msg, *args, **kwargs)
+        self.records = []
 
 
 class FileOperator(object):
@@ -202,21 +1389,43 @@ class FileOperator(object):
     """Dry-run aware file operations"""
     def __init__(self, dry_run):
         self.dry_run = dry_run
+        self.profiler = NullProfiler()
 
     def _not_dry_run(func):
+        name = func.__name__  # pylint: disable=no-member
+
         def conditional(*args):
             if not args[0].dry_run:
-                return func(*args)
+                with args[0].profiler.span(name, 'fileop'):
+                    return func(*args)
         return conditional
 
     @_not_dry_run
     def move(self, *args):
+        import shutil
         shutil.move(*args)
 
     @_not_dry_run
     def makedirs(self, *args):
         os.makedirs(*args)
 
+    @_not_dry_run
+    def copy(self, *args):
+        from dfman import fastcopy
+        fastcopy.copy_file(*args)
+
+    @_not_dry_run
+    def remove(self, _src, dest):
+        os.unlink(dest)
+
+    @_not_dry_run
+    def mkdir(self, *args):
+        os.mkdir(*args)
+
+    @_not_dry_run
+    def rmdir(self, *args):
+        os.rmdir(*args)
+
     @_not_dry_run
     def symlink(self, *args):
         os.symlink(*args)
@@ -225,41 +1434,172 @@ class FileOperator(object):
     def unlink(self, *args):
         os.unlink(*args)
 
+    @_not_dry_run
+    def store(self, *args):
+        from dfman import backup
+        backup.store_blob(*args)
+
+    @_not_dry_run
+    def write(self, *args):
+        from dfman import backup
+        backup.write_blob(*args)
+
+    @_not_dry_run
+    def render(self, *args):
+        from dfman import template
+        template.write_output(*args)
+
+    @_not_dry_run
+    def discard(self, _ref, dest):
+        from dfman import backup
+        backup.discard(dest)
+
+    @_not_dry_run
+    def restore(self, *args):
+        from dfman import backup
+        backup.restore(*args)
+
+    def skip(self, *args):
+        # Skips are only recorded by plans
+        pass
+
     @_not_dry_run
     def writelines(self, dest, mode, content):
         with open(dest, mode) as f:
             f.writelines(content)
 
+    @_not_dry_run
+    def write_atomic(self, dest, content):
+        tmp = '%s.%d.tmp' % (dest, os.getpid())
+        with open(tmp, 'w') as f:
+            f.writelines(content)
+        os.chmod(tmp, stat.S_IMODE(os.stat(dest).st_mode))
+        os.replace(tmp, dest)
+
 
 def main():
     """Read arguments and begin"""
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        'operation', choices=['install', 'uninstall'], help='operation to perform'
+        'operation',
+        choices=['install', 'uninstall', 'plan', 'recover', 'watch', 'verify', 'bundle'],
+        help='operation to perform'
     )
     parser.add_argument('-i', '--init', required=False, help='provide initial configuration file')
-    parser.add_argument('-a', '--add', required=False, help='add a dotfile')
+    parser.add_argument(
+        '-a', '--add', nargs='+', metavar='PATH', required=False,
+        help='add dotfiles, paths may be glob patterns'
+    )
+    parser.add_argument(
+        '--from-bundle', metavar='FILE', help='install the content of a bundle instead of links'
+    )
+    parser.add_argument('-o', '--output', metavar='FILE', help='bundle file to write')
     parser.add_argument('-v', '--verbose', help='print verbosely', action='store_true')
     parser.add_argument('--dry-run', help='dry run only', action='store_true')
+    parser.add_argument(
+        '--rollback', help='undo an interrupted run on recover', action='store_true'
+    )
+    parser.add_argument(
+        '--uninstall', help='plan an uninstall instead of an install', action='store_true'
+    )
+    parser.add_argument(
+        '--format', choices=['ndjson', 'json'], default='ndjson',
+        help='plan and verify output format, ndjson is streamed'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=1, help='number of entries to process concurrently'
+    )
+    parser.add_argument(
+        '--engine', choices=ENGINES, default='threads',
+        help='how --jobs entries run concurrently, async suits high latency filesystems'
+    )
+    parser.add_argument(
+        '--debounce', type=float, default=0.5,
+        help='seconds to wait for more changes before applying them on watch'
+    )
+    parser.add_argument(
+        '--profile', metavar='FILE',
+        help='write phase and file operation timings to FILE and a trace next to it'
+    )
+    parser.add_argument(
+        '--homes', nargs='+', metavar='HOME',
+        help='install or uninstall into each of these home directories'
+    )
+    parser.add_argument(
+        '--processes', type=int, help='number of homes to process concurrently'
+    )
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.processes is not None and args.processes < 1:
+        parser.error('--processes must be at least 1')
+    if args.homes and args.operation not in ('install', 'uninstall'):
+        parser.error('--homes can only be used with install or uninstall')
+    if args.homes and args.add:
+        parser.error('--add should not be used with --homes')
+    if args.from_bundle and (args.operation != 'install' or args.homes or args.add):
+        parser.error('--from-bundle can only be used with install, without --homes or --add')
+    if args.operation == 'bundle' and not args.output:
+        parser.error('bundle requires --output')
 
-    runtime = MainRuntime(args.verbose, args.dry_run)
+    runtime = MainRuntime(args.verbose, args.dry_run, jobs=args.jobs, engine=args.engine)
+    if args.profile:
+        import atexit
+        # Also written when the operation fails or exits early
+        atexit.register(runtime.enable_profiling().write, args.profile)
     runtime.run_initial_setup(init_cfg=args.init)
 
     if args.dry_run:
         LOG.info('STARTING DRY RUN')
 
-    if args.operation == 'install':
-        if args.add:
-            runtime.add_file(args.add)
-            runtime.run_initial_setup() # Re-load config
-        runtime.install_dotfiles()
+    if args.homes:
+        from dfman.fleet import Fleet
+        summaries = Fleet(runtime, args.homes, processes=args.processes).run(args.operation)
+        if Fleet.report(summaries):
+            sys.exit(1)
+    elif args.operation == 'install':
+        if args.from_bundle:
+            runtime.install_bundle(args.from_bundle)
+        else:
+            if args.add:
+                runtime.add_files(args.add)
+            runtime.install_dotfiles()
     elif args.operation == 'uninstall':
         if args.init:
             parser.error('--init should not be used with uninstall')
         if args.add:
             parser.error('--add should not be used with uninstall')
         runtime.uninstall_dotfiles()
+    elif args.operation == 'plan':
+        if args.add:
+            parser.error('--add should not be used with plan')
+        runtime.write_plan(sys.stdout, uninstall=args.uninstall, stream=args.format == 'ndjson')
+    elif args.operation == 'watch':
+        if args.add:
+            parser.error('--add should not be used with watch')
+        from dfman.watch import Watch
+        try:
+            Watch(runtime, debounce=args.debounce).run()
+        except KeyboardInterrupt:
+            LOG.info('Stopped watching')
+    elif args.operation == 'verify':
+        if args.add:
+            parser.error('--add should not be used with verify')
+        from dfman.verify import Verify
+        report = Verify(runtime).run()
+        Verify.write_report(report, sys.stdout, stream=args.format == 'ndjson')
+        if report['drift']:
+            LOG.error('Drift found in %d of %d entries', len(report['drift']), report['checked'])
+            sys.exit(1)
+    elif args.operation == 'bundle':
+        if args.add:
+            parser.error('--add should not be used with bundle')
+        runtime.create_bundle(args.output)
+    elif args.operation == 'recover':
+        if args.dry_run:
+            parser.error('--dry-run should not be used with recover')
+        runtime.recover(rollback=args.rollback)
 
     if args.dry_run:
         LOG.info('ENDING DRY RUN')
@@ -0,0 +1,102 @@
+"""File copies which keep the data in the kernel"""
+
+
+import errno
+import os
+import stat
+
+
+# Linux ioctl to share extents between two files (reflink)
+FICLONE = 0x40049409
+CHUNK_SIZE = 1 << 20
+# Raised where a kernel copy path isn't supported for a pair of files
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF}
+
+
+def _reflink(src_fd, dest_fd, offset, size):
+    import fcntl
+    if offset:
+        return offset
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    return size
+
+
+def _copy_file_range(src_fd, dest_fd, offset, size):
+    while offset < size:
+        copied = os.copy_file_range(
+            src_fd, dest_fd, size - offset, offset_src=offset, offset_dst=offset
+        )
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def _sendfile(src_fd, dest_fd, offset, size):
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    while offset < size:
+        copied = os.sendfile(dest_fd, src_fd, offset, size - offset)
+        if not copied:
+            break
+        offset += copied
+    return offset
+
+
+def _read_write(src_fd, dest_fd, offset, size):
+    while offset < size:
+        chunk = os.pread(src_fd, min(CHUNK_SIZE, size - offset), offset)
+        if not chunk:
+            break
+        offset += os.pwrite(dest_fd, chunk, offset)
+    return offset
+
+
+def copy_data(src_fd, dest_fd, size):
+    """Copy size bytes from the start of src_fd to dest_fd as a reflink
+    where supported, else with copy_file_range or sendfile, and only read
+    into Python where none of them work"""
+    offset = 0
+    for func in (_reflink, _copy_file_range, _sendfile):
+        try:
+            offset = func(src_fd, dest_fd, offset, size)
+        except (AttributeError, ImportError):
+            # Not available on this platform
+            continue
+        except OSError as err:
+            if err.errno not in _UNSUPPORTED:
+                raise
+            continue
+        if offset >= size:
+            return
+    _read_write(src_fd, dest_fd, offset, size)
+
+
+def copy_file(src, dest):
+    """Atomically replace dest with a copy of src, keeping its mode and
+    times so an unchanged copy can be recognized by size and mtime"""
+    st = os.stat(src)
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dest_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            copy_data(src_fd, dest_fd, st.st_size)
+            os.fchmod(dest_fd, stat.S_IMODE(st.st_mode))
+            os.utime(dest_fd, ns=(st.st_atime_ns, st.st_mtime_ns))
+        finally:
+            os.close(dest_fd)
+    except BaseException:
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        os.close(src_fd)
+    os.replace(tmp, dest)
+
+
+def is_copy(src_st, dest_st):
+    """Return True if dest_st is a file matching src_st by size and mtime"""
+    return (
+        dest_st is not None and stat.S_ISREG(dest_st.st_mode)
+        and dest_st.st_size == src_st.st_size and dest_st.st_mtime_ns == src_st.st_mtime_ns
+    )
@@ -0,0 +1,129 @@
+"""Indexed map of dotfile sources and destinations"""
+
+
+import os
+import sys
+from collections.abc import Mapping
+
+
+class FileMapEntry(object):
+    """A single source to destination mapping
+
+    The source is stored relative to the map root and the destination as a
+    shared (interned) parent directory plus basename, so entries don't hold
+    two full paths each.
+    """
+    __slots__ = ('name', 'parent', 'basename', 'override')
+
+    def __init__(self, name, parent, basename, override):
+        self.name = name
+        self.parent = parent
+        self.basename = basename
+        self.override = override
+
+    @property
+    def dest(self):
+        """Full destination path"""
+        return os.path.join(self.parent, self.basename)
+
+
+class FileMap(Mapping):
+    """Map of source path to destination path, indexed by source, destination
+    and destination parent directory"""
+    def __init__(self, root):
+        self.root = root
+        self._prefix = os.path.join(root, '')
+        self._sources = {}
+        self._parents = {}
+        self.conflicts = []
+
+    def _name(self, src):
+        if src.startswith(self._prefix):
+            return src[len(self._prefix):]
+        return src
+
+    def _src(self, entry):
+        return os.path.join(self.root, entry.name)
+
+    def __getitem__(self, src):
+        return self._sources[self._name(src)].dest
+
+    def __contains__(self, src):
+        return self._name(src) in self._sources
+
+    def __iter__(self):
+        for entry in self._sources.values():
+            yield self._src(entry)
+
+    def __len__(self):
+        return len(self._sources)
+
+    def items(self):
+        """Return (src, dest) pairs"""
+        return [(self._src(entry), entry.dest) for entry in self._sources.values()]
+
+    def values(self):
+        """Return destinations"""
+        return [entry.dest for entry in self._sources.values()]
+
+    def _lookup(self, dest):
+        parent, basename = os.path.split(dest)
+        return self._parents.get(parent, {}).get(basename)
+
+    def _insert(self, name, dest, override):
+        parent, basename = os.path.split(dest)
+        parent = sys.intern(parent)
+        entry = FileMapEntry(name, parent, basename, override)
+        self._sources[name] = entry
+        self._parents.setdefault(parent, {})[basename] = entry
+
+    def _delete(self, entry):
+        del self._sources[entry.name]
+        siblings = self._parents[entry.parent]
+        del siblings[entry.basename]
+        if not siblings:
+            del self._parents[entry.parent]
+
+    def add(self, src, dest, override=False):
+        """Map src to dest and return True, or record a conflict and return
+        False if dest is already taken
+
+        An override replaces a default mapping to the same destination. Any
+        other clash keeps the existing mapping, and an earlier mapping of src
+        is only replaced once dest is accepted.
+        """
+        name = self._name(src)
+        current = self._sources.get(name)
+        existing = self._lookup(dest)
+        if existing is not None and existing is not current:
+            if override and not existing.override:
+                self.conflicts.append(('shadowed', dest, src, self._src(existing)))
+                self._delete(existing)
+            else:
+                kind = 'shadowed' if existing.override and not override else 'duplicate'
+                self.conflicts.append((kind, dest, self._src(existing), src))
+                return False
+        if current is not None:
+            self._delete(current)
+        self._insert(name, dest, override)
+        return True
+
+    def remove(self, src):
+        """Remove the mapping for src"""
+        self._delete(self._sources[self._name(src)])
+
+    def source(self, dest):
+        """Return the source mapped to dest or None"""
+        entry = self._lookup(dest)
+        return None if entry is None else self._src(entry)
+
+    def is_override(self, src):
+        """Return True if src is mapped by an override"""
+        return self._sources[self._name(src)].override
+
+    def children(self, parent):
+        """Return (src, dest) pairs for destinations directly inside parent"""
+        return [
+            (self._src(entry), entry.dest)
+            for entry in self._parents.get(parent, {}).values()
+        ]
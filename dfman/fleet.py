@@ -0,0 +1,103 @@
+"""Install into many home directories from one process"""
+
+
+import os
+from dfman import core, logs
+
+
+# Set in each worker process by _init_worker
+_SHARED = {}
+
+
+def _init_worker(config, source_tree, release, dry_run, jobs, engine):
+    if logs.PIPELINE is not None and os.getpid() != _SHARED.get('parent'):
+        # Forked without the logging thread
+        logs.PIPELINE.detach()
+    _SHARED.update(
+        config=config, source_tree=source_tree, release=release, dry_run=dry_run, jobs=jobs,
+        engine=engine
+    )
+
+
+def run_home(home, operation):
+    """Run operation for a single home root with the shared state of this
+    worker and return its summary"""
+    runtime = core.MainRuntime(
+        False, _SHARED['dry_run'], jobs=_SHARED['jobs'], engine=_SHARED['engine']
+    )
+    # The source tree is shared, everything else lives in the home
+    runtime.config = _SHARED['config'].rehome(home, keep=[('Globals', 'dotfile_path')])
+    runtime.source_tree = _SHARED['source_tree']
+    runtime.release = _SHARED['release']
+    summary = {'home': home, 'error': None}
+    try:
+        runtime.create_runtime_directories()
+        if operation == 'install':
+            plan = runtime.install_dotfiles()
+        else:
+            plan = runtime.uninstall_dotfiles()
+    except (OSError, ValueError) as err:
+        summary['error'] = str(err)
+        return summary
+    finally:
+        if logs.PIPELINE is not None and not logs.PIPELINE.running:
+            # Worker processes exit without flushing
+            logs.PIPELINE.flush()
+    for op in plan.records:
+        action = runtime.describe(op)['action']
+        summary[action] = summary.get(action, 0) + 1
+    return summary
+
+
+class Fleet(object):
+    """Run install or uninstall for many home roots
+
+    The config is read and dotfile_path scanned once by the set up runtime.
+    Paths starting with ~ are expanded to each home, except dotfile_path,
+    which is shared. Homes are handled on a pool of processes.
+    """
+    def __init__(self, runtime, homes, processes=None):
+        self.runtime = runtime
+        self.homes = [os.path.abspath(home) for home in homes]
+        self.processes = processes or os.cpu_count() or 1
+
+    def run(self, operation):
+        """Run operation for every home and return their summaries in order"""
+        initargs = (
+            self.runtime.config, self.runtime.scan_source_tree(), self.runtime.release,
+            self.runtime.dry_run, self.runtime.jobs, self.runtime.engine
+        )
+        tasks = [(home, operation) for home in self.homes]
+        _SHARED['parent'] = os.getpid()
+        if self.processes <= 1 or len(self.homes) <= 1:
+            _init_worker(*initargs)
+            return [run_home(*task) for task in tasks]
+        from concurrent.futures import ProcessPoolExecutor
+        if logs.PIPELINE is not None:
+            # Don't fork queued records or a partly filled file buffer
+            logs.PIPELINE.stop()
+        try:
+            with ProcessPoolExecutor(
+                    max_workers=min(self.processes, len(self.homes)),
+                    initializer=_init_worker, initargs=initargs
+            ) as pool:
+                return list(pool.map(run_home, *zip(*tasks)))
+        finally:
+            if logs.PIPELINE is not None:
+                logs.PIPELINE.start()
+
+    @staticmethod
+    def report(summaries, log=core.LOG):
+        """Log a line per home and return the number of failed homes"""
+        failed = 0
+        for summary in summaries:
+            if summary['error'] is not None:
+                failed += 1
+                log.error('%s: failed: %s', summary['home'], summary['error'])
+                continue
+            log.info(
+                '%s: %d linked, %d unlinked, %d backed up, %d restored, %d skipped',
+                summary['home'], summary.get('link', 0), summary.get('unlink', 0),
+                summary.get('backup', 0), summary.get('restore', 0), summary.get('skip', 0)
+            )
+        return failed
@@ -0,0 +1,135 @@
+"""Logging pipeline writing records from a background thread"""
+
+
+import atexit
+import json
+import logging
+import queue
+
+
+# Record attributes, passed with extra=, copied into JSON lines
+FIELDS = ('op', 'src', 'dest', 'reason')
+
+# The running pipeline, there is only one per process
+PIPELINE = None
+
+
+def fields(op, src, dest, reason=None):
+    """Return extra= record attributes describing a file operation"""
+    extra = {'op': op, 'src': src, 'dest': dest}
+    if reason is not None:
+        extra['reason'] = reason
+    return extra
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """File handler which leaves writes in the file buffer until it is full
+    or a record of flush_level or above arrives"""
+    def __init__(self, filename, buffer_size=1 << 16, flush_level=logging.WARNING):
+        self.buffer_size = buffer_size
+        self.flush_level = flush_level
+        super().__init__(filename)
+
+    def _open(self):
+        return open(
+            self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding
+        )
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= self.flush_level:
+                self.flush()
+        except Exception: # pylint: disable=broad-except
+            self.handleError(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON lines, including file operation fields"""
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _QueueHandler(logging.Handler):
+    """Queue records as they are, so formatting also happens in the background
+
+    Safe because the queue never leaves the process.
+    """
+    def __init__(self, records):
+        super().__init__()
+        self.queue = records
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Exception: # pylint: disable=broad-except
+            self.handleError(record)
+
+
+class LogPipeline(object):
+    """Hand records of logger to handlers on a background thread"""
+    def __init__(self, logger, handlers):
+        from logging.handlers import QueueListener
+        self.logger = logger
+        self.handlers = handlers
+        self.queue = queue.SimpleQueue()
+        self.handler = _QueueHandler(self.queue)
+        self.listener = QueueListener(
+            self.queue, *handlers, respect_handler_level=True
+        )
+        self.running = False
+
+    def start(self):
+        """Start writing records in the background"""
+        if self.handler not in self.logger.handlers:
+            self.logger.addHandler(self.handler)
+        self.listener.start()
+        self.running = True
+
+    def stop(self):
+        """Write all queued records and stop the background thread"""
+        if self.running:
+            self.listener.stop()
+            self.running = False
+        self.flush()
+
+    def flush(self):
+        """Flush buffered output"""
+        for handler in self.handlers:
+            handler.flush()
+
+    def detach(self):
+        """Log directly from the calling thread instead, for forked processes
+        which don't have the background thread"""
+        self.running = False
+        self.logger.removeHandler(self.handler)
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+
+    def close(self):
+        """Stop and close all handlers"""
+        self.stop()
+        self.logger.removeHandler(self.handler)
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+            handler.close()
+
+
+def start(logger, handlers):
+    """Start the pipeline for logger, closed when the process exits"""
+    global PIPELINE # pylint: disable=global-statement
+    PIPELINE = LogPipeline(logger, handlers)
+    PIPELINE.start()
+    atexit.register(PIPELINE.close)
+    return PIPELINE
@@ -0,0 +1,134 @@
+"""Install state manifest"""
+
+
+import json
+import os
+import stat
+
+
+class Manifest(object):
+    """Record of linked, backed up and skipped dotfiles from previous runs"""
+    VERSION = 1
+
+    def __init__(self):
+        self.path = None
+        self.data = self.empty()
+        self.dirty = False
+        self._backups = {}
+
+    @classmethod
+    def empty(cls):
+        """Return an empty manifest structure"""
+        return {'version': cls.VERSION, 'stamps': None, 'filemap': {}, 'entries': {}}
+
+    def load(self, path):
+        """Load the manifest from path, starting empty if it is unusable"""
+        self.path = path
+        self.dirty = False
+        self._backups = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            data = self.empty()
+        self.data = data
+
+    def save(self):
+        """Atomically write the manifest if it changed"""
+        if not self.dirty or not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, sort_keys=True)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+    @staticmethod
+    def stamp(path):
+        """Return [mtime_ns, size] of path or None if it can't be read"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return [st.st_mtime_ns, st.st_size]
+
+    def is_current(self, stamps):
+        """Return True if the stored filemap was built from the same inputs"""
+        return self.data['stamps'] == stamps
+
+    def filemap(self):
+        """Return the stored filemap"""
+        return dict(self.data['filemap'])
+
+    def set_filemap(self, stamps, filemap):
+        """Store a freshly built filemap and drop entries no longer in it"""
+        self.data['stamps'] = stamps
+        self.data['filemap'] = dict(filemap)
+        dests = set(filemap.values())
+        # Bundled entries don't come from the filemap
+        self.data['entries'] = {
+            dest: entry for dest, entry in self.data['entries'].items()
+            if dest in dests or entry['state'] == 'bundled'
+        }
+        self.dirty = True
+
+    def is_linked(self, src, dest, lstat=None):
+        """Return True if dest was linked to src and neither changed since
+
+        lstat, if given, is used instead of os.lstat and returns None for
+        missing paths.
+        """
+        entry = self.data['entries'].get(dest)
+        if not entry or entry['state'] != 'linked' or entry['src'] != src:
+            return False
+        try:
+            dest_st = os.lstat(dest) if lstat is None else lstat(dest)
+            if dest_st is None:
+                return False
+            return (
+                stat.S_ISLNK(dest_st.st_mode)
+                and [dest_st.st_ino, dest_st.st_ctime_ns] == entry['dest_ino']
+                and os.stat(src).st_mtime_ns == entry['src_mtime']
+            )
+        except OSError:
+            return False
+
+    def entry(self, dest):
+        """Return the recorded entry of dest, None if there is none"""
+        return self.data['entries'].get(dest)
+
+    def by_state(self, state):
+        """Return the recorded entries in state by destination"""
+        return {
+            dest: entry for dest, entry in self.data['entries'].items()
+            if entry['state'] == state
+        }
+
+    def record_backup(self, dest, backup):
+        """Remember the backup made for dest until its entry is recorded"""
+        self._backups[dest] = backup
+
+    def record(self, src, dest, state, lstat=None):
+        """Record the outcome of installing src to dest
+
+        lstat is used as in is_linked.
+        """
+        entry = {'src': src, 'state': state, 'src_mtime': None, 'dest_ino': None}
+        previous = self.data['entries'].get(dest, {})
+        entry['backup'] = self._backups.pop(dest, previous.get('backup'))
+        try:
+            entry['src_mtime'] = os.stat(src).st_mtime_ns
+            dest_st = os.lstat(dest) if lstat is None else lstat(dest)
+            if dest_st is not None:
+                entry['dest_ino'] = [dest_st.st_ino, dest_st.st_ctime_ns]
+        except OSError:
+            pass
+        self.data['entries'][dest] = entry
+        self.dirty = True
+
+    def discard(self, dest):
+        """Forget dest"""
+        if self.data['entries'].pop(dest, None) is not None:
+            self.dirty = True
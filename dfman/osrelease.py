@@ -0,0 +1,84 @@
+"""Distribution identification from the systemd os-release file"""
+
+
+from dfman import const
+
+
+# Parsed files by path, os-release doesn't change during a run
+_CACHE = {}
+
+
+class OsRelease(object):
+    """ID, ID_LIKE and VERSION_ID of a distribution"""
+    __slots__ = ('id', 'id_like', 'version_id')
+
+    def __init__(self, id, id_like=(), version_id=None):
+        # pylint: disable=redefined-builtin
+        self.id = id
+        self.id_like = tuple(id_like)
+        self.version_id = version_id
+
+    def __repr__(self):
+        return 'OsRelease(%r, %r, %r)' % (self.id, self.id_like, self.version_id)
+
+    def __eq__(self, other):
+        return isinstance(other, OsRelease) and (
+            (self.id, self.id_like, self.version_id)
+            == (other.id, other.id_like, other.version_id)
+        )
+
+    def __hash__(self):
+        return hash((self.id, self.id_like, self.version_id))
+
+    def sections(self):
+        """Return the override section names of this distribution, from
+        the loosest match to the closest
+
+        ID_LIKE lists related distributions closest first, so it is
+        reversed, and a section for this release, ID-VERSION_ID, comes last.
+        """
+        names = list(reversed(self.id_like))
+        names.append(self.id)
+        if self.version_id:
+            names.append('%s-%s' % (self.id, self.version_id))
+        return names
+
+
+def _unquote(value):
+    value = value.strip()
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def parse(lines):
+    """Return the OsRelease described by lines of an os-release file, None
+    if it has no ID"""
+    values = {}
+    for line in lines:
+        key, sep, value = line.strip().partition('=')
+        if sep and key in ('ID', 'ID_LIKE', 'VERSION_ID'):
+            values[key] = _unquote(value)
+    if not values.get('ID'):
+        return None
+    return OsRelease(
+        values['ID'], values.get('ID_LIKE', '').split(), values.get('VERSION_ID') or None
+    )
+
+
+def load(path=None):
+    """Return the OsRelease of path, const.SYSTEMD_DISTINFO by default, or
+    None if it can't be read. Each path is only read once."""
+    if path is None:
+        path = const.SYSTEMD_DISTINFO
+    try:
+        return _CACHE[path]
+    except KeyError:
+        pass
+    try:
+        with open(path) as f:
+            release = parse(f)
+    except OSError:
+        release = None
+    _CACHE[path] = release
+    return release
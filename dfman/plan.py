@@ -0,0 +1,438 @@
+"""Planned file operations and their journaled application"""
+
+
+import errno
+import json
+import os
+from dfman import backup, fastcopy, template
+from dfman.profiling import NullProfiler
+
+
+class Operation(object):
+    """A single planned file operation
+
+    kind is one of 'move' (src to dest), 'symlink' (dest pointing to src) or
+    'unlink' (remove dest, a link to src if known). Backups to the store use
+    'store' (content of src into blob dest), 'write' (text src as blob dest),
+    'discard' (remove dest stored as blob src) and 'restore' (recreate dest
+    from blob src). Tree linking uses 'mkdir' and 'rmdir' (create or remove
+    the real directory dest), templates 'render' (text and mode src
+    replacing dest)
+    and copies 'copy' (file src replacing dest) and 'remove' (remove dest,
+    a copy of src). Plans also record 'skip' entries with a reason, which are
+    never applied.
+    """
+    __slots__ = ('kind', 'src', 'dest', 'reason')
+
+    def __init__(self, kind, src, dest, reason=None):
+        self.kind = kind
+        self.src = src
+        self.dest = dest
+        self.reason = reason
+
+    def __eq__(self, other):
+        return isinstance(other, Operation) and self.to_list() == other.to_list()
+
+    def __repr__(self):
+        return 'Operation(%r, %r, %r)' % (self.kind, self.src, self.dest)
+
+    def to_list(self):
+        """Return a JSON serializable form"""
+        return [self.kind, self.src, self.dest]
+
+    @classmethod
+    def from_list(cls, data):
+        """Build an operation from to_list output"""
+        return cls(*data)
+
+    def inverse(self):
+        """Return the operation undoing this one, None if nothing needs undoing"""
+        if self.kind in ('store', 'write', 'render'):
+            # Blobs are immutable and renders only cached, leaving one
+            # behind is harmless
+            return None
+        if self.kind == 'discard':
+            return Operation('restore', self.src, self.dest)
+        if self.kind == 'restore':
+            return Operation('discard', self.src, self.dest)
+        if self.kind == 'move':
+            return Operation('move', self.dest, self.src)
+        if self.kind == 'copy':
+            # What was there before is backed up by an earlier operation, or
+            # an earlier copy which the next install makes again
+            return Operation('remove', self.src, self.dest)
+        if self.kind == 'remove':
+            return Operation('copy', self.src, self.dest)
+        if self.kind == 'mkdir':
+            return Operation('rmdir', None, self.dest)
+        if self.kind == 'rmdir':
+            return Operation('mkdir', None, self.dest)
+        if self.kind == 'symlink':
+            return Operation('unlink', self.src, self.dest)
+        if self.src is None:
+            raise ValueError('%s: Link target unknown, cannot restore' % self.dest)
+        return Operation('symlink', self.src, self.dest)
+
+    def is_applied(self):
+        """Return True if the filesystem already reflects this operation"""
+        if self.kind == 'move':
+            return not os.path.lexists(self.src) and os.path.lexists(self.dest)
+        if self.kind == 'render':
+            # Replaces an older render, so it can't be told apart, run again
+            return False
+        if self.kind == 'symlink':
+            return os.path.islink(self.dest) and os.readlink(self.dest) == self.src
+        if self.kind in ('store', 'write', 'restore'):
+            return os.path.lexists(self.dest)
+        if self.kind == 'mkdir':
+            return os.path.isdir(self.dest) and not os.path.islink(self.dest)
+        if self.kind == 'copy':
+            try:
+                return fastcopy.is_copy(os.stat(self.src), os.lstat(self.dest))
+            except OSError:
+                return False
+        return not os.path.lexists(self.dest)
+
+
+class Plan(object):
+    # pylint: disable=missing-docstring
+    """File operator which records operations instead of running them
+
+    operations holds what will be applied, records additionally holds skips,
+    in order. listener, if given, is called with every record as it is added.
+    """
+    def __init__(self, listener=None):
+        self.operations = []
+        self.records = []
+        self.listener = listener
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def _record(self, op):
+        self.records.append(op)
+        if self.listener is not None:
+            self.listener(op)
+
+    def _add(self, op):
+        self.operations.append(op)
+        self._record(op)
+
+    def move(self, src, dest):
+        self._add(Operation('move', src, dest))
+
+    def symlink(self, src, dest):
+        self._add(Operation('symlink', src, dest))
+
+    def unlink(self, dest):
+        try:
+            target = os.readlink(dest)
+        except OSError:
+            target = None
+        self._add(Operation('unlink', target, dest))
+
+    def copy(self, src, dest):
+        self._add(Operation('copy', src, dest))
+
+    def remove(self, src, dest):
+        self._add(Operation('remove', src, dest))
+
+    def mkdir(self, dest):
+        self._add(Operation('mkdir', None, dest))
+
+    def rmdir(self, dest):
+        self._add(Operation('rmdir', None, dest))
+
+    def store(self, src, blob):
+        self._add(Operation('store', src, blob))
+
+    def write(self, content, blob):
+        self._add(Operation('write', content, blob))
+
+    def render(self, content, dest, mode):
+        self._add(Operation('render', [content, mode], dest))
+
+    def discard(self, ref, dest):
+        self._add(Operation('discard', ref, dest))
+
+    def restore(self, ref, dest):
+        self._add(Operation('restore', ref, dest))
+
+    def skip(self, src, dest, reason):
+        self._record(Operation('skip', src, dest, reason))
+
+    def extend(self, plan):
+        """Append all operations and skips of another plan"""
+        self.operations.extend(plan.operations)
+        for op in plan.records:
+            self._record(op)
+
+
+class Journal(object):
+    """Write-ahead record of a plan being applied
+
+    The first line holds the full list of operations and every following
+    line the index of an operation which completed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def exists(self):
+        """Return True if an unfinished journal is present"""
+        return os.path.exists(self.path)
+
+    def begin(self, operations):
+        """Durably record operations before any of them run"""
+        self._f = open(self.path, 'w')
+        self._f.write(json.dumps([op.to_list() for op in operations]) + '\n')
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def mark(self, index):
+        """Record that the operation at index completed"""
+        self._f.write('%d\n' % index)
+        self._f.flush()
+
+    def close(self):
+        """Close the journal, keeping it on disk"""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def finish(self):
+        """Remove the journal after all operations completed"""
+        self.close()
+        os.remove(self.path)
+
+    def load(self):
+        """Return the journaled operations and the set of completed indexes"""
+        with open(self.path) as f:
+            operations = [Operation.from_list(op) for op in json.loads(f.readline())]
+            done = set()
+            for line in f:
+                try:
+                    done.add(int(line))
+                except ValueError:
+                    # Torn final write
+                    break
+        return operations, done
+
+
+# Directory descriptors kept open by a BatchOperator
+MAX_DIR_FDS = 64
+
+
+class BatchOperator(object):
+    """Run operations relative to cached parent directory descriptors
+
+    Only the MAX_DIR_FDS most recently used descriptors are kept open.
+    """
+    STORE_KINDS = {
+        'store': backup.store_blob,
+        'write': backup.write_blob,
+        'discard': lambda ref, dest: backup.discard(dest),
+        'restore': backup.restore,
+        'render': lambda src, dest: template.write_output(src[0], dest, src[1]),
+        'copy': fastcopy.copy_file,
+    }
+
+    def __init__(self):
+        from collections import OrderedDict
+        # Least recently used first
+        self._fds = OrderedDict()
+        # Cached directories by each of their ancestors
+        self._below = {}
+        self._dir_fd = all(
+            func in os.supports_dir_fd
+            for func in (os.rename, os.symlink, os.unlink, os.mkdir, os.rmdir)
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Close all cached directory descriptors"""
+        for fd in self._fds.values():
+            os.close(fd)
+        self._fds.clear()
+        self._below = {}
+
+    @staticmethod
+    def _ancestors(path):
+        parent = os.path.dirname(path)
+        while parent != path:
+            yield parent
+            path, parent = parent, os.path.dirname(parent)
+
+    def _dir(self, path):
+        parent, basename = os.path.split(path)
+        fd = self._fds.get(parent)
+        if fd is not None:
+            self._fds.move_to_end(parent)
+            return fd, basename
+        fd = os.open(parent or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+        self._fds[parent] = fd
+        for ancestor in self._ancestors(parent):
+            self._below.setdefault(ancestor, set()).add(parent)
+        if len(self._fds) > MAX_DIR_FDS:
+            self._close(next(iter(self._fds)))
+        return fd, basename
+
+    def _close(self, parent):
+        os.close(self._fds.pop(parent))
+        for ancestor in self._ancestors(parent):
+            below = self._below[ancestor]
+            below.discard(parent)
+            if not below:
+                del self._below[ancestor]
+
+    def _invalidate(self, path):
+        # Descriptors at or below a replaced path would point at the old directory
+        stale = list(self._below.get(path, ()))
+        if path in self._fds:
+            stale.append(path)
+        for parent in stale:
+            self._close(parent)
+
+    def run(self, op):
+        """Apply a single operation"""
+        if op.kind in self.STORE_KINDS:
+            self.STORE_KINDS[op.kind](op.src, op.dest)
+            self._invalidate(op.dest)
+            return
+        if not self._dir_fd:
+            self._run_paths(op)
+            return
+        if op.kind == 'move':
+            src_fd, src_name = self._dir(op.src)
+            dest_fd, dest_name = self._dir(op.dest)
+            if os.path.lexists(op.dest):
+                raise FileExistsError('%s: Already exists' % op.dest)
+            try:
+                os.rename(src_name, dest_name, src_dir_fd=src_fd, dst_dir_fd=dest_fd)
+            except OSError as err:
+                if err.errno != errno.EXDEV:
+                    raise
+                import shutil
+                shutil.move(op.src, op.dest)
+            self._invalidate(op.src)
+        elif op.kind == 'symlink':
+            fd, name = self._dir(op.dest)
+            os.symlink(op.src, name, dir_fd=fd)
+        elif op.kind == 'mkdir':
+            fd, name = self._dir(op.dest)
+            os.mkdir(name, dir_fd=fd)
+        elif op.kind == 'rmdir':
+            fd, name = self._dir(op.dest)
+            os.rmdir(name, dir_fd=fd)
+        else:
+            fd, name = self._dir(op.dest)
+            os.unlink(name, dir_fd=fd)
+        self._invalidate(op.dest)
+
+    @staticmethod
+    def _run_paths(op):
+        if op.kind == 'move':
+            import shutil
+            shutil.move(op.src, op.dest)
+        elif op.kind == 'symlink':
+            os.symlink(op.src, op.dest)
+        elif op.kind == 'mkdir':
+            os.mkdir(op.dest)
+        elif op.kind == 'rmdir':
+            os.rmdir(op.dest)
+        else:
+            os.unlink(op.dest)
+
+
+def apply_plan(plan, journal_path, profiler=None, jobs=1):
+    """Apply all operations of plan in order, journaled at journal_path,
+    timing each with profiler if given
+
+    With more than one job, copies run on a pool of jobs threads. Other
+    operations wait for all running copies, except creating directories,
+    which copies never depend on.
+    """
+    profiler = profiler or NullProfiler()
+    operations = list(plan)
+    if not operations:
+        return
+    journal = Journal(journal_path)
+    with profiler.span('journal', 'apply'):
+        journal.begin(operations)
+    pool = None
+    try:
+        if jobs > 1 and any(op.kind == 'copy' for op in operations):
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(max_workers=jobs)
+        with BatchOperator() as batch:
+            _apply(operations, batch, journal, profiler, pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        journal.close()
+    journal.finish()
+
+
+def _apply(operations, batch, journal, profiler, pool):
+    def copy(op):
+        with profiler.span(op.kind, 'fileop'):
+            fastcopy.copy_file(op.src, op.dest)
+
+    running = {}
+
+    def wait():
+        for index, future in running.items():
+            future.result()
+            journal.mark(index)
+        running.clear()
+
+    try:
+        for index, op in enumerate(operations):
+            if pool is not None and op.kind == 'copy':
+                running[index] = pool.submit(copy, op)
+                continue
+            if op.kind != 'mkdir':
+                wait()
+            with profiler.span(op.kind, 'fileop'):
+                batch.run(op)
+            journal.mark(index)
+        wait()
+    finally:
+        # Don't leave copies running after a failure
+        for future in running.values():
+            future.cancel()
+
+
+def recover(journal_path, rollback=False):
+    """Finish or undo an interrupted apply_plan and return the operations run
+
+    Rolling forward runs the operations which are not yet reflected on disk.
+    Rolling back undoes completed operations in reverse order, including the
+    one which may have completed without being marked.
+    """
+    journal = Journal(journal_path)
+    operations, done = journal.load()
+    if rollback:
+        pending = [index for index in range(len(operations)) if index not in done]
+        if pending and operations[pending[0]].is_applied():
+            done.add(pending[0])
+        todo = [operations[index].inverse() for index in sorted(done, reverse=True)]
+        todo = [op for op in todo if op is not None]
+    else:
+        todo = [
+            op for index, op in enumerate(operations)
+            if index not in done and not op.is_applied()
+        ]
+    with BatchOperator() as batch:
+        for op in todo:
+            batch.run(op)
+    journal.finish()
+    return todo
@@ -0,0 +1,119 @@
+"""Phase and file operation timings"""
+
+
+import json
+import os
+import threading
+import time
+
+
+class _Span(object):
+    """Time the enclosed block"""
+    __slots__ = ('profiler', 'name', 'cat', 'start')
+
+    def __init__(self, profiler, name, cat):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, self.cat, self.start, time.perf_counter() - self.start)
+
+
+class _NullSpan(object):
+    """Time nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullProfiler(object):
+    # pylint: disable=unused-argument,no-self-use
+    """Profiler which records nothing, used unless profiling is enabled"""
+    enabled = False
+
+    def span(self, name, cat='phase'):
+        """Return a context manager timing nothing"""
+        return _NULL_SPAN
+
+    def count(self, name, value=1):
+        """Count nothing"""
+
+
+class Profiler(object):
+    """Collect timed spans and counters from any thread
+
+    write() stores a summary per span name and counter, and the individual
+    spans in Chrome trace event format, which trace viewers like
+    chrome://tracing and Perfetto load.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def span(self, name, cat='phase'):
+        """Return a context manager timing the enclosed block as name"""
+        return _Span(self, name, cat)
+
+    def add(self, name, cat, start, duration):
+        """Record a completed span"""
+        # list.append is atomic, no lock needed
+        self.events.append((name, cat, start, duration, threading.get_ident()))
+
+    def count(self, name, value=1):
+        """Add value to counter name"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Return count, total and max seconds per span and all counters"""
+        spans = {}
+        for name, cat, _, duration, _ in self.events:
+            span = spans.setdefault(name, {'cat': cat, 'count': 0, 'total': 0.0, 'max': 0.0})
+            span['count'] += 1
+            span['total'] += duration
+            span['max'] = max(span['max'], duration)
+        return {'spans': spans, 'counters': dict(self.counters)}
+
+    def trace(self):
+        """Return the spans as a Chrome trace"""
+        pid = os.getpid()
+        return {
+            'traceEvents': [
+                {
+                    'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                    'ts': (start - self._origin) * 1e6, 'dur': duration * 1e6,
+                }
+                for name, cat, start, duration, tid in self.events
+            ],
+            'displayTimeUnit': 'ms',
+        }
+
+    @staticmethod
+    def trace_file(path):
+        """Return the trace file written next to the summary at path"""
+        return os.path.splitext(path)[0] + '.trace.json'
+
+    def write(self, path):
+        """Write the summary to path and the trace next to it"""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+            f.write('\n')
+        with open(self.trace_file(path), 'w') as f:
+            json.dump(self.trace(), f)
@@ -0,0 +1,96 @@
+"""Symlink resolution with cached parent directories"""
+
+
+import os
+import stat
+import threading
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+class PathResolver(object):
+    """Resolve paths like os.path.realpath, remembering resolved directories
+
+    Destinations share most of their parents, which os.path.realpath
+    resolves again component by component for every path. Here each
+    directory is resolved once, a final symlink is followed with one lstat
+    and readlink, and os.path.realpath is only used from a component which
+    is itself a symlink. lstat is called as lstat(path), returning None for
+    missing paths, so a runtime's cached lstat can be shared.
+
+    hits and misses count directory lookups answered from and added to the
+    cache, fallbacks the components handed to os.path.realpath.
+    """
+    def __init__(self, lstat=_lstat):
+        self.lstat = lstat
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        self._dirs = {}
+        self._lock = threading.Lock()
+
+    def counts(self):
+        """Return hits, misses and fallbacks by name"""
+        return {'hits': self.hits, 'misses': self.misses, 'fallbacks': self.fallbacks}
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _step(self, resolved, name):
+        """Return the resolved path of name in the resolved directory"""
+        if name in ('', '.'):
+            return resolved
+        if name == '..':
+            return os.path.dirname(resolved)
+        path = os.path.join(resolved, name)
+        result = self.lstat(path)
+        if result is not None and stat.S_ISLNK(result.st_mode):
+            self._count('fallbacks')
+            return os.path.realpath(path)
+        return path
+
+    def resolve_dir(self, path):
+        """Return the resolved form of the absolute directory path"""
+        resolved = self._dirs.get(path)
+        if resolved is not None:
+            self._count('hits')
+            return resolved
+        self._count('misses')
+        parent, name = os.path.split(path)
+        if parent == path:
+            resolved = path
+        else:
+            resolved = self._step(self.resolve_dir(parent), name)
+        self._dirs[path] = resolved
+        return resolved
+
+    def _follow(self, resolved, target):
+        if os.path.isabs(target):
+            resolved = os.sep
+        for name in target.split(os.sep):
+            resolved = self._step(resolved, name)
+        return resolved
+
+    def follow(self, path, target):
+        """Return the resolved form of path, a symlink to target"""
+        return self._follow(self.resolve_dir(os.path.dirname(path)), target)
+
+    def realpath(self, path):
+        """Return the resolved form of path"""
+        if not os.path.isabs(path):
+            path = os.path.join(os.getcwd(), path)
+        parent, name = os.path.split(path)
+        resolved = self.resolve_dir(parent)
+        if name in ('', '.', '..'):
+            return self._step(resolved, name)
+        path = os.path.join(resolved, name)
+        result = self.lstat(path)
+        if result is None or not stat.S_ISLNK(result.st_mode):
+            return path
+        return self._follow(resolved, os.readlink(path))
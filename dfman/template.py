@@ -0,0 +1,124 @@
+"""Templated dotfiles and their render cache"""
+
+
+import json
+import os
+import stat
+
+
+# Sources ending in SUFFIX are rendered, and linked without it
+SUFFIX = '.tmpl'
+
+
+def is_template(path):
+    """Return True if path names a template"""
+    return path.endswith(SUFFIX)
+
+
+def strip_suffix(name):
+    """Return the name a template is installed as"""
+    return name[:-len(SUFFIX)] if is_template(name) else name
+
+
+def output_path(root, source_root, src):
+    """Return the path the template src is rendered to under root, by its
+    path relative to source_root so templates with the same name in
+    different directories don't share it"""
+    rel = os.path.relpath(src, source_root)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        rel = os.path.abspath(src).lstrip(os.sep)
+    return os.path.join(root, strip_suffix(rel))
+
+
+def render(text, variables):
+    """Return text with $name and ${name} replaced by variables, raises
+    KeyError for an unknown variable and ValueError for a stray $"""
+    import string
+    return string.Template(text).substitute(variables)
+
+
+def write_output(content, path, mode):
+    """Atomically replace path with content, created with mode so it is
+    never readable by more than the template"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    with open(fd, 'w') as f:
+        os.fchmod(fd, mode)
+        f.write(content)
+    os.replace(tmp, path)
+
+
+class RenderCache(object):
+    """Rendered templates under render_path and the inputs they came from
+
+    Each template below source_root is rendered to a fixed path, which its
+    destination links to, with the mode of the template. The index, kept next
+    to root so no render can replace it, maps that path to a sha256 digest of
+    the template content, its mode and the variables, a template is only
+    rendered again when it differs. planned holds the outputs whose render
+    was added to a plan.
+    """
+    def __init__(self, root, source_root, variables):
+        self.root = root
+        self.source_root = source_root
+        self.variables = variables
+        self.index_file = os.path.normpath(root) + '.json'
+        self.index = {}
+        self.planned = set()
+        self._variables_key = json.dumps(variables, sort_keys=True).encode()
+        self._dirty = False
+
+    def load(self):
+        """Load the index, starting empty if it is unusable"""
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+        self.index = index if isinstance(index, dict) else {}
+        self._dirty = False
+
+    def save(self):
+        """Atomically write the index if it changed"""
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp = self.index_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f, sort_keys=True)
+        os.replace(tmp, self.index_file)
+        self._dirty = False
+
+    def key(self, content, mode):
+        """Return the cache key of template content and mode with the
+        variables"""
+        import hashlib
+        digest = hashlib.sha256(content)
+        digest.update(b'\0%o\0' % mode)
+        digest.update(self._variables_key)
+        return digest.hexdigest()
+
+    def plan_render(self, src, fileop):
+        """Add rendering src to fileop unless its output is current, return
+        the output path
+
+        Raises OSError if src can't be read and KeyError or ValueError if it
+        doesn't render.
+        """
+        output = output_path(self.root, self.source_root, src)
+        with open(src, 'rb') as f:
+            content = f.read()
+            mode = stat.S_IMODE(os.fstat(f.fileno()).st_mode)
+        key = self.key(content, mode)
+        if self.index.get(output) == key and os.path.exists(output):
+            return output
+        fileop.render(render(content.decode(), self.variables), output, mode)
+        self.planned.add(output)
+        self.index[output] = key
+        self._dirty = True
+        return output
@@ -0,0 +1,176 @@
+"""Check installed destinations against dotfile_path"""
+
+
+import json
+import os
+import stat
+from dfman import backup, template
+
+
+def finding(state, src, dest, **details):
+    """Return a report entry"""
+    item = {'state': state, 'src': src, 'dest': dest}
+    item.update(details)
+    return item
+
+
+class DigestCache(object):
+    """sha256 digests of files, reused while their size, mtime and inode
+    stay the same
+
+    Only files looked up since the last load are kept on save.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._seen = set()
+        self._dirty = False
+
+    def load(self):
+        """Load the cache, starting empty if it is unusable"""
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = None
+        self.entries = entries if isinstance(entries, dict) else {}
+        self._seen = set()
+        self._dirty = False
+
+    def save(self):
+        """Atomically write the cache if it changed"""
+        if set(self.entries) != self._seen:
+            self.entries = {path: self.entries[path] for path in self._seen}
+            self._dirty = True
+        if not self._dirty:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, sort_keys=True)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def digest(self, path, st=None):
+        """Return the digest of path, hashing it only if it changed"""
+        if st is None:
+            st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        self._seen.add(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == stamp:
+            return entry[3]
+        digest = backup.hash_file(path)
+        self.entries[path] = stamp + [digest]
+        self._dirty = True
+        return digest
+
+
+class Verify(object):
+    """Report destinations which drifted from their sources
+
+    A destination is in place if it links to its source, or for directories
+    which aren't linked as a whole, if everything in the source is in place
+    below it. Anything else is reported with one of these states:
+    'missing' (no destination), 'no_source' (no source), 'retargeted' (links
+    elsewhere), 'copied' (a file with the same content instead of a link),
+    'modified' (a file with different content) or 'mismatched' (a file where
+    a directory belongs or the other way around). Files with equal sizes are
+    compared by digest, hashed on a pool of jobs threads. With install_mode
+    copy, or where the manifest records a copy, a file with the same content
+    is in place.
+    """
+    def __init__(self, runtime, jobs=None):
+        self.runtime = runtime
+        self.jobs = jobs or (runtime.jobs if runtime.jobs > 1 else os.cpu_count() or 1)
+        self.digests = DigestCache(runtime.config.getpath('Globals', 'digest_cache'))
+
+    def run(self):
+        """Check every destination and return the report"""
+        runtime = self.runtime
+        render_path = runtime.config.getpath('Globals', 'render_path')
+        dotfile_path = runtime.config.getpath('Globals', 'dotfile_path')
+        copy_mode = runtime.config.get('Globals', 'install_mode') == 'copy'
+        runtime.manifest.load(runtime.config.getpath('Globals', 'manifest'))
+        self.digests.load()
+        drift, compare = [], []
+        with runtime.profiler.span('check'), runtime.path_cache():
+            filemap = runtime.get_filemap()
+            for src, dest in filemap.items():
+                if template.is_template(src):
+                    src = template.output_path(render_path, dotfile_path, src)
+                if not runtime.does_symlink_already_exist(src, dest):
+                    entry = runtime.manifest.entry(dest)
+                    copied = copy_mode or (entry is not None and entry['state'] == 'copied')
+                    self.check(src, dest, drift, compare, copied)
+        with runtime.profiler.span('hash'):
+            drift.extend(self.compare_files(compare))
+        self.digests.save()
+        drift.sort(key=lambda item: item['dest'])
+        return {'checked': len(filemap), 'drift': drift}
+
+    def check(self, src, dest, drift, compare, copied=False):
+        """Add what is out of place at dest to drift, and file pairs whose
+        content has to be compared to compare, with copied if dest is meant
+        to be a copy of src"""
+        try:
+            src_st = os.stat(src)
+        except OSError:
+            drift.append(finding('no_source', src, dest))
+            return
+        try:
+            dest_st = os.lstat(dest)
+        except OSError:
+            drift.append(finding('missing', src, dest))
+            return
+        if stat.S_ISLNK(dest_st.st_mode):
+            if copied and os.path.islink(src) and os.readlink(src) == os.readlink(dest):
+                # A copied symlink
+                return
+            if not self.runtime.links_to(dest, src):
+                drift.append(finding('retargeted', src, dest, target=os.readlink(dest)))
+        elif stat.S_ISDIR(dest_st.st_mode) and stat.S_ISDIR(src_st.st_mode):
+            with os.scandir(src) as entries:
+                names = [entry.name for entry in entries]
+            for name in names:
+                self.check(
+                    os.path.join(src, name), os.path.join(dest, name), drift, compare, copied
+                )
+        elif stat.S_ISREG(dest_st.st_mode) and stat.S_ISREG(src_st.st_mode):
+            if dest_st.st_size != src_st.st_size:
+                drift.append(finding('modified', src, dest))
+            else:
+                compare.append((src, src_st, dest, dest_st, copied))
+        else:
+            drift.append(finding('mismatched', src, dest))
+
+    def compare_files(self, compare):
+        """Yield findings for the (src, src_st, dest, dest_st, copied) file
+        pairs of compare, hashing them in parallel"""
+        if not compare:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+
+        def same(pair):
+            src, src_st, dest, dest_st, _ = pair
+            return self.digests.digest(src, src_st) == self.digests.digest(dest, dest_st)
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            for (src, _, dest, _, copied), equal in zip(compare, pool.map(same, compare)):
+                if not equal:
+                    yield finding('modified', src, dest)
+                elif not copied:
+                    yield finding('copied', src, dest)
+
+    @staticmethod
+    def write_report(report, out, stream=True):
+        """Write report to out, with stream as one JSON object per drifted
+        destination followed by the summary"""
+        if not stream:
+            json.dump(report, out, indent=2, sort_keys=True)
+            out.write('\n')
+            return
+        for item in report['drift']:
+            out.write(json.dumps(item, sort_keys=True) + '\n')
+        out.write(json.dumps(
+            {'checked': report['checked'], 'drifted': len(report['drift'])}, sort_keys=True
+        ) + '\n')
@@ -0,0 +1,246 @@
+"""Watch dotfile_path and the config file and re-link on changes"""
+
+
+import os
+import time
+from dfman import core, template
+from dfman.manifest import Manifest
+
+
+# Reported in place of a dotfile name when the config file changed
+CONFIG_CHANGED = None
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_CLOEXEC = 0o2000000
+
+# IN_CLOSE_WRITE catches templates edited in place, which have to be rendered again
+DOTFILE_MASK = (
+    IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+CONFIG_MASK = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ATTRIB
+
+
+class InotifyWatcher(object):
+    """Report changes using inotify, raises OSError where it isn't available"""
+    def __init__(self, dotfile_path, cfg_file):
+        import ctypes
+        import ctypes.util
+        import struct
+        self._event = struct.Struct('iIII')
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            init = self._libc.inotify_init1
+        except AttributeError as err:
+            raise OSError('inotify is not supported') from err
+        self.fd = init(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self._get_errno = ctypes.get_errno
+        self.cfg_name = os.path.basename(cfg_file)
+        self._dotfiles = self._add(dotfile_path, DOTFILE_MASK)
+        self._config = self._add(os.path.dirname(cfg_file), CONFIG_MASK)
+
+    def _add(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = self._get_errno()
+            self.close()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def close(self):
+        """Stop watching"""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def wait(self, timeout=None):
+        """Return the set of changes within timeout seconds, blocking until
+        the first one if timeout is None
+
+        All queued events are read, so a burst of changes is reported at once.
+        """
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        changes = set()
+        while True:
+            self._read_events(os.read(self.fd, 65536), changes)
+            if not select.select([self.fd], [], [], 0)[0]:
+                return changes
+
+    def _read_events(self, data, changes):
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, everything has to be checked
+                changes.add(CONFIG_CHANGED)
+            elif wd == self._config:
+                if name == self.cfg_name:
+                    changes.add(CONFIG_CHANGED)
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                # dotfile_path itself went away, everything has to be checked
+                changes.add(CONFIG_CHANGED)
+            elif name:
+                changes.add(name)
+
+
+class PollWatcher(object):
+    """Report changes by polling the mtime of dotfile_path and the config
+    file, listing dotfile_path only when its mtime changed
+
+    Templates are polled as well, since editing one in place doesn't change
+    the mtime of dotfile_path.
+    """
+    def __init__(self, dotfile_path, cfg_file, interval=1.0):
+        self.dotfile_path = dotfile_path
+        self.cfg_file = cfg_file
+        self.interval = interval
+        self._dir_stamp = Manifest.stamp(dotfile_path)
+        self._cfg_stamp = Manifest.stamp(cfg_file)
+        self._names = self._list()
+        self._templates = self._template_stamps()
+
+    def _template_stamps(self):
+        return {
+            name: Manifest.stamp(os.path.join(self.dotfile_path, name))
+            for name in self._names if template.is_template(name)
+        }
+
+    def _list(self):
+        try:
+            return set(os.listdir(self.dotfile_path))
+        except OSError:
+            return set()
+
+    def close(self):
+        """Stop watching"""
+
+    def changes(self):
+        """Return the set of changes since the last call"""
+        changes = set()
+        cfg_stamp = Manifest.stamp(self.cfg_file)
+        if cfg_stamp != self._cfg_stamp:
+            self._cfg_stamp = cfg_stamp
+            changes.add(CONFIG_CHANGED)
+        dir_stamp = Manifest.stamp(self.dotfile_path)
+        if dir_stamp != self._dir_stamp:
+            self._dir_stamp = dir_stamp
+            names = self._list()
+            changes.update(names ^ self._names)
+            self._names = names
+        templates = self._template_stamps()
+        changes.update(
+            name for name, stamp in templates.items()
+            if name in self._templates and self._templates[name] != stamp
+        )
+        self._templates = templates
+        return changes
+
+    def wait(self, timeout=None):
+        """Return the set of changes within timeout seconds, blocking until
+        the first one if timeout is None"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            changes = self.changes()
+            if changes:
+                return changes
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changes
+            time.sleep(min(self.interval, remaining))
+
+
+def create_watcher(dotfile_path, cfg_file, interval=1.0):
+    """Return an inotify watcher, or a polling one where inotify fails"""
+    try:
+        return InotifyWatcher(dotfile_path, cfg_file)
+    except OSError as err:
+        core.LOG.debug('Polling for changes, inotify unavailable: %s', err)
+        return PollWatcher(dotfile_path, cfg_file, interval=interval)
+
+
+class Watch(object):
+    """Apply changes to the dotfiles as they happen
+
+    Changes arriving less than debounce seconds apart are applied together.
+    Only the links of changed dotfile_path entries are updated, a config
+    change reloads the config and runs a full, manifest assisted, install.
+    """
+    def __init__(self, runtime, debounce=0.5, interval=1.0):
+        self.runtime = runtime
+        self.debounce = debounce
+        self.interval = interval
+        self.watcher = None
+
+    def start(self):
+        """Install everything once and start watching"""
+        self.runtime.install_dotfiles()
+        if self.runtime.filemap is None:
+            self.runtime.get_filemap()
+        self.watch()
+
+    def watch(self):
+        """(Re)create the watcher for the configured paths"""
+        if self.watcher is not None:
+            self.watcher.close()
+        self.watcher = create_watcher(
+            self.runtime.config.getpath('Globals', 'dotfile_path'),
+            self.runtime.config.cfg_file,
+            interval=self.interval
+        )
+
+    def step(self, timeout=None):
+        """Wait for a burst of changes and apply it, return the changes"""
+        changes = self.watcher.wait(timeout)
+        if not changes:
+            return changes
+        while True:
+            more = self.watcher.wait(self.debounce)
+            if not more:
+                break
+            changes |= more
+        self.apply(changes)
+        return changes
+
+    def apply(self, changes):
+        """Apply a set of changes"""
+        try:
+            if CONFIG_CHANGED in changes:
+                core.LOG.info('Configuration changed, reinstalling')
+                self.runtime.config.load_cfg()
+                # dotfile_path may have moved or been replaced
+                self.watch()
+                self.runtime.install_dotfiles()
+            else:
+                core.LOG.info('Changed: %s', ', '.join(sorted(changes)))
+                self.runtime.install_changes(changes)
+        except OSError as err:
+            # Keep watching, the next change may fix this
+            core.LOG.error('Not applied: %s', err)
+
+    def run(self):
+        """Watch until interrupted"""
+        self.start()
+        try:
+            while True:
+                self.step()
+        finally:
+            self.watcher.close()
@@ -0,0 +1,62 @@
+"""Test api module"""
+
+
+import logging
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman import logs
+
+
+class TestDfman(unittest.TestCase):
+
+    def test_targets(self):
+        with test_utils.temp_directory() as tmpdir:
+            dotfile_path = os.path.join(tmpdir, 'dotfiles')
+            os.makedirs(os.path.join(dotfile_path, 'app'))
+            open(os.path.join(dotfile_path, 'rc'), 'a').close()
+            cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            with open(cfg_file, 'w') as f:
+                f.write('[Globals]\ndotfile_path = %s\n\n[Overrides]\n' % dotfile_path)
+            homes = [os.path.join(tmpdir, name) for name in ('a', 'b')]
+            for home in homes:
+                os.makedirs(os.path.join(home, '.config'))
+            # One destination is in the way and gets backed up
+            with open(os.path.join(homes[1], '.config', 'rc'), 'w') as f:
+                f.write('original')
+            handlers = list(logging.getLogger('dfman').handlers)
+
+            api = dfman.Dfman(cfg_file)
+            plan = api.plan(homes[0])
+            self.assertTrue(plan.ok)
+            self.assertEqual(plan.counts(), {'link': 2})
+            self.assertFalse(os.path.lexists(os.path.join(homes[0], '.config', 'rc')))
+
+            results = [api.install(home) for home in homes]
+            self.assertEqual([result.counts() for result in results], [
+                {'link': 2}, {'link': 2, 'backup': 1}
+            ])
+            for home in homes:
+                self.assertEqual(
+                    os.readlink(os.path.join(home, '.config', 'app')),
+                    os.path.join(dotfile_path, 'app')
+                )
+                self.assertIs(api.filemap(home), api.filemap(home))
+            self.assertEqual(api.install(homes[0]).counts(), {'skip': 2})
+
+            result = api.uninstall(homes[1])
+            self.assertTrue(result.applied)
+            with open(os.path.join(homes[1], '.config', 'rc')) as f:
+                self.assertEqual(f.read(), 'original')
+
+            result = api.uninstall(os.path.join(tmpdir, 'missing'), dry_run=True)
+            self.assertFalse(result.ok)
+            self.assertIn('No such directory', result.error)
+
+            self.assertEqual(logging.getLogger('dfman').handlers, handlers)
+            self.assertIsNone(logs.PIPELINE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""Test backup module"""
+
+
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman import backup, plan
+
+
+class TestBackupStore(unittest.TestCase):
+
+    def test_backup_and_restore(self):
+        with test_utils.temp_directory() as tmpdir:
+            store = backup.BackupStore(os.path.join(tmpdir, 'backups'), jobs=2)
+            journal = os.path.join(tmpdir, 'journal')
+            home = os.path.join(tmpdir, 'home')
+            files = {
+                'a/rc': 'same',
+                'b/rc': 'same',
+                'dir/x': 'same',
+                'dir/sub/y': 'other',
+            }
+            for name, content in files.items():
+                path = os.path.join(home, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'w') as f:
+                    f.write(content)
+            os.chmod(os.path.join(home, 'dir/x'), 0o600)
+            os.symlink('x', os.path.join(home, 'dir/link'))
+            dests = [os.path.join(home, i) for i in ('a/rc', 'b/rc', 'dir')]
+
+            plan_ = plan.Plan()
+            for dest in dests:
+                self.assertIsNotNone(store.plan_backup(dest, plan_))
+            plan.apply_plan(plan_, journal)
+            store.update_index(plan_)
+            store.save()
+
+            for dest in dests:
+                self.assertFalse(os.path.lexists(dest))
+            # Identical content is stored once
+            blobs = [
+                name for _, _, names in os.walk(store.objects) for name in names
+                if not name.endswith(backup.TREE_SUFFIX)
+            ]
+            self.assertEqual(len(blobs), 2)
+
+            store = backup.BackupStore(store.root)
+            store.load()
+            self.assertEqual(sorted(store.index), sorted(dests))
+            plan_ = plan.Plan()
+            for dest in dests:
+                plan_.restore(store.index[dest], dest)
+            plan.apply_plan(plan_, journal)
+            store.update_index(plan_)
+
+            self.assertEqual(store.index, {})
+            for name, content in files.items():
+                with open(os.path.join(home, name)) as f:
+                    self.assertEqual(f.read(), content)
+            self.assertEqual(os.stat(os.path.join(home, 'dir/x')).st_mode & 0o777, 0o600)
+            self.assertEqual(os.readlink(os.path.join(home, 'dir/link')), 'x')
+
+    def test_restore_modes(self):
+        with test_utils.temp_directory() as tmpdir:
+            store = backup.BackupStore(os.path.join(tmpdir, 'backups'))
+            journal = os.path.join(tmpdir, 'journal')
+            modes = {os.path.join(tmpdir, 'secret'): 0o600, os.path.join(tmpdir, 'script'): 0o755}
+            for dest, mode in modes.items():
+                with open(dest, 'w') as f:
+                    f.write('same')
+                os.chmod(dest, mode)
+
+            plan_ = plan.Plan()
+            refs = [store.plan_backup(dest, plan_) for dest in modes]
+            plan.apply_plan(plan_, journal)
+            blob, _ = backup.split_ref(refs[0])
+            self.assertEqual(blob, backup.split_ref(refs[1])[0])
+            self.assertEqual(os.stat(blob).st_nlink, 1)
+
+            plan_ = plan.Plan()
+            for dest, ref in zip(modes, refs):
+                plan_.restore(ref, dest)
+            plan.apply_plan(plan_, journal)
+
+            for dest, mode in modes.items():
+                self.assertEqual(os.stat(dest).st_mode & 0o777, mode)
+
+    def test_rollback(self):
+        with test_utils.temp_directory() as tmpdir:
+            store = backup.BackupStore(os.path.join(tmpdir, 'backups'))
+            journal = os.path.join(tmpdir, 'journal')
+            dest = os.path.join(tmpdir, 'rc')
+            with open(dest, 'w') as f:
+                f.write('content')
+
+            plan_ = plan.Plan()
+            store.plan_backup(dest, plan_)
+            journal_ = plan.Journal(journal)
+            journal_.begin(list(plan_))
+            with plan.BatchOperator() as batch:
+                for index, op in enumerate(plan_):
+                    batch.run(op)
+                    journal_.mark(index)
+            journal_.close()
+
+            plan.recover(journal, rollback=True)
+
+            with open(dest) as f:
+                self.assertEqual(f.read(), 'content')
+
+    def test_skips_other_file_types(self):
+        with test_utils.temp_directory() as tmpdir:
+            store = backup.BackupStore(os.path.join(tmpdir, 'backups'))
+            link = os.path.join(tmpdir, 'link')
+            os.symlink('target', link)
+            plan_ = plan.Plan()
+
+            self.assertIsNone(store.plan_backup(link, plan_))
+            self.assertEqual(list(plan_), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
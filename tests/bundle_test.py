@@ -0,0 +1,132 @@
+"""Test bundle module"""
+
+
+import os
+import shutil
+import stat
+import unittest
+from mock import patch
+import test_utils
+from context import dfman
+from dfman import bundle, core
+
+
+def make_sources(root):
+    """Create a file, a directory tree and a symlink under root"""
+    os.makedirs(os.path.join(root, 'app', 'themes'))
+    with open(os.path.join(root, 'rc'), 'w') as f:
+        f.write('rc')
+    with open(os.path.join(root, 'app', 'themes', 'dark'), 'w') as f:
+        f.write('dark')
+    os.chmod(os.path.join(root, 'app', 'themes', 'dark'), 0o600)
+    os.symlink('themes/dark', os.path.join(root, 'app', 'current'))
+
+
+class TestBundle(unittest.TestCase):
+
+    def test_write_extract(self):
+        with test_utils.temp_directory() as tmpdir:
+            src = os.path.join(tmpdir, 'src')
+            home = os.path.join(tmpdir, 'home')
+            make_sources(src)
+            # Rendered templates keep the mode of the template
+            with open(os.path.join(src, 'gitconfig.tmpl'), 'w') as f:
+                f.write('$email')
+            os.chmod(os.path.join(src, 'gitconfig.tmpl'), 0o600)
+            filemap = {
+                os.path.join(src, 'rc'): os.path.join(home, '.rc'),
+                os.path.join(src, 'app'): os.path.join(home, '.config', 'app'),
+                os.path.join(src, 'missing'): os.path.join(home, 'missing'),
+                os.path.join(src, 'gitconfig.tmpl'): os.path.join(home, '.gitconfig'),
+            }
+            path = os.path.join(tmpdir, 'dotfiles.bundle')
+            missing = bundle.write(
+                path, filemap, rendered={os.path.join(src, 'gitconfig.tmpl'): 'rendered'},
+                home=home
+            )
+            self.assertEqual(missing, [os.path.join(src, 'missing')])
+
+            # Installed into another home
+            other = os.path.join(tmpdir, 'other')
+            os.makedirs(os.path.join(other, '.config'))
+            with patch.dict(os.environ, {'HOME': other}):
+                with bundle.Bundle(path) as archive:
+                    self.assertEqual(archive.entries, [
+                        os.path.join(other, '.rc'), os.path.join(other, '.config', 'app'),
+                        os.path.join(other, '.gitconfig'),
+                    ])
+                    count = archive.extract(skip={os.path.join(other, '.rc')})
+
+            self.assertEqual(count, 2)
+            self.assertFalse(os.path.lexists(os.path.join(other, '.rc')))
+            gitconfig = os.path.join(other, '.gitconfig')
+            with open(gitconfig) as f:
+                self.assertEqual(f.read(), 'rendered')
+            self.assertEqual(stat.S_IMODE(os.stat(gitconfig).st_mode), 0o600)
+            dark = os.path.join(other, '.config', 'app', 'themes', 'dark')
+            with open(dark) as f:
+                self.assertEqual(f.read(), 'dark')
+            self.assertEqual(stat.S_IMODE(os.stat(dark).st_mode), 0o600)
+            self.assertEqual(
+                os.readlink(os.path.join(other, '.config', 'app', 'current')), 'themes/dark'
+            )
+
+    def test_not_a_bundle(self):
+        with test_utils.tempfile_with_content('not a bundle') as tmp:
+            with self.assertRaises(ValueError):
+                bundle.Bundle(tmp)
+
+    @patch('dfman.core.Config')
+    def test_install_bundle(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            make_sources(paths['dotfile_path'])
+            filemap = {
+                os.path.join(paths['dotfile_path'], name): os.path.join(paths['config_path'], name)
+                for name in ('rc', 'app')
+            }
+            with open(os.path.join(paths['config_path'], 'rc'), 'w') as f:
+                f.write('original')
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.getboolean.return_value = False
+
+            runtime = core.MainRuntime(False, False)
+            path = os.path.join(tmpdir, 'dotfiles.bundle')
+            with patch.object(runtime, 'get_filemap', return_value=filemap):
+                runtime.create_bundle(path)
+            runtime.install_bundle(path)
+
+            with open(os.path.join(paths['backup_path'], 'rc')) as f:
+                self.assertEqual(f.read(), 'original')
+            with open(os.path.join(paths['config_path'], 'rc')) as f:
+                self.assertEqual(f.read(), 'rc')
+            self.assertTrue(os.path.isdir(os.path.join(paths['config_path'], 'app', 'themes')))
+
+            # Uninstall needs neither the sources nor the filemap
+            shutil.rmtree(paths['dotfile_path'])
+            os.makedirs(paths['dotfile_path'])
+            dark = os.path.join(paths['config_path'], 'app', 'themes', 'dark')
+            with open(dark, 'w') as f:
+                f.write('mine')
+            runtime = core.MainRuntime(False, False)
+            with patch.object(runtime, 'get_filemap', return_value={}):
+                runtime.uninstall_dotfiles()
+
+            with open(os.path.join(paths['config_path'], 'rc')) as f:
+                self.assertEqual(f.read(), 'original')
+            # Changed files are kept with the directories holding them
+            self.assertEqual(os.listdir(os.path.join(paths['config_path'], 'app')), ['themes'])
+            with open(dark) as f:
+                self.assertEqual(f.read(), 'mine')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 """Test config module"""
 
 
+import configparser
 import os
 import tempfile
 import unittest
@@ -65,6 +66,139 @@ testvalue = 123
 
             self.assertEqual(dict(result), expected_items)
 
+    def test_compiled_cache(self):
+        test_config = \
+'''
+[Globals]
+verbose = true
+
+[Overrides]
+file1 = ~/file1
+'''
+        with test_utils.tempfile_with_content(test_config) as tmp:
+            config_ = dfman.Config()
+            config_.cfg_file = tmp
+            config_.load_cfg()
+
+            self.assertTrue(os.path.isfile(config_.cache_file()))
+            self.assertTrue(config_.getboolean('Globals', 'verbose'))
+            self.assertEqual(
+                config_.pathitems('Overrides'),
+                {'file1': os.path.join(os.environ.get('HOME'), 'file1')}
+            )
+
+            # A current cache is used without parsing the config file
+            config_ = dfman.Config()
+            config_.cfg_file = tmp
+            with patch.object(config_, 'parser') as mock_parser:
+                config_.load_cfg()
+
+            mock_parser.assert_not_called()
+            self.assertEqual(config_.items('Overrides'), [('file1', '~/file1')])
+
+            # Changing the config file invalidates the cache
+            with open(tmp, 'a') as f:
+                f.write('file2 = ~/file2\n')
+            config_ = dfman.Config()
+            config_.cfg_file = tmp
+            config_.load_cfg()
+
+            self.assertEqual(config_.get('Overrides', 'file2'), '~/file2')
+
+    def test_rehome(self):
+        test_config = \
+'''
+[Globals]
+dotfile_path = ~/dotfiles
+
+[Overrides]
+file1 = ~/file1
+file2 = /etc/file2
+'''
+        with test_utils.tempfile_with_content(test_config) as tmp:
+            config_ = dfman.Config()
+            config_.cfg_file = tmp
+            config_.load_cfg()
+
+            rehomed = config_.rehome('/home/other', keep=[('Globals', 'dotfile_path')])
+
+            self.assertEqual(
+                rehomed.getpath('Globals', 'dotfile_path'),
+                os.path.join(os.environ.get('HOME'), 'dotfiles')
+            )
+            self.assertEqual(rehomed.getpath('Globals', 'config_path'), '/home/other/.config')
+            self.assertEqual(
+                rehomed.pathitems('Overrides'),
+                {'file1': '/home/other/file1', 'file2': '/etc/file2'}
+            )
+            # The original is unchanged
+            self.assertEqual(
+                config_.getpath('Overrides', 'file1'),
+                os.path.join(os.environ.get('HOME'), 'file1')
+            )
+
+    def test_update_section(self):
+        with test_utils.tempfile_with_content('[Overrides]\nfile1 = ~/file1\n') as tmp:
+            config_ = dfman.Config()
+            config_.cfg_file = tmp
+            config_.load_cfg()
+            with open(tmp, 'a') as f:
+                f.write('file2 = ~/file2\n')
+
+            config_.update_section('Overrides', {'file2': '~/file2'})
+
+            expected = {
+                'file1': os.path.join(os.environ.get('HOME'), 'file1'),
+                'file2': os.path.join(os.environ.get('HOME'), 'file2'),
+            }
+            self.assertEqual(config_.pathitems('Overrides'), expected)
+            # The updated config is cached for the changed file
+            config_ = dfman.Config()
+            config_.cfg_file = tmp
+            with patch.object(config_, 'parser') as mock_parser:
+                config_.load_cfg()
+            mock_parser.assert_not_called()
+            self.assertEqual(config_.pathitems('Overrides'), expected)
+
+    def test_missing_section_and_option(self):
+        config_ = dfman.Config()
+        with self.assertRaises(configparser.NoSectionError):
+            config_.get('Missing', 'value')
+        with test_utils.tempfile_with_content('[Test]\n') as tmp:
+            config_.cfg_file = tmp
+            config_.load_cfg()
+        with self.assertRaises(configparser.NoOptionError):
+            config_.getpath('Test', 'value')
+        # Defaults only fill in Globals
+        with self.assertRaises(configparser.NoOptionError):
+            config_.get('Test', 'loglevel')
+
+    def test_override_named_like_global(self):
+        test_config = \
+'''
+[Globals]
+verbose = true
+
+[Overrides]
+manifest = ~/manifest
+'''
+        with test_utils.tempfile_with_content(test_config) as tmp:
+            config_ = dfman.Config()
+            config_.cfg_file = tmp
+            config_.load_cfg()
+
+            self.assertEqual(config_.get('Globals', 'loglevel'), 'DEBUG')
+            self.assertEqual(config_.items('Globals'), [])
+            self.assertEqual(config_.items('Overrides'), [('manifest', '~/manifest')])
+            self.assertEqual(
+                config_.merged_pathitems(['Overrides']),
+                {'manifest': os.path.join(os.environ.get('HOME'), 'manifest')}
+            )
+            config_.update_section('host:a', {'log': '~/log'})
+            self.assertEqual(config_.items('host:a'), [('log', '~/log')])
+            with self.assertRaises(configparser.NoOptionError):
+                config_.get('host:a', 'loglevel')
+
 
 if __name__ == '__main__':
     unittest.main()
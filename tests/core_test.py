@@ -1,14 +1,24 @@
 """Test core module"""
 
 
+import asyncio
+import io
+import json
 import os
+import stat
 import sys
+import time
 import unittest
 from contextlib import contextmanager
 from mock import call, mock_open, patch
 import test_utils
 from context import dfman
-from dfman import config, const, core
+from dfman import config, const, core, osrelease
+from dfman.plan import Operation, Plan
+
+
+def sorted_json(obj):
+    return json.dumps(obj, sort_keys=True)
 
 
 class TestMainRuntime(unittest.TestCase):
@@ -63,9 +73,21 @@ dotfile_path = srcdir
 [Overrides]
 file1 = dir1/file1
 file2 = dir2/file2
+file3 = dir3/file3
+file4 = dir4/file4
 
 [spooky]
 file2 = distoverride/file2
+
+[spooky-13]
+file3 = releaseoverride/file3
+
+[scary]
+file2 = likeoverride/file2
+file4 = likeoverride/file4
+
+[host:crypt]
+file1 = hostoverride/file1
 '''
         with test_utils.tempfile_with_content(test_config) as tmp:
             config = dfman.Config()
@@ -74,10 +96,28 @@ file2 = distoverride/file2
 
         runtime = dfman.core.MainRuntime(False, False)
         runtime.config = config
+        runtime.release = osrelease.OsRelease('spooky', ['scary'], '13')
+        runtime.hostname = 'crypt'
+        overrides = runtime.get_overrides()
+        self.assertEqual(overrides, {
+            os.path.join('srcdir', 'file1'): 'hostoverride/file1',
+            os.path.join('srcdir', 'file2'): 'distoverride/file2',
+            os.path.join('srcdir', 'file3'): 'releaseoverride/file3',
+            os.path.join('srcdir', 'file4'): 'likeoverride/file4',
+        })
+        # Reused until the config changes
+        self.assertIs(runtime.get_overrides(), overrides)
+        config.update_section('host:crypt', {'file5': 'dir5/file5'})
+        self.assertEqual(
+            runtime.get_overrides()[os.path.join('srcdir', 'file5')], 'dir5/file5'
+        )
+
         runtime.distro = 'spooky'
+        runtime.hostname = 'other'
         overrides = runtime.get_overrides()
         self.assertEqual(overrides[os.path.join('srcdir', 'file1')], 'dir1/file1')
         self.assertEqual(overrides[os.path.join('srcdir', 'file2')], 'distoverride/file2')
+        self.assertEqual(overrides[os.path.join('srcdir', 'file3')], 'dir3/file3')
 
     @patch('dfman.core.os')
     @patch('dfman.core.Config')
@@ -93,43 +133,56 @@ file2 = distoverride/file2
         calls = [call('backup_path'), call('logpath')]
         mock_os.makedirs.assert_has_calls(calls, any_order=True)
 
-    @patch('dfman.core.os.listdir')
     @patch('dfman.core.Config')
     @patch.object(dfman.core.MainRuntime, 'get_overrides')
-    def test_get_filemap(self, mock_overrides, mock_config, mock_listdir):
-        mc = mock_config.return_value
-        mc.getpath.return_value = 'test_path'
-        mock_listdir.return_value = ['1', '2']
-        overrides = {os.path.join('test_path', '1'): os.path.join('test_path', '3')}
-        mock_overrides.return_value = overrides
-        expected = {
-            os.path.join('test_path', '1'): os.path.join('test_path', '3'),
-            os.path.join('test_path', '2'): os.path.join('test_path', '2')
-        }
+    def test_get_filemap(self, mock_overrides, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            mc = mock_config.return_value
+            mc.getpath.return_value = tmpdir
+            for i in ('1', '2'):
+                open(os.path.join(tmpdir, i), 'a').close()
+            overrides = {os.path.join(tmpdir, '1'): os.path.join(tmpdir, '3')}
+            mock_overrides.return_value = overrides
+            expected = {
+                os.path.join(tmpdir, '1'): os.path.join(tmpdir, '3'),
+                os.path.join(tmpdir, '2'): os.path.join(tmpdir, '2')
+            }
 
-        runtime = dfman.core.MainRuntime(False, False)
-        result = runtime.get_filemap()
+            runtime = dfman.core.MainRuntime(False, False)
+            result = runtime.get_filemap()
 
-        self.assertEqual(result, expected)
+            self.assertEqual(result, expected)
+            self.assertEqual(runtime.scanned, {i: False for i in expected})
 
-        # Test that destination overrides work as expected
-        mock_listdir.return_value = ['1', '2', '3']
-        overrides = {os.path.join('test_path', '3'): os.path.join('test_path', '1')}
-        mock_overrides.return_value = overrides
-        expected = {
-            os.path.join('test_path', '3'): os.path.join('test_path', '1'),
-            os.path.join('test_path', '2'): os.path.join('test_path', '2')
-        }
+            # Test that destination overrides work as expected
+            os.makedirs(os.path.join(tmpdir, '3'))
+            overrides = {os.path.join(tmpdir, '3'): os.path.join(tmpdir, '1')}
+            mock_overrides.return_value = overrides
+            expected = {
+                os.path.join(tmpdir, '3'): os.path.join(tmpdir, '1'),
+                os.path.join(tmpdir, '2'): os.path.join(tmpdir, '2')
+            }
 
-        runtime = dfman.core.MainRuntime(False, False)
-        result = runtime.get_filemap()
+            runtime = dfman.core.MainRuntime(False, False)
+            result = runtime.get_filemap()
 
-        self.assertEqual(result, expected)
+            self.assertEqual(result, expected)
+            self.assertTrue(runtime.scanned[os.path.join(tmpdir, '3')])
 
-    @patch('dfman.core.os.path.exists')
+            # Overrides for missing sources come last and are not marked as scanned
+            missing = os.path.join(tmpdir, 'missing')
+            overrides[missing] = os.path.join(tmpdir, 'elsewhere')
+
+            result = list(runtime.iter_filemap())
+
+            self.assertEqual(result[-1], (missing, os.path.join(tmpdir, 'elsewhere')))
+            self.assertNotIn(missing, runtime.scanned)
+            self.assertFalse(runtime.source_exists(missing))
+
+    @patch.object(dfman.core.MainRuntime, 'lexists')
     @patch('dfman.core.Config')
-    @patch('dfman.core.shutil')
-    def test_backup_file(self, mock_shutil, mock_config, mock_exists):
+    @patch('shutil.move')
+    def test_backup_file(self, mock_move, mock_config, mock_exists):
         mc = mock_config.return_value
         mc.getpath.return_value = 'backup_path'
         src = 'src'
@@ -159,7 +212,7 @@ file2 = distoverride/file2
 
         result = runtime.backup_file(dest)
 
-        mock_shutil.move.assert_called_once_with(
+        mock_move.assert_called_once_with(
             'dest', os.path.join('backup_path', 'dest')
         )
         self.assertTrue(result)
@@ -189,12 +242,11 @@ file2 = distoverride/file2
 
     @patch('dfman.core.os')
     @patch('dfman.core.Config')
-    @patch.object(dfman.core.FileOperator, 'move')
-    @patch.object(dfman.core.FileOperator, 'unlink')
+    @patch('dfman.plan.apply_plan')
     @patch.object(dfman.core.MainRuntime, 'get_filemap')
     @patch.object(dfman.core.MainRuntime, 'does_symlink_already_exist')
     def test_uninstall_dotfiles(
-            self, mock_test_symlink, mock_get_filemap, mock_unlink, mock_move, mock_config, mock_os
+            self, mock_test_symlink, mock_get_filemap, mock_apply, mock_config, mock_os
     ):
         mc = mock_config.return_value
         mc.getpath.return_value = 'backup_path'
@@ -216,22 +268,623 @@ file2 = distoverride/file2
 
         runtime.uninstall_dotfiles()
 
-        mock_unlink.assert_not_called()
+        self.assertEqual(list(mock_apply.call_args[0][0]), [])
 
         # symlink and backup exist
         mock_os.path.exists.return_value = True
+        mock_os.lstat.return_value.st_mode = stat.S_IFREG
         mock_test_symlink.return_value = True
         mock_os.path.join.return_value = 'backup_path/file'
 
         runtime.uninstall_dotfiles()
 
-        mock_unlink.assert_called_once_with('config_path/file')
-        mock_move.assert_called_once_with('backup_path/file', 'config_path/file')
+        self.assertEqual(list(mock_apply.call_args[0][0]), [
+            Operation('unlink', None, 'config_path/file'),
+            Operation('move', 'backup_path/file', 'config_path/file'),
+        ])
+
+    @patch('dfman.core.Config')
+    def test_write_plan(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            for i in ('file1', 'file2', 'file3'):
+                open(os.path.join(paths['dotfile_path'], i), 'a').close()
+            src = {i: os.path.join(paths['dotfile_path'], i) for i in ('file1', 'file2', 'file3')}
+            dest = {i: os.path.join(paths['config_path'], i) for i in ('file1', 'file2', 'file3')}
+            open(dest['file2'], 'a').close()
+            os.symlink(src['file3'], dest['file3'])
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.pathitems.return_value = {}
+            mc.has_section.return_value = False
+            mc.getboolean.return_value = False
+
+            runtime = dfman.core.MainRuntime(False, False)
+            out = io.StringIO()
+            with patch('dfman.core.os.lstat', wraps=os.lstat) as mock_lstat:
+                runtime.write_plan(out)
+
+            lstat_paths = [i[0][0] for i in mock_lstat.call_args_list]
+            self.assertEqual(len(lstat_paths), len(set(lstat_paths)))
+            records = [json.loads(line) for line in out.getvalue().splitlines()]
+            backup = os.path.join(paths['backup_path'], 'file2')
+            expected = [
+                {'action': 'link', 'src': src['file1'], 'dest': dest['file1']},
+                {'action': 'backup', 'src': dest['file2'], 'dest': backup},
+                {'action': 'link', 'src': src['file2'], 'dest': dest['file2']},
+                {'action': 'skip', 'src': src['file3'], 'dest': dest['file3'],
+                 'reason': 'linked'},
+            ]
+            # Scan order is arbitrary, but a backup precedes its link
+            self.assertEqual(sorted(records, key=sorted_json), sorted(expected, key=sorted_json))
+            self.assertLess(records.index(expected[1]), records.index(expected[2]))
+            # Nothing was changed on disk
+            self.assertFalse(os.path.lexists(dest['file1']))
+            self.assertFalse(os.path.exists(paths['journal']))
+
+            out = io.StringIO()
+            runtime.write_plan(out, uninstall=True, stream=False)
+
+            self.assertEqual(sorted(json.loads(out.getvalue()), key=sorted_json), sorted([
+                {'action': 'skip', 'src': src[i], 'dest': dest[i], 'reason': 'not linked'}
+                for i in ('file1', 'file2')
+            ] + [
+                {'action': 'unlink', 'src': src['file3'], 'dest': dest['file3']},
+                {'action': 'skip', 'src': os.path.join(paths['backup_path'], 'file3'),
+                 'dest': dest['file3'], 'reason': 'no backup'},
+            ], key=sorted_json))
+
+    def test_schedule_waves(self):
+        filemap = {
+            'src/a': '/home/a',
+            'src/b': '/home/a/b',
+            'src/c': '/home/c',
+            'src/d': '/home/a/b/d',
+        }
+        expected = [
+            [('src/a', '/home/a'), ('src/c', '/home/c')],
+            [('src/b', '/home/a/b')],
+            [('src/d', '/home/a/b/d')],
+        ]
+
+        self.assertEqual(dfman.core.MainRuntime.schedule_waves(filemap), expected)
+
+    @patch('dfman.core.Config')
+    def test_run_entries_async(self, _):
+        # A nested destination comes first in filemap order
+        filemap = {'src/b': '/home/a/b', 'src/a': '/home/a', 'src/c': '/home/c'}
+        started, finished = [], []
+
+        def func(src, dest, log, plan):
+            started.append(dest)
+            if dest == '/home/a':
+                time.sleep(0.05)
+            finished.append(dest)
+            log.debug('Linked: %s', dest)
+            plan.symlink(src, dest)
+
+        runtime = dfman.core.MainRuntime(False, False, jobs=3, engine='async')
+        with patch.object(dfman.core.LOG, 'log') as mock_log:
+            plan = runtime.run_entries(func, filemap.items())
+
+        self.assertLess(finished.index('/home/a'), started.index('/home/a/b'))
+        # Unrelated entries don't wait for a slow one
+        self.assertLess(finished.index('/home/c'), finished.index('/home/a'))
+        # Parents come first, as with the threads engine
+        order = ['/home/a', '/home/c', '/home/a/b']
+        self.assertEqual([op.dest for op in plan], order)
+        self.assertEqual([i[0][2] for i in mock_log.call_args_list], order)
+
+    @patch('dfman.core.Config')
+    def test_run_entries_async_in_loop(self, _):
+        runtime = dfman.core.MainRuntime(False, False, jobs=2, engine='async')
+
+        async def caller():
+            return runtime.run_entries(
+                lambda src, dest, log, plan: plan.symlink(src, dest),
+                [('src/a', '/home/a'), ('src/b', '/home/b')]
+            )
+
+        plan = asyncio.run(caller())
+        self.assertEqual([op.dest for op in plan], ['/home/a', '/home/b'])
+
+    @patch('dfman.core.Config')
+    def test_run_entries_engines(self, _):
+        filemap = {
+            'src/d': '/home/a/b/d', 'src/b': '/home/a/b', 'src/e': '/home/e',
+            'src/a': '/home/a', 'src/c': '/home/a/c',
+        }
+
+        def func(src, dest, log, plan):
+            plan.mkdir(dest)
+            plan.symlink(src, os.path.join(dest, 'link'))
+
+        plans = [
+            dfman.core.MainRuntime(False, False, jobs=3, engine=engine).run_entries(
+                func, filemap.items()
+            )
+            for engine in dfman.core.ENGINES
+        ]
+        self.assertEqual(plans[0].operations, plans[1].operations)
+        self.assertEqual(
+            [op.dest for op in plans[0] if op.kind == 'mkdir'],
+            ['/home/e', '/home/a', '/home/a/b', '/home/a/c', '/home/a/b/d']
+        )
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_parallel(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            filemap = {}
+            for i in range(20):
+                src = os.path.join(paths['dotfile_path'], 'file%d' % i)
+                open(src, 'a').close()
+                filemap[src] = os.path.join(paths['config_path'], 'file%d' % i)
+            # One destination already exists and must be backed up
+            open(filemap[src], 'a').close()
+            mock_config.return_value.getpath.side_effect = lambda _, key: paths[key]
+            mock_config.return_value.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mock_config.return_value.getboolean.return_value = False
+
+            runtime = dfman.core.MainRuntime(False, False, jobs=4)
+            profiler = runtime.enable_profiling()
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()), \
+                    patch.object(dfman.core.LOG, 'log') as mock_log:
+                runtime.install_dotfiles()
+
+            for src, dest in filemap.items():
+                self.assertEqual(os.path.realpath(dest), src)
+            self.assertTrue(os.path.isfile(os.path.join(paths['backup_path'], 'file19')))
+            spans = profiler.summary()['spans']
+            self.assertEqual(spans['plan_install']['count'], 1)
+            self.assertEqual(spans['check_link']['count'], 20)
+            self.assertEqual(spans['symlink']['count'], 20)
+            self.assertEqual(spans['move']['count'], 1)
+            self.assertGreater(profiler.summary()['counters']['lstat'], 0)
+            linked = [
+                i[0][3] for i in mock_log.call_args_list if i[0][1].startswith('Linked')
+            ]
+            self.assertEqual(linked, list(filemap.values()))
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_backup_store(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            # Two existing destinations share a basename
+            filemap = {}
+            for name in ('a', 'b'):
+                src = os.path.join(paths['dotfile_path'], name)
+                open(src, 'a').close()
+                dest = os.path.join(paths['config_path'], name, 'rc')
+                os.makedirs(os.path.dirname(dest))
+                with open(dest, 'w') as f:
+                    f.write(name)
+                filemap[src] = dest
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = True
+
+            runtime = dfman.core.MainRuntime(False, False)
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()), \
+                    patch.object(runtime, 'get_filemap', return_value=filemap):
+                runtime.install_dotfiles()
+                for src, dest in filemap.items():
+                    self.assertEqual(os.readlink(dest), src)
+                runtime.uninstall_dotfiles()
+
+            for name, dest in zip(('a', 'b'), filemap.values()):
+                with open(dest) as f:
+                    self.assertEqual(f.read(), name)
+            self.assertEqual(runtime.backups.index, {})
+
+    @patch('dfman.core.Config')
+    def test_uninstall_dotfiles_indexed(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            src = os.path.join(paths['dotfile_path'], 'file')
+            dest = os.path.join(paths['config_path'], 'rc')
+            open(src, 'a').close()
+            with open(dest, 'w') as f:
+                f.write('original')
+            filemap = {src: dest}
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = False
+
+            runtime = dfman.core.MainRuntime(False, False, jobs=2)
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()):
+                runtime.install_dotfiles()
+
+            backup = os.path.join(paths['backup_path'], 'rc')
+            self.assertEqual(runtime.backups.index, {dest: backup})
+
+            # The backup is found by destination without probing backup_path
+            runtime = dfman.core.MainRuntime(False, False, jobs=2)
+            with patch.object(runtime, 'get_filemap', return_value=filemap), \
+                    patch.object(runtime, 'exists') as mock_exists:
+                runtime.uninstall_dotfiles()
+
+            mock_exists.assert_not_called()
+            with open(dest) as f:
+                self.assertEqual(f.read(), 'original')
+            self.assertEqual(runtime.backups.index, {})
+
+    @patch('dfman.core.Config')
+    def test_uninstall_dotfiles_index_json(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            # A dotfile named like the backup index
+            src = os.path.join(paths['dotfile_path'], 'index.json')
+            dest = os.path.join(paths['config_path'], 'index.json')
+            open(src, 'a').close()
+            with open(dest, 'w') as f:
+                f.write('original')
+            filemap = {src: dest}
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = False
+
+            runtime = dfman.core.MainRuntime(False, False)
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()), \
+                    patch.object(runtime, 'get_filemap', return_value=filemap):
+                runtime.install_dotfiles()
+                with open(os.path.join(paths['backup_path'], 'index.json')) as f:
+                    self.assertEqual(f.read(), 'original')
+                runtime.uninstall_dotfiles()
+
+            with open(dest) as f:
+                self.assertEqual(f.read(), 'original')
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_tree(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            src = os.path.join(paths['dotfile_path'], 'app')
+            dest = os.path.join(paths['config_path'], 'app')
+            os.makedirs(os.path.join(src, 'themes'))
+            for name in ('config', os.path.join('themes', 'dark')):
+                open(os.path.join(src, name), 'a').close()
+            # The application keeps state next to the managed files
+            os.makedirs(dest)
+            open(os.path.join(dest, 'state'), 'a').close()
+            filemap = {src: dest}
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.get.side_effect = lambda _, key: 'tree'
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = False
+
+            runtime = dfman.core.MainRuntime(False, False)
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()), \
+                    patch.object(runtime, 'get_filemap', return_value=filemap):
+                runtime.install_dotfiles()
+                self.assertFalse(os.path.islink(dest))
+                self.assertFalse(os.path.islink(os.path.join(dest, 'themes')))
+                for name in ('config', os.path.join('themes', 'dark')):
+                    self.assertEqual(
+                        os.readlink(os.path.join(dest, name)), os.path.join(src, name)
+                    )
+                self.assertEqual(len(runtime.install_dotfiles()), 0)
+
+                runtime.uninstall_dotfiles()
+                self.assertEqual(os.listdir(dest), ['state'])
+
+                # Folding links directories as a whole where nothing else is
+                os.remove(os.path.join(dest, 'state'))
+                runtime.install_dotfiles()
+                mc.get.side_effect = lambda _, key: 'fold'
+                plan = runtime.install_dotfiles()
+                self.assertEqual([op.kind for op in plan].count('rmdir'), 2)
+                self.assertEqual(os.readlink(dest), src)
+
+                runtime.uninstall_dotfiles()
+                self.assertFalse(os.path.lexists(dest))
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_copy(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            src = os.path.join(paths['dotfile_path'], 'app')
+            dest = os.path.join(paths['config_path'], 'app')
+            os.makedirs(os.path.join(src, 'themes'))
+            for name in ('config', os.path.join('themes', 'dark')):
+                with open(os.path.join(src, name), 'w') as f:
+                    f.write(name)
+            filemap = {src: dest}
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.get.side_effect = lambda _, key: {'install_mode': 'copy'}.get(key, 'entry')
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = False
+
+            runtime = dfman.core.MainRuntime(False, False, jobs=2)
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()), \
+                    patch.object(runtime, 'get_filemap', return_value=filemap):
+                plan = runtime.install_dotfiles()
+                self.assertEqual(sorted(op.kind for op in plan), ['copy', 'copy', 'mkdir', 'mkdir'])
+                self.assertFalse(os.path.islink(os.path.join(dest, 'config')))
+                with open(os.path.join(dest, 'themes', 'dark')) as f:
+                    self.assertEqual(f.read(), os.path.join('themes', 'dark'))
+
+                # Only changed files are copied again
+                with open(os.path.join(src, 'config'), 'w') as f:
+                    f.write('changed')
+                plan = runtime.install_dotfiles()
+                self.assertEqual(list(plan), [
+                    Operation('copy', os.path.join(src, 'config'), os.path.join(dest, 'config'))
+                ])
+
+                # Locally modified files survive an uninstall
+                with open(os.path.join(dest, 'themes', 'dark'), 'a') as f:
+                    f.write('modified')
+                runtime.uninstall_dotfiles()
+                self.assertEqual(os.listdir(dest), ['themes'])
+                self.assertEqual(os.listdir(os.path.join(dest, 'themes')), ['dark'])
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_template(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path', 'render_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            src = os.path.join(paths['dotfile_path'], 'gitconfig.tmpl')
+            dest = os.path.join(paths['config_path'], 'gitconfig')
+            output = os.path.join(paths['render_path'], 'gitconfig')
+            with open(src, 'w') as f:
+                f.write('$email on $distro\n')
+            filemap = {src: dest}
+            variables = {'email': 'a@example.com'}
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = False
+            mc.has_section.side_effect = lambda section: section == 'Variables'
+            mc.items.side_effect = lambda _: list(variables.items())
+
+            runtime = dfman.core.MainRuntime(False, False)
+            runtime.distro = 'spooky'
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()), \
+                    patch.object(runtime, 'get_filemap', return_value=filemap):
+                runtime.install_dotfiles()
+                self.assertEqual(os.readlink(dest), output)
+                with open(dest) as f:
+                    self.assertEqual(f.read(), 'a@example.com on spooky\n')
+                self.assertEqual(len(runtime.install_dotfiles()), 0)
+
+                variables['email'] = 'b@example.com'
+                plan = runtime.install_dotfiles()
+                self.assertEqual([op.kind for op in plan], ['render'])
+                with open(dest) as f:
+                    self.assertEqual(f.read(), 'b@example.com on spooky\n')
+
+                runtime.uninstall_dotfiles()
+                self.assertFalse(os.path.lexists(dest))
+
+            # Unreadable templates are skipped like those which don't render
+            broken = os.path.join(paths['dotfile_path'], 'broken.tmpl')
+            os.makedirs(broken)
+            plan = Plan()
+            self.assertIsNone(runtime.render_template(broken, dest, dfman.core.LOG, plan))
+            self.assertEqual([op.reason for op in plan.records], ['render failed'])
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_copy_template(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            # Doesn't exist before the first render
+            paths['render_path'] = os.path.join(tmpdir, 'rendered')
+            src = os.path.join(paths['dotfile_path'], 'gitconfig.tmpl')
+            dest = os.path.join(paths['config_path'], 'gitconfig')
+            with open(src, 'w') as f:
+                f.write('$email\n')
+            filemap = {src: dest}
+            variables = {'email': 'a@example.com'}
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.get.side_effect = lambda _, key: {'install_mode': 'copy'}.get(key, 'entry')
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = False
+            mc.has_section.side_effect = lambda section: section == 'Variables'
+            mc.items.side_effect = lambda _: list(variables.items())
+
+            runtime = dfman.core.MainRuntime(False, False, jobs=2)
+            with patch.object(runtime, 'iter_filemap', return_value=filemap.items()), \
+                    patch.object(runtime, 'get_filemap', return_value=filemap):
+                plan = runtime.install_dotfiles()
+                self.assertEqual([op.kind for op in plan], ['render', 'copy'])
+                self.assertFalse(os.path.islink(dest))
+                with open(dest) as f:
+                    self.assertEqual(f.read(), 'a@example.com\n')
+                self.assertEqual(len(runtime.install_dotfiles()), 0)
+
+                variables['email'] = 'b@example.com'
+                plan = runtime.install_dotfiles()
+                self.assertEqual([op.kind for op in plan], ['render', 'copy'])
+                with open(dest) as f:
+                    self.assertEqual(f.read(), 'b@example.com\n')
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_incremental(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            open(os.path.join(paths['dotfile_path'], 'file1'), 'a').close()
+            mock_config.return_value.getpath.side_effect = lambda _, key: paths[key]
+            mock_config.return_value.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mock_config.return_value.pathitems.return_value = {}
+            mock_config.return_value.getboolean.return_value = False
+
+            runtime = dfman.core.MainRuntime(False, False)
+            runtime.distro = None
+            runtime.install_dotfiles()
+
+            self.assertTrue(os.path.islink(os.path.join(paths['config_path'], 'file1')))
+            self.assertTrue(os.path.isfile(paths['manifest']))
+
+            # Nothing changed, so neither the filemap nor the links are rebuilt
+            with patch.object(runtime, 'iter_filemap') as mock_iter_filemap, \
+                    patch.object(runtime, 'does_symlink_already_exist') as mock_test_symlink:
+                runtime.install_dotfiles()
+
+            mock_iter_filemap.assert_not_called()
+            mock_test_symlink.assert_not_called()
+
+            # A new dotfile invalidates the stored filemap
+            open(os.path.join(paths['dotfile_path'], 'file2'), 'a').close()
+            runtime.install_dotfiles()
+
+            self.assertTrue(os.path.islink(os.path.join(paths['config_path'], 'file2')))
+
+            # A symlink to nothing is skipped as a missing source
+            os.symlink('nowhere', os.path.join(paths['dotfile_path'], 'dangling'))
+            plan = runtime.install_dotfiles()
+
+            self.assertIn('missing', [op.reason for op in plan.records])
+            self.assertFalse(os.path.lexists(os.path.join(paths['config_path'], 'dangling')))
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_other_host(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            src = os.path.join(paths['dotfile_path'], 'rc')
+            open(src, 'a').close()
+            alt = os.path.join(tmpdir, 'alt', 'rc')
+            os.makedirs(os.path.dirname(alt))
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            mc.getboolean.return_value = False
+            mc.merged_pathitems.side_effect = \
+                lambda sections: {'rc': alt} if 'host:b' in sections else {}
+
+            # The manifest in the shared home was written on another host
+            runtime = dfman.core.MainRuntime(False, False)
+            runtime.distro = None
+            runtime.hostname = 'a'
+            runtime.install_dotfiles()
+            self.assertEqual(os.readlink(os.path.join(paths['config_path'], 'rc')), src)
+
+            runtime = dfman.core.MainRuntime(False, False)
+            runtime.distro = None
+            runtime.hostname = 'b'
+            runtime.install_dotfiles()
+            self.assertEqual(os.readlink(alt), src)
+
+    @patch('dfman.core.Config')
+    def test_install_dotfiles_dangling_link(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'backup_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            paths['journal'] = os.path.join(tmpdir, 'journal')
+            src = os.path.join(paths['dotfile_path'], 'rc')
+            open(src, 'a').close()
+            dest = os.path.join(paths['config_path'], 'rc')
+            os.symlink('nowhere', dest)
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.getboolean.return_value = False
+            mc.merged_pathitems.return_value = {}
+
+            runtime = dfman.core.MainRuntime(False, False)
+            runtime.distro = None
+            runtime.install_dotfiles()
+            self.assertEqual(os.readlink(dest), src)
+            backup = os.path.join(paths['backup_path'], 'rc')
+            self.assertEqual(os.readlink(backup), 'nowhere')
+
+            runtime = dfman.core.MainRuntime(False, False)
+            runtime.distro = None
+            runtime.uninstall_dotfiles()
+            self.assertEqual(os.readlink(dest), 'nowhere')
+            self.assertFalse(os.path.lexists(backup))
 
     @patch('dfman.core.os.path.exists')
     @patch('dfman.core.Config')
     @patch.object(dfman.core.FileOperator, 'move')
-    @patch.object(dfman.core.MainRuntime, 'add_file_to_overrides')
+    @patch.object(dfman.core.MainRuntime, 'add_files_to_overrides')
     def test_add_file(self, mock_add_override, mock_move, mock_config, mock_exists):
         mc = mock_config.return_value
         mc.getpath.side_effect = ['dotfile_path', 'config_path']
@@ -255,7 +908,7 @@ file2 = distoverride/file2
 
         runtime.add_file('test')
 
-        mock_add_override.assert_called_once_with('test')
+        mock_add_override.assert_called_once_with(['test'])
         mock_move.assert_called_once_with('test', os.path.join('dotfile_path', 'test'))
 
         # added file exists, is in default path, and file not in tracking
@@ -271,6 +924,65 @@ file2 = distoverride/file2
             'config_path/test', os.path.join('dotfile_path', 'test')
         )
 
+    @patch('dfman.core.Config')
+    def test_add_files(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {i: os.path.join(tmpdir, i) for i in ('dotfile_path', 'config_path', 'other')}
+            for path in paths.values():
+                os.makedirs(path)
+            for name in ('a.conf', 'b.conf', 'c.txt'):
+                open(os.path.join(paths['other'], name), 'a').close()
+            open(os.path.join(paths['config_path'], 'd'), 'a').close()
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            cfg_file = os.path.join(tmpdir, const.CFG)
+            with open(cfg_file, 'w') as f:
+                f.write('[Overrides]\nexisting = 1\n')
+
+            runtime = dfman.core.MainRuntime(False, False, jobs=4)
+            with patch.object(const, 'USER_PATH', tmpdir), \
+                    patch.object(runtime.fileop, 'writelines') as mock_writelines:
+                # Nothing is moved if any path can't be added
+                with self.assertRaises(FileNotFoundError):
+                    runtime.add_files([os.path.join(paths['other'], '*.conf'), 'missing'])
+                self.assertEqual(os.listdir(paths['dotfile_path']), [])
+
+                runtime.add_files([
+                    os.path.join(paths['other'], '*.conf'), os.path.join(paths['config_path'], 'd')
+                ])
+
+            mock_writelines.assert_not_called()
+            self.assertEqual(
+                sorted(os.listdir(paths['dotfile_path'])), ['a.conf', 'b.conf', 'd']
+            )
+            with open(cfg_file) as f:
+                self.assertEqual(f.read(), '[Overrides]\n%s\n%s\nexisting = 1\n' % (
+                    'a.conf = %s' % os.path.join(paths['other'], 'a.conf'),
+                    'b.conf = %s' % os.path.join(paths['other'], 'b.conf'),
+                ))
+            # The loaded config is updated in place
+            mc.update_section.assert_called_once_with('Overrides', {
+                'a.conf': os.path.join(paths['other'], 'a.conf'),
+                'b.conf': os.path.join(paths['other'], 'b.conf'),
+            })
+
+            # Overrides of the files moved before a move failed are kept
+            open(os.path.join(paths['other'], 'e.txt'), 'a').close()
+            move = runtime.fileop.move
+
+            def failing_move(src, dest):
+                if src.endswith('e.txt'):
+                    raise PermissionError(src)
+                move(src, dest)
+
+            with patch.object(const, 'USER_PATH', tmpdir), \
+                    patch.object(runtime.fileop, 'move', failing_move):
+                with self.assertRaises(PermissionError):
+                    runtime.add_files([os.path.join(paths['other'], '*.txt')])
+            with open(cfg_file) as f:
+                self.assertIn('c.txt = %s\n' % os.path.join(paths['other'], 'c.txt'), f.read())
+            self.assertIn('c.txt', os.listdir(paths['dotfile_path']))
+
     @patch('dfman.core.os.path.basename')
     @patch('dfman.core.Config')
     def test_add_file_to_overrides(self, mock_config, mock_basename):
@@ -311,19 +1023,19 @@ existing_value = 123
 
 class TestFileOperator(unittest.TestCase):
 
-    @patch('dfman.core.shutil')
-    def test_move(self, mock_shutil):
+    @patch('shutil.move')
+    def test_move(self, mock_move):
         dry_run = True
         fileop = dfman.core.FileOperator(dry_run)
         fileop.move('src', 'dest')
 
-        mock_shutil.move.assert_not_called()
+        mock_move.assert_not_called()
 
         dry_run = False
         fileop = dfman.core.FileOperator(dry_run)
         fileop.move('src', 'dest')
 
-        mock_shutil.move.assert_called_once_with('src', 'dest')
+        mock_move.assert_called_once_with('src', 'dest')
 
 
 if __name__ == '__main__':
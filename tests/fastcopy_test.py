@@ -0,0 +1,65 @@
+"""Test fastcopy module"""
+
+
+import errno
+import os
+import stat
+import unittest
+from mock import patch
+import test_utils
+from context import dfman
+from dfman import fastcopy
+
+
+def unsupported(*args, **kwargs):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+class TestFastCopy(unittest.TestCase):
+
+    def test_copy_file(self):
+        with test_utils.temp_directory() as tmpdir:
+            src = os.path.join(tmpdir, 'src')
+            dest = os.path.join(tmpdir, 'dest')
+            with open(src, 'wb') as f:
+                f.write(os.urandom(3 * fastcopy.CHUNK_SIZE + 1))
+            os.chmod(src, 0o640)
+            with open(dest, 'w') as f:
+                f.write('old')
+
+            fastcopy.copy_file(src, dest)
+
+            with open(src, 'rb') as f, open(dest, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+            self.assertEqual(stat.S_IMODE(os.stat(dest).st_mode), 0o640)
+            self.assertTrue(fastcopy.is_copy(os.stat(src), os.lstat(dest)))
+            # No temporary file is left behind
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['dest', 'src'])
+
+    def test_copy_data_fallbacks(self):
+        content = os.urandom(2 * fastcopy.CHUNK_SIZE + 5)
+        for disabled in (
+                ('_reflink',),
+                ('_reflink', '_copy_file_range'),
+                ('_reflink', '_copy_file_range', '_sendfile'),
+        ):
+            with test_utils.temp_directory() as tmpdir:
+                src = os.path.join(tmpdir, 'src')
+                dest = os.path.join(tmpdir, 'dest')
+                with open(src, 'wb') as f:
+                    f.write(content)
+                patches = [patch.object(fastcopy, name, unsupported) for name in disabled]
+                for i in patches:
+                    i.start()
+                try:
+                    with open(src, 'rb') as f, open(dest, 'wb') as g:
+                        fastcopy.copy_data(f.fileno(), g.fileno(), len(content))
+                finally:
+                    for i in patches:
+                        i.stop()
+                with open(dest, 'rb') as f:
+                    self.assertEqual(f.read(), content, disabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
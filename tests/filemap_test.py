@@ -0,0 +1,75 @@
+"""Test filemap module"""
+
+
+import os
+import unittest
+from context import dfman
+from dfman.filemap import FileMap
+
+
+class TestFileMap(unittest.TestCase):
+
+    def test_add_and_lookup(self):
+        filemap = FileMap('/src')
+        self.assertTrue(filemap.add('/src/a', '/home/.config/a'))
+        self.assertTrue(filemap.add('/src/b', '/home/.config/b'))
+        self.assertTrue(filemap.add('/other/c', '/home/c', override=True))
+
+        self.assertEqual(filemap['/src/a'], '/home/.config/a')
+        self.assertIn('/other/c', filemap)
+        self.assertEqual(len(filemap), 3)
+        self.assertEqual(
+            filemap,
+            {'/src/a': '/home/.config/a', '/src/b': '/home/.config/b', '/other/c': '/home/c'}
+        )
+        self.assertEqual(filemap.source('/home/.config/b'), '/src/b')
+        self.assertIsNone(filemap.source('/home/.config/c'))
+        self.assertEqual(
+            sorted(filemap.children('/home/.config')),
+            [('/src/a', '/home/.config/a'), ('/src/b', '/home/.config/b')]
+        )
+        self.assertTrue(filemap.is_override('/other/c'))
+
+        filemap.remove('/src/a')
+
+        self.assertNotIn('/src/a', filemap)
+        self.assertIsNone(filemap.source('/home/.config/a'))
+
+    def test_conflicts(self):
+        filemap = FileMap('/src')
+        filemap.add('/src/a', '/home/a')
+
+        # An override replaces a default with the same destination
+        self.assertTrue(filemap.add('/src/b', '/home/a', override=True))
+        self.assertEqual(filemap, {'/src/b': '/home/a'})
+
+        # A default can't replace an override
+        self.assertFalse(filemap.add('/src/c', '/home/a'))
+
+        # Two overrides for one destination keep the first
+        self.assertFalse(filemap.add('/src/d', '/home/a', override=True))
+
+        self.assertEqual(filemap, {'/src/b': '/home/a'})
+        self.assertEqual(filemap.conflicts, [
+            ('shadowed', '/home/a', '/src/b', '/src/a'),
+            ('shadowed', '/home/a', '/src/b', '/src/c'),
+            ('duplicate', '/home/a', '/src/b', '/src/d'),
+        ])
+
+    def test_readd_source(self):
+        filemap = FileMap('/src')
+        filemap.add('/src/a', '/home/a')
+        filemap.add('/src/a', '/home/b', override=True)
+
+        self.assertEqual(filemap, {'/src/a': '/home/b'})
+        self.assertIsNone(filemap.source('/home/a'))
+
+        # A clashing destination keeps the earlier mapping
+        filemap.add('/src/c', '/home/c', override=True)
+        self.assertFalse(filemap.add('/src/a', '/home/c'))
+        self.assertEqual(filemap, {'/src/a': '/home/b', '/src/c': '/home/c'})
+        self.assertEqual(filemap.source('/home/b'), '/src/a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Test fleet module"""
+
+
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman import fleet
+
+
+class TestFleet(unittest.TestCase):
+
+    def test_run(self):
+        with test_utils.temp_directory() as tmpdir:
+            dotfile_path = os.path.join(tmpdir, 'dotfiles')
+            os.makedirs(dotfile_path)
+            for name in ('file1', 'file2'):
+                open(os.path.join(dotfile_path, name), 'a').close()
+            cfg_file = os.path.join(tmpdir, 'dfman.conf')
+            with open(cfg_file, 'w') as f:
+                f.write(
+                    '[Globals]\ndotfile_path = %s\n\n[Overrides]\nfile2 = ~/file2\n'
+                    % dotfile_path
+                )
+            homes = [os.path.join(tmpdir, name) for name in ('home1', 'home2')]
+            for home in homes:
+                os.makedirs(os.path.join(home, '.config'))
+            with open(os.path.join(homes[0], '.config', 'file1'), 'w') as f:
+                f.write('existing')
+            # A home which can't be set up fails on its own
+            broken = os.path.join(tmpdir, 'broken')
+            open(broken, 'a').close()
+
+            runtime = dfman.core.MainRuntime(False, False)
+            runtime.config.cfg_file = cfg_file
+            runtime.config.load_cfg()
+            runtime.distro = None
+            summaries = fleet.Fleet(runtime, homes + [broken], processes=2).run('install')
+
+            self.assertEqual([i['home'] for i in summaries], homes + [broken])
+            for home in homes:
+                self.assertEqual(
+                    os.readlink(os.path.join(home, '.config', 'file1')),
+                    os.path.join(dotfile_path, 'file1')
+                )
+                self.assertEqual(
+                    os.readlink(os.path.join(home, 'file2')),
+                    os.path.join(dotfile_path, 'file2')
+                )
+                self.assertTrue(os.path.isfile(os.path.join(home, '.dfman', 'manifest.json')))
+            self.assertEqual(summaries[0]['link'], 2)
+            self.assertEqual(summaries[0]['backup'], 1)
+            self.assertNotIn('backup', summaries[1])
+            self.assertIsNotNone(summaries[2]['error'])
+            self.assertEqual(fleet.Fleet.report(summaries), 1)
+
+            summaries = fleet.Fleet(runtime, homes, processes=1).run('uninstall')
+
+            self.assertEqual([i['unlink'] for i in summaries], [2, 2])
+            with open(os.path.join(homes[0], '.config', 'file1')) as f:
+                self.assertEqual(f.read(), 'existing')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""Test logs module"""
+
+
+import json
+import logging
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman import logs
+
+
+class TestLogs(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.NOTSET)
+        self.logger = logging.getLogger('dfman.test_logs')
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        logging.disable(logging.CRITICAL)
+
+    def test_pipeline_json(self):
+        with test_utils.temp_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'dfman.log')
+            handler = logs.BufferedFileHandler(path)
+            handler.setFormatter(logs.JsonFormatter())
+            handler.setLevel(logging.INFO)
+            pipeline = logs.LogPipeline(self.logger, [handler])
+            pipeline.start()
+            self.assertIn(pipeline.handler, self.logger.handlers)
+            self.logger.debug('Filtered: %s', 'a')
+            self.logger.info('Linked: %s to %s', 'a', 'b', extra=logs.fields('link', 'a', 'b'))
+            self.logger.info('Plain')
+            pipeline.close()
+
+            with open(path) as f:
+                records = [json.loads(line) for line in f]
+
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['message'], 'Linked: a to b')
+        self.assertEqual(
+            (records[0]['op'], records[0]['src'], records[0]['dest']), ('link', 'a', 'b')
+        )
+        self.assertNotIn('op', records[1])
+        self.assertNotIn(pipeline.handler, self.logger.handlers)
+        self.assertNotIn(handler, self.logger.handlers)
+
+    def test_buffered_file_handler(self):
+        with test_utils.temp_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'dfman.log')
+            handler = logs.BufferedFileHandler(path)
+            self.logger.addHandler(handler)
+            try:
+                self.logger.debug('buffered')
+                self.assertEqual(os.path.getsize(path), 0)
+                # Warnings are written out right away, with everything before them
+                self.logger.warning('flushed')
+                with open(path) as f:
+                    self.assertEqual(f.read(), 'buffered\nflushed\n')
+            finally:
+                self.logger.removeHandler(handler)
+                handler.close()
+
+    def test_detach(self):
+        with test_utils.temp_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'dfman.log')
+            handler = logs.BufferedFileHandler(path)
+            pipeline = logs.LogPipeline(self.logger, [handler])
+            pipeline.start()
+            pipeline.stop()
+            pipeline.detach()
+
+            self.assertIn(handler, self.logger.handlers)
+            self.assertNotIn(pipeline.handler, self.logger.handlers)
+            self.logger.info('direct')
+            pipeline.close()
+            self.assertNotIn(handler, self.logger.handlers)
+            with open(path) as f:
+                self.assertEqual(f.read(), 'direct\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
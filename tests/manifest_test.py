@@ -0,0 +1,74 @@
+"""Test manifest module"""
+
+
+import json
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman import manifest
+
+
+class TestManifest(unittest.TestCase):
+
+    def test_load_missing_or_invalid(self):
+        with test_utils.temp_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'manifest.json')
+            manifest_ = manifest.Manifest()
+            manifest_.load(path)
+
+            self.assertEqual(manifest_.data, manifest.Manifest.empty())
+
+            with open(path, 'w') as f:
+                f.write('not json')
+            manifest_.load(path)
+
+            self.assertEqual(manifest_.data, manifest.Manifest.empty())
+
+    def test_record_and_save(self):
+        with test_utils.temp_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'manifest.json')
+            src = os.path.join(tmpdir, 'src')
+            dest = os.path.join(tmpdir, 'dest')
+            open(src, 'a').close()
+            os.symlink(src, dest)
+
+            manifest_ = manifest.Manifest()
+            manifest_.load(path)
+            manifest_.record_backup(dest, 'backup')
+            manifest_.record(src, dest, 'linked')
+            manifest_.save()
+
+            with open(path) as f:
+                entry = json.load(f)['entries'][dest]
+            self.assertEqual(entry['backup'], 'backup')
+            self.assertEqual(entry['dest_ino'][0], os.lstat(dest).st_ino)
+
+            manifest_.load(path)
+            self.assertTrue(manifest_.is_linked(src, dest))
+
+            # Replacing the link changes its inode
+            os.remove(dest)
+            open(dest, 'a').close()
+
+            self.assertFalse(manifest_.is_linked(src, dest))
+
+    def test_set_filemap(self):
+        manifest_ = manifest.Manifest()
+        manifest_.data['entries'] = {
+            'dest1': {'state': 'linked'}, 'dest2': {'state': 'linked'},
+            'dest3': {'state': 'bundled'},
+        }
+        stamps = {'config': [1, 2]}
+
+        manifest_.set_filemap(stamps, {'src1': 'dest1'})
+
+        self.assertTrue(manifest_.is_current(stamps))
+        self.assertFalse(manifest_.is_current({'config': [1, 3]}))
+        self.assertEqual(manifest_.filemap(), {'src1': 'dest1'})
+        # Bundled entries are kept, they aren't in any filemap
+        self.assertEqual(sorted(manifest_.data['entries']), ['dest1', 'dest3'])
+
+
+if __name__ == '__main__':
+    unittest.main()
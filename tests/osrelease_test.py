@@ -0,0 +1,34 @@
+"""Test osrelease module"""
+
+
+import unittest
+import test_utils
+from context import dfman
+from dfman import osrelease
+from dfman.osrelease import OsRelease
+
+
+class TestOsRelease(unittest.TestCase):
+
+    def test_parse(self):
+        release = osrelease.parse([
+            'NAME="Pop!_OS"\n', 'ID=pop\n', "ID_LIKE='ubuntu debian'\n",
+            'VERSION_ID="22.04"\n', 'PRETTY_NAME="Pop!_OS 22.04 LTS"\n',
+        ])
+        self.assertEqual(release, OsRelease('pop', ['ubuntu', 'debian'], '22.04'))
+        self.assertEqual(release.sections(), ['debian', 'ubuntu', 'pop', 'pop-22.04'])
+        self.assertEqual(osrelease.parse(['ID=arch']).sections(), ['arch'])
+        self.assertIsNone(osrelease.parse(['NAME=Nothing']))
+
+    def test_load(self):
+        with test_utils.tempfile_with_content('ID=spooky\n') as tmp:
+            self.assertEqual(osrelease.load(tmp), OsRelease('spooky'))
+            with open(tmp, 'w') as f:
+                f.write('ID=changed\n')
+            # Only read once
+            self.assertEqual(osrelease.load(tmp), OsRelease('spooky'))
+        self.assertIsNone(osrelease.load(tmp + '.missing'))
+
+
+if __name__ == '__main__':
+    unittest.main()
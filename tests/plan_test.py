@@ -0,0 +1,191 @@
+"""Test plan module"""
+
+
+import os
+import unittest
+from mock import patch
+import test_utils
+from context import dfman
+from dfman import plan
+from dfman.plan import Operation
+
+
+class TestPlan(unittest.TestCase):
+
+    def test_record(self):
+        with test_utils.temp_directory() as tmpdir:
+            link = os.path.join(tmpdir, 'link')
+            os.symlink('target', link)
+            plan_ = plan.Plan()
+            plan_.move('a', 'b')
+            plan_.symlink('c', 'd')
+            plan_.unlink(link)
+
+            self.assertEqual(list(plan_), [
+                Operation('move', 'a', 'b'),
+                Operation('symlink', 'c', 'd'),
+                Operation('unlink', 'target', link),
+            ])
+            # Nothing is touched while planning
+            self.assertTrue(os.path.islink(link))
+
+    def test_apply_plan(self):
+        with test_utils.temp_directory() as tmpdir:
+            journal = os.path.join(tmpdir, 'journal')
+            src = os.path.join(tmpdir, 'src')
+            dest = os.path.join(tmpdir, 'config', 'dest')
+            backup = os.path.join(tmpdir, 'backup')
+            os.makedirs(src)
+            os.makedirs(dest)
+            open(os.path.join(dest, 'file'), 'a').close()
+            plan_ = plan.Plan()
+            plan_.move(dest, backup)
+            plan_.symlink(src, dest)
+
+            plan.apply_plan(plan_, journal)
+
+            self.assertEqual(os.readlink(dest), src)
+            self.assertTrue(os.path.isfile(os.path.join(backup, 'file')))
+            self.assertFalse(os.path.exists(journal))
+
+            # A move never replaces an existing destination
+            plan_ = plan.Plan()
+            plan_.move(src, backup)
+
+            with self.assertRaises(FileExistsError):
+                plan.apply_plan(plan_, journal)
+
+            self.assertTrue(os.path.exists(journal))
+
+    def test_apply_plan_crash(self):
+        with test_utils.temp_directory() as tmpdir:
+            journal = os.path.join(tmpdir, 'journal')
+            src = os.path.join(tmpdir, 'src')
+            dest = os.path.join(tmpdir, 'dest')
+            backup = os.path.join(tmpdir, 'backup')
+            open(src, 'a').close()
+            open(dest, 'a').close()
+            plan_ = plan.Plan()
+            plan_.move(dest, backup)
+            plan_.symlink(src, dest)
+            run = plan.BatchOperator.run
+            calls = []
+
+            def crash(self, op):
+                if calls:
+                    raise KeyboardInterrupt
+                calls.append(op)
+                run(self, op)
+
+            with patch.object(plan.BatchOperator, 'run', crash):
+                with self.assertRaises(KeyboardInterrupt):
+                    plan.apply_plan(plan_, journal)
+
+            self.assertEqual(plan.Journal(journal).load()[1], {0})
+
+            with open(journal) as f:
+                content = f.read()
+            rolled_back = plan.recover(journal, rollback=True)
+
+            self.assertEqual(rolled_back, [Operation('move', backup, dest)])
+            self.assertTrue(os.path.isfile(dest))
+            self.assertFalse(os.path.exists(journal))
+
+            # Roll forward from the same point
+            os.rename(dest, backup)
+            with open(journal, 'w') as f:
+                f.write(content)
+            rolled_forward = plan.recover(journal)
+
+            self.assertEqual(rolled_forward, [Operation('symlink', src, dest)])
+            self.assertEqual(os.readlink(dest), src)
+
+    def test_rollback_copy(self):
+        with test_utils.temp_directory() as tmpdir:
+            journal = os.path.join(tmpdir, 'journal')
+            src = os.path.join(tmpdir, 'src')
+            dest = os.path.join(tmpdir, 'dest')
+            backup = os.path.join(tmpdir, 'backup')
+            with open(src, 'w') as f:
+                f.write('copy')
+            with open(dest, 'w') as f:
+                f.write('original')
+            plan_ = plan.Plan()
+            plan_.move(dest, backup)
+            plan_.copy(src, dest)
+            plan_.symlink(src, os.path.join(tmpdir, 'link'))
+            run = plan.BatchOperator.run
+
+            def crash(self, op):
+                if op.kind == 'symlink':
+                    raise KeyboardInterrupt
+                run(self, op)
+
+            with patch.object(plan.BatchOperator, 'run', crash):
+                with self.assertRaises(KeyboardInterrupt):
+                    plan.apply_plan(plan_, journal)
+            rolled_back = plan.recover(journal, rollback=True)
+
+            self.assertEqual(rolled_back, [
+                Operation('remove', src, dest), Operation('move', backup, dest)
+            ])
+            with open(dest) as f:
+                self.assertEqual(f.read(), 'original')
+            self.assertFalse(os.path.exists(journal))
+
+    def test_inverse(self):
+        self.assertEqual(
+            Operation('move', 'a', 'b').inverse(), Operation('move', 'b', 'a')
+        )
+        self.assertEqual(
+            Operation('symlink', 'a', 'b').inverse(), Operation('unlink', 'a', 'b')
+        )
+        self.assertEqual(
+            Operation('unlink', 'a', 'b').inverse(), Operation('symlink', 'a', 'b')
+        )
+        self.assertEqual(
+            Operation('mkdir', None, 'b').inverse(), Operation('rmdir', None, 'b')
+        )
+        self.assertEqual(
+            Operation('copy', 'a', 'b').inverse(), Operation('remove', 'a', 'b')
+        )
+        with self.assertRaises(ValueError):
+            Operation('unlink', None, 'b').inverse()
+
+    def test_batch_operator_replaced_directory(self):
+        with test_utils.temp_directory() as tmpdir:
+            parent = os.path.join(tmpdir, 'parent')
+            moved = os.path.join(tmpdir, 'moved')
+            os.makedirs(parent)
+            with plan.BatchOperator() as batch:
+                batch.run(Operation('symlink', 'a', os.path.join(parent, 'a')))
+                batch.run(Operation('move', parent, moved))
+                os.makedirs(parent)
+                batch.run(Operation('symlink', 'b', os.path.join(parent, 'b')))
+
+            self.assertEqual(os.listdir(parent), ['b'])
+            self.assertEqual(os.listdir(moved), ['a'])
+
+
+    def test_batch_operator_many_directories(self):
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        limit = 128
+        with test_utils.temp_directory() as tmpdir:
+            plan_ = plan.Plan()
+            for i in range(limit * 2):
+                parent = os.path.join(tmpdir, 'dir%d' % i)
+                plan_.mkdir(parent)
+                plan_.symlink('target', os.path.join(parent, 'link'))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+            try:
+                plan.apply_plan(plan_, os.path.join(tmpdir, 'journal'))
+            finally:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+            self.assertEqual(
+                os.readlink(os.path.join(tmpdir, 'dir%d' % (limit * 2 - 1), 'link')), 'target'
+            )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""Test profiling module"""
+
+
+import json
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman import profiling
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_write(self):
+        profiler = profiling.Profiler()
+        for _ in range(2):
+            with profiler.span('phase'):
+                pass
+        with profiler.span('symlink', 'fileop'):
+            profiler.count('lstat', 3)
+
+        with test_utils.temp_directory() as tmpdir:
+            path = os.path.join(tmpdir, 'profile.json')
+            profiler.write(path)
+            with open(path) as f:
+                summary = json.load(f)
+            with open(os.path.join(tmpdir, 'profile.trace.json')) as f:
+                trace = json.load(f)
+
+        self.assertEqual(summary['spans']['phase']['count'], 2)
+        self.assertEqual(summary['spans']['symlink']['cat'], 'fileop')
+        self.assertEqual(summary['counters'], {'lstat': 3})
+        events = trace['traceEvents']
+        self.assertEqual([i['name'] for i in events], ['phase', 'phase', 'symlink'])
+        for event in events:
+            self.assertEqual(event['ph'], 'X')
+            self.assertGreaterEqual(event['dur'], 0)
+
+    def test_null_profiler(self):
+        profiler = profiling.NullProfiler()
+        with profiler.span('phase'):
+            profiler.count('lstat')
+        self.assertFalse(profiler.enabled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+"""Test resolver module"""
+
+
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman.resolver import PathResolver
+
+
+class TestPathResolver(unittest.TestCase):
+
+    def test_realpath(self):
+        with test_utils.temp_directory() as tmpdir:
+            tmpdir = os.path.realpath(tmpdir)
+            os.makedirs(os.path.join(tmpdir, 'real', 'sub'))
+            open(os.path.join(tmpdir, 'real', 'sub', 'file'), 'a').close()
+            os.symlink('real', os.path.join(tmpdir, 'linked'))
+            os.symlink('../real/sub/file', os.path.join(tmpdir, 'real', 'relative'))
+            os.symlink(
+                os.path.join(tmpdir, 'linked', 'sub'), os.path.join(tmpdir, 'real', 'absolute')
+            )
+            os.symlink('relative', os.path.join(tmpdir, 'real', 'chained'))
+            os.symlink('loop', os.path.join(tmpdir, 'loop'))
+            paths = [
+                os.path.join(tmpdir, 'real', 'sub', 'file'),
+                os.path.join(tmpdir, 'linked', 'sub', 'file'),
+                os.path.join(tmpdir, 'real', 'relative'),
+                os.path.join(tmpdir, 'linked', 'relative'),
+                os.path.join(tmpdir, 'real', 'absolute', 'file'),
+                os.path.join(tmpdir, 'real', 'chained'),
+                os.path.join(tmpdir, 'real', 'missing', 'file'),
+                os.path.join(tmpdir, 'linked', 'sub', '..', 'sub'),
+                os.path.join(tmpdir, 'loop'),
+            ]
+            resolver = PathResolver()
+            for path in paths:
+                self.assertEqual(resolver.realpath(path), os.path.realpath(path), path)
+
+            # Every directory of the first path is resolved once
+            resolver = PathResolver()
+            resolver.realpath(paths[0])
+            misses = resolver.misses
+            self.assertEqual(resolver.counts(), {'hits': 0, 'misses': misses, 'fallbacks': 0})
+            resolver.realpath(os.path.join(tmpdir, 'real', 'sub', 'other'))
+            self.assertEqual(resolver.counts(), {'hits': 1, 'misses': misses, 'fallbacks': 0})
+            # Only the symlinked directory falls back to os.path.realpath
+            resolver.realpath(paths[1])
+            self.assertEqual(resolver.counts()['fallbacks'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+"""Test dfman startup cost"""
+
+
+import os
+import subprocess
+import sys
+import unittest
+import test_utils
+from context import dfman
+
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SCRIPT = os.path.join(ROOT, 'bin', 'dfman')
+
+# Modules that must stay off the no-op install path. argparse pulls in
+# shutil itself, so shutil is only checked when importing dfman.core.
+LAZY_MODULES = ('asyncio', 'configparser', 'concurrent.futures', 'datetime', 'hashlib')
+# Loaded by the code paths using them, never by importing dfman.core
+CORE_LAZY_MODULES = (
+    'logging.handlers', 'dfman.backup', 'dfman.fastcopy', 'dfman.filemap', 'dfman.plan',
+    'dfman.resolver', 'dfman.template'
+)
+
+
+class TestStartup(unittest.TestCase):
+
+    def run_dfman(self, home, *args):
+        env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+        return subprocess.run(
+            [sys.executable] + list(args),
+            env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+
+    def test_import_is_lazy(self):
+        result = self.run_dfman(
+            ROOT, '-c', 'import sys, dfman.core; print(" ".join(sys.modules))'
+        )
+        loaded = result.stdout.split()
+        for module in LAZY_MODULES + CORE_LAZY_MODULES + ('argparse', 'shutil'):
+            self.assertNotIn(module, loaded)
+
+    def test_import_package(self):
+        result = self.run_dfman(
+            ROOT, '-c', 'import sys, dfman; print(" ".join(sys.modules))'
+        )
+        loaded = result.stdout.split()
+        self.assertNotIn('dfman.api', loaded)
+        self.assertNotIn('dfman.core', loaded)
+        result = self.run_dfman(ROOT, '-c', 'import dfman.api, dfman; print(dfman.Dfman.__name__)')
+        self.assertEqual(result.stdout, 'Dfman\n')
+
+    def test_noop_install(self):
+        with test_utils.temp_directory() as home:
+            os.makedirs(os.path.join(home, '.dotfiles', 'files', 'app'))
+            os.makedirs(os.path.join(home, '.config'))
+            # First run creates the config, its compiled cache and the manifest
+            self.run_dfman(home, SCRIPT, 'install')
+
+            result = self.run_dfman(home, '-X', 'importtime', SCRIPT, 'install')
+            imported = [line.split('|')[-1].strip() for line in result.stderr.splitlines()]
+            for module in LAZY_MODULES:
+                self.assertNotIn(module, imported)
+
+
+if __name__ == '__main__':
+    unittest.main()
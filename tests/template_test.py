@@ -0,0 +1,106 @@
+"""Test template module"""
+
+
+import os
+import unittest
+import test_utils
+from context import dfman
+from dfman import template
+from dfman.plan import BatchOperator, Operation, Plan
+
+
+class TestTemplate(unittest.TestCase):
+
+    def test_render(self):
+        self.assertEqual(
+            template.render('user=$user ${host}s $$', {'user': 'me', 'host': 'box'}),
+            'user=me boxs $'
+        )
+        with self.assertRaises(KeyError):
+            template.render('$missing', {})
+        self.assertEqual(template.strip_suffix('bashrc' + template.SUFFIX), 'bashrc')
+
+    def test_plan_render(self):
+        with test_utils.temp_directory() as tmpdir:
+            root = os.path.join(tmpdir, 'rendered')
+            src = os.path.join(tmpdir, 'gitconfig' + template.SUFFIX)
+            with open(src, 'w') as f:
+                f.write('email = $email\n')
+            os.chmod(src, 0o600)
+            output = os.path.join(root, 'gitconfig')
+
+            cache = template.RenderCache(root, tmpdir, {'email': 'a@example.com'})
+            plan = Plan()
+            self.assertEqual(cache.plan_render(src, plan), output)
+            self.assertEqual(
+                list(plan), [Operation('render', ['email = a@example.com\n', 0o600], output)]
+            )
+            with BatchOperator() as batch:
+                for op in plan:
+                    batch.run(op)
+            cache.save()
+            # The render is never more readable than the template
+            self.assertEqual(os.stat(output).st_mode & 0o777, 0o600)
+
+            # Unchanged inputs are not rendered again
+            cache = template.RenderCache(root, tmpdir, {'email': 'a@example.com'})
+            cache.load()
+            plan = Plan()
+            cache.plan_render(src, plan)
+            self.assertEqual(len(plan), 0)
+
+            # Changed variables render it again
+            cache = template.RenderCache(root, tmpdir, {'email': 'b@example.com'})
+            cache.load()
+            plan = Plan()
+            cache.plan_render(src, plan)
+            self.assertEqual(len(plan), 1)
+
+            # So does a changed mode
+            os.chmod(src, 0o644)
+            cache = template.RenderCache(root, tmpdir, {'email': 'a@example.com'})
+            cache.load()
+            plan = Plan()
+            cache.plan_render(src, plan)
+            self.assertEqual(len(plan), 1)
+
+    def test_output_path(self):
+        root = os.path.join('/', 'rendered')
+        source_root = os.path.join('/', 'dotfiles')
+        outputs = {
+            template.output_path(root, source_root, os.path.join(source_root, name))
+            for name in ('rc.tmpl', os.path.join('a', 'rc.tmpl'), os.path.join('b', 'rc.tmpl'))
+        }
+        self.assertEqual(outputs, {
+            os.path.join(root, 'rc'), os.path.join(root, 'a', 'rc'), os.path.join(root, 'b', 'rc')
+        })
+        # Templates outside source_root stay below root
+        self.assertEqual(
+            template.output_path(root, source_root, os.path.join('/', 'etc', 'rc.tmpl')),
+            os.path.join(root, 'etc', 'rc')
+        )
+
+    def test_index_name(self):
+        with test_utils.temp_directory() as tmpdir:
+            root = os.path.join(tmpdir, 'rendered')
+            src = os.path.join(tmpdir, 'index.json' + template.SUFFIX)
+            with open(src, 'w') as f:
+                f.write('{"email": "$email"}')
+
+            cache = template.RenderCache(root, tmpdir, {'email': 'a@example.com'})
+            plan = Plan()
+            output = cache.plan_render(src, plan)
+            with BatchOperator() as batch:
+                for op in plan:
+                    batch.run(op)
+            cache.save()
+
+            cache = template.RenderCache(root, tmpdir, {'email': 'a@example.com'})
+            cache.load()
+            self.assertIn(output, cache.index)
+            with open(output) as f:
+                self.assertEqual(f.read(), '{"email": "a@example.com"}')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,13 +9,14 @@ from contextlib import contextmanager
 
 @contextmanager
 def tempfile_with_content(content):
-    tempf = tempfile.NamedTemporaryFile(delete=False, mode='w')
+    tempdir = tempfile.mkdtemp()
+    tempf = tempfile.NamedTemporaryFile(dir=tempdir, delete=False, mode='w')
     try:
         tempf.write(content)
         tempf.seek(0)
         yield tempf.name
     finally:
-         os.remove(tempf.name)
+        shutil.rmtree(tempdir)
 
 @contextmanager
 def temp_directory():
@@ -0,0 +1,112 @@
+"""Test verify module"""
+
+
+import io
+import json
+import os
+import unittest
+from mock import patch
+import test_utils
+from context import dfman
+from dfman import core, verify
+
+
+class TestVerify(unittest.TestCase):
+
+    @patch('dfman.core.Config')
+    def test_run(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'render_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['digest_cache'] = os.path.join(tmpdir, 'digests.json')
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            filemap = {}
+            for name in ('linked', 'copied', 'modified', 'missing', 'retargeted', 'tree'):
+                filemap[os.path.join(paths['dotfile_path'], name)] = \
+                    os.path.join(paths['config_path'], name)
+            src = os.path.join(paths['dotfile_path'], '%s')
+            dest = os.path.join(paths['config_path'], '%s')
+            for name in ('linked', 'copied', 'modified', 'missing', 'retargeted'):
+                with open(src % name, 'w') as f:
+                    f.write('content')
+            os.makedirs(src % 'tree')
+            with open(os.path.join(src % 'tree', 'file'), 'w') as f:
+                f.write('content')
+            os.symlink(src % 'linked', dest % 'linked')
+            with open(dest % 'copied', 'w') as f:
+                f.write('content')
+            with open(dest % 'modified', 'w') as f:
+                f.write('changed')
+            os.symlink(src % 'copied', dest % 'retargeted')
+            # An unfolded tree, with a file of its own
+            os.makedirs(dest % 'tree')
+            os.symlink(os.path.join(src % 'tree', 'file'), os.path.join(dest % 'tree', 'file'))
+            open(os.path.join(dest % 'tree', 'state'), 'a').close()
+            mock_config.return_value.getpath.side_effect = lambda _, key: paths[key]
+
+            runtime = core.MainRuntime(False, False)
+            with patch.object(runtime, 'get_filemap', return_value=filemap):
+                report = verify.Verify(runtime, jobs=2).run()
+                self.assertEqual(report['checked'], 6)
+                self.assertEqual(
+                    [(item['state'], item['dest']) for item in report['drift']],
+                    [(state, dest % state) for state in (
+                        'copied', 'missing', 'modified', 'retargeted'
+                    )]
+                )
+
+                # Unchanged files are not hashed again
+                with patch.object(verify.backup, 'hash_file') as mock_hash:
+                    self.assertEqual(verify.Verify(runtime, jobs=2).run(), report)
+                mock_hash.assert_not_called()
+
+            with open(paths['digest_cache']) as f:
+                self.assertEqual(set(json.load(f)), {
+                    path % name for path in (src, dest) for name in ('copied', 'modified')
+                })
+            out = io.StringIO()
+            verify.Verify.write_report(report, out)
+            lines = [json.loads(line) for line in out.getvalue().splitlines()]
+            self.assertEqual(lines[-1], {'checked': 6, 'drifted': 4})
+
+    @patch('dfman.core.Config')
+    def test_run_copy_mode(self, mock_config):
+        with test_utils.temp_directory() as tmpdir:
+            paths = {
+                i: os.path.join(tmpdir, i)
+                for i in ('dotfile_path', 'config_path', 'render_path')
+            }
+            for path in paths.values():
+                os.makedirs(path)
+            paths['digest_cache'] = os.path.join(tmpdir, 'digests.json')
+            paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+            src = os.path.join(paths['dotfile_path'], 'app')
+            dest = os.path.join(paths['config_path'], 'app')
+            for root in (src, dest):
+                os.makedirs(root)
+                with open(os.path.join(root, 'config'), 'w') as f:
+                    f.write('content')
+                os.symlink('config', os.path.join(root, 'current'))
+            with open(os.path.join(src, 'theme'), 'w') as f:
+                f.write('dark')
+            with open(os.path.join(dest, 'theme'), 'w') as f:
+                f.write('blue')
+            mc = mock_config.return_value
+            mc.getpath.side_effect = lambda _, key: paths[key]
+            mc.get.side_effect = lambda _, key: {'install_mode': 'copy'}[key]
+
+            runtime = core.MainRuntime(False, False)
+            with patch.object(runtime, 'get_filemap', return_value={src: dest}):
+                report = verify.Verify(runtime).run()
+
+            self.assertEqual(report['drift'], [
+                verify.finding('modified', os.path.join(src, 'theme'), os.path.join(dest, 'theme'))
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main()
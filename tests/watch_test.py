@@ -0,0 +1,156 @@
+"""Test watch module"""
+
+
+import os
+import unittest
+from mock import patch
+import test_utils
+from context import dfman
+from dfman import watch
+
+
+class TestWatch(unittest.TestCase):
+
+    def make_runtime(self, tmpdir):
+        paths = {
+            i: os.path.join(tmpdir, i)
+            for i in ('dotfile_path', 'config_path', 'backup_path')
+        }
+        for path in paths.values():
+            os.makedirs(path)
+        paths['manifest'] = os.path.join(tmpdir, 'manifest.json')
+        paths['journal'] = os.path.join(tmpdir, 'journal')
+        paths['render_path'] = os.path.join(tmpdir, 'rendered')
+        cfg_file = os.path.join(tmpdir, 'cfg', 'dfman.conf')
+        os.makedirs(os.path.dirname(cfg_file))
+        with open(cfg_file, 'w') as f:
+            f.write('[Globals]\n')
+            for key, value in paths.items():
+                f.write('%s = %s\n' % (key, value))
+            f.write('[Overrides]\n')
+        runtime = dfman.core.MainRuntime(False, False)
+        runtime.config.cfg_file = cfg_file
+        runtime.config.load_cfg()
+        runtime.distro = None
+        return runtime, paths
+
+    def check_watcher(self, watcher, paths, cfg_file):
+        self.assertEqual(watcher.wait(0), set())
+        open(os.path.join(paths['dotfile_path'], 'file1'), 'a').close()
+        os.remove(os.path.join(paths['dotfile_path'], 'file0'))
+        self.assertEqual(watcher.wait(2), {'file0', 'file1'})
+        with open(cfg_file, 'a') as f:
+            f.write('\n')
+        self.assertEqual(watcher.wait(2), {watch.CONFIG_CHANGED})
+        # A template edited in place
+        with open(os.path.join(paths['dotfile_path'], 'rc.tmpl'), 'w') as f:
+            f.write('edited')
+        self.assertEqual(watcher.wait(2), {'rc.tmpl'})
+
+    def test_inotify_watcher(self):
+        with test_utils.temp_directory() as tmpdir:
+            runtime, paths = self.make_runtime(tmpdir)
+            open(os.path.join(paths['dotfile_path'], 'file0'), 'a').close()
+            open(os.path.join(paths['dotfile_path'], 'rc.tmpl'), 'a').close()
+            try:
+                watcher = watch.InotifyWatcher(paths['dotfile_path'], runtime.config.cfg_file)
+            except OSError:
+                self.skipTest('inotify unavailable')
+            try:
+                self.check_watcher(watcher, paths, runtime.config.cfg_file)
+            finally:
+                watcher.close()
+
+    def test_inotify_burst(self):
+        with test_utils.temp_directory() as tmpdir:
+            runtime, paths = self.make_runtime(tmpdir)
+            try:
+                watcher = watch.InotifyWatcher(paths['dotfile_path'], runtime.config.cfg_file)
+            except OSError:
+                self.skipTest('inotify unavailable')
+            try:
+                # More events than a single read returns
+                names = {'%s%04d' % ('x' * 60, i) for i in range(2000)}
+                for name in names:
+                    open(os.path.join(paths['dotfile_path'], name), 'a').close()
+                self.assertEqual(watcher.wait(2), names)
+
+                # Dropped events make everything be checked
+                changes = set()
+                watcher._read_events(
+                    watcher._event.pack(-1, watch.IN_Q_OVERFLOW, 0, 0), changes
+                )
+                self.assertEqual(changes, {watch.CONFIG_CHANGED})
+            finally:
+                watcher.close()
+
+    def test_poll_watcher(self):
+        with test_utils.temp_directory() as tmpdir:
+            runtime, paths = self.make_runtime(tmpdir)
+            open(os.path.join(paths['dotfile_path'], 'file0'), 'a').close()
+            open(os.path.join(paths['dotfile_path'], 'rc.tmpl'), 'a').close()
+            # Make sure the mtimes differ from the initial index
+            os.utime(paths['dotfile_path'], ns=(0, 0))
+            os.utime(runtime.config.cfg_file, ns=(0, 0))
+            watcher = watch.PollWatcher(
+                paths['dotfile_path'], runtime.config.cfg_file, interval=0.01
+            )
+            self.check_watcher(watcher, paths, runtime.config.cfg_file)
+
+    def test_step(self):
+        with test_utils.temp_directory() as tmpdir:
+            runtime, paths = self.make_runtime(tmpdir)
+            open(os.path.join(paths['dotfile_path'], 'file1'), 'a').close()
+            watch_ = watch.Watch(runtime, debounce=0.05, interval=0.01)
+            watch_.start()
+            dest = {
+                name: os.path.join(paths['config_path'], name)
+                for name in ('file1', 'file2', 'file3')
+            }
+            self.assertTrue(os.path.islink(dest['file1']))
+
+            # A burst of changes is applied once, touching only those entries
+            for name in ('file2', 'file3'):
+                open(os.path.join(paths['dotfile_path'], name), 'a').close()
+            os.remove(os.path.join(paths['dotfile_path'], 'file1'))
+            with patch.object(runtime, 'install_changes', wraps=runtime.install_changes) \
+                    as mock_install_changes, \
+                    patch.object(runtime, 'iter_filemap') as mock_iter_filemap:
+                changes = watch_.step(timeout=2)
+                while changes != {'file1', 'file2', 'file3'}:
+                    # The watcher may report the burst in several batches
+                    changes |= watch_.step(timeout=2)
+            watch_.watcher.close()
+
+            mock_iter_filemap.assert_not_called()
+            self.assertLessEqual(mock_install_changes.call_count, 3)
+            self.assertFalse(os.path.lexists(dest['file1']))
+            self.assertTrue(os.path.islink(dest['file2']))
+            self.assertTrue(os.path.islink(dest['file3']))
+            # The stored filemap is kept current for the next install
+            self.assertTrue(runtime.manifest.is_current(runtime.get_stamps()))
+
+    def test_step_template(self):
+        with test_utils.temp_directory() as tmpdir:
+            runtime, paths = self.make_runtime(tmpdir)
+            src = os.path.join(paths['dotfile_path'], 'rc.tmpl')
+            dest = os.path.join(paths['config_path'], 'rc')
+            with open(src, 'w') as f:
+                f.write('first')
+            watch_ = watch.Watch(runtime, debounce=0.05, interval=0.01)
+            watch_.start()
+            with open(dest) as f:
+                self.assertEqual(f.read(), 'first')
+
+            with open(src, 'w') as f:
+                f.write('second')
+            try:
+                self.assertEqual(watch_.step(timeout=2), {'rc.tmpl'})
+            finally:
+                watch_.watcher.close()
+            with open(dest) as f:
+                self.assertEqual(f.read(), 'second')
+
+
+if __name__ == '__main__':
+    unittest.main()